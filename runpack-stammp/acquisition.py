@@ -0,0 +1,242 @@
+# title             : acquisition.py
+# description       : Snap and sequence frame acquisition engines for RunPack
+# authors           : Daniel Mokhtari
+# credits           :
+# date              : 20201018
+# version update    : 20201018
+# version           : 0.1.1
+# python_version    : 2.7
+
+
+import warnings
+from itertools import groupby
+
+from runpack import clock
+from runpack import profiling
+
+
+################################################################################
+
+
+def supportsSequencing(core):
+	"""Checks whether a MicroManager core offers circular buffer sequence
+	acquisition
+
+	Args:
+		core (MMCorePy.CMMCore): MicroManager core
+
+	Returns:
+		bool: True if sequence acquisition is available
+	"""
+	required = ('startSequenceAcquisition', 'isSequenceRunning',
+				'getRemainingImageCount', 'popNextImage')
+	return all(hasattr(core, name) for name in required)
+
+
+def supportsExposureSequence(core):
+	"""Checks whether the camera can step through a sequence of exposures in
+	hardware
+
+	Args:
+		core (MMCorePy.CMMCore): MicroManager core
+
+	Returns:
+		bool: True if the camera exposure is sequenceable
+	"""
+	try:
+		return bool(core.isExposureSequenceable(core.getCameraDevice()))
+	except Exception:
+		return False
+
+
+
+class AcquisitionEngine:
+	def __init__(self, core, mode = 'snap', halt = None, pollInterval = 0.001):
+		"""Acquires the frames of a channel's exposure list
+
+		In 'snap' mode every frame is a software-triggered snapImage/getImage
+		pair. In 'sequence' mode runs of repeated exposures are acquired as
+		circular buffer sequences, and exposure lists are stepped through in
+		hardware if the camera supports exposure sequences. Single frames are
+		always snapped. If the core does not support sequences, or a sequence
+		fails, the engine warns and falls back to snap mode.
+
+		Args:
+			core (MMCorePy.CMMCore): MicroManager core
+			mode (str): acquisition mode ('snap' | 'sequence')
+			halt (threading.Event): event that stops acquisition when set
+			pollInterval (float): circular buffer polling interval (s)
+
+		Returns:
+			None
+		"""
+		if mode not in ('snap', 'sequence'):
+			raise ValueError('Acquisition mode must be \'snap\' or \'sequence\'')
+		self.core = core
+		self.mode = mode
+		self.halt = halt
+		self.pollInterval = pollInterval
+		self.sequencing = mode == 'sequence' and supportsSequencing(core)
+		if mode == 'sequence' and not self.sequencing:
+			warnings.warn('Sequence acquisition not supported by the core, using snaps')
+		self.exposureSequencing = self.sequencing and supportsExposureSequence(core)
+
+
+	def _checkHalt(self):
+		if self.halt is not None and self.halt.is_set():
+			raise RuntimeError('Acquisition halted by emergency stop')
+
+
+	def _stopSequences(self):
+		camera = self.core.getCameraDevice()
+		for command, args in (('stopSequenceAcquisition', ()), ('stopExposureSequence', (camera,))):
+			try:
+				getattr(self.core, command)(*args)
+			except Exception:
+				pass
+
+
+	def acquire(self, exposures, afterLastExposure = None):
+		"""Acquires one frame per exposure, in order
+
+		Args:
+			exposures (list): camera exposures (ms)
+			afterLastExposure (callable): called once the last frame has been
+				exposed, before it is read out (e.g. to start a stage move)
+
+		Returns:
+			list: (exposure, image, exposure time (s), readout time (s))
+				tuples, one per frame
+		"""
+		exposures = list(exposures)
+		if self.sequencing and len(exposures) > 1:
+			try:
+				return self._acquireSequences(exposures, afterLastExposure)
+			except Exception as e: # MMCorePy raises CMMError
+				if self.halt is not None and self.halt.is_set():
+					raise
+				self._stopSequences()
+				self.sequencing = self.exposureSequencing = False
+				warnings.warn('Sequence acquisition failed ({}), falling back to snaps'.format(e))
+		return self._acquireSnaps(exposures, afterLastExposure)
+
+
+	def burst(self, exposure, numFrames, intervalMs = 0):
+		"""Acquires a timed burst of frames at a fixed exposure
+
+		Args:
+			exposure (float): camera exposure (ms)
+			numFrames (int): number of frames
+			intervalMs (float): requested interval between frame starts (ms).
+				0 acquires as fast as the camera allows.
+
+		Returns:
+			list: (exposure, image, exposure time (s), readout time (s),
+				frame start offset (s)) tuples, one per frame
+		"""
+		if self.sequencing and numFrames > 1:
+			try:
+				frames = self._sequence([exposure] * numFrames, intervalMs, None)
+				period = frames[0][2] if frames else 0.0
+				return [frame + (k * period,) for k, frame in enumerate(frames)]
+			except Exception as e: # MMCorePy raises CMMError
+				if self.halt is not None and self.halt.is_set():
+					raise
+				self._stopSequences()
+				self.sequencing = self.exposureSequencing = False
+				warnings.warn('Sequence acquisition failed ({}), falling back to snaps'.format(e))
+		frames = []
+		burstStart = clock.monotonic()
+		for k in range(numFrames):
+			frameStart = clock.monotonic()
+			frames.append(self._acquireSnaps([exposure], None)[0] + (frameStart - burstStart,))
+			if intervalMs and k < numFrames - 1:
+				clock.sleep(intervalMs / 1000.0 - (clock.monotonic() - frameStart))
+		return frames
+
+
+	def _acquireSnaps(self, exposures, afterLastExposure):
+		camera = self.core.getCameraDevice()
+		profiler = profiling.active
+		frames = []
+		for e, exposure in enumerate(exposures):
+			self._checkHalt()
+			frameStart = clock.monotonic()
+			self.core.setProperty(camera, 'Exposure', exposure)
+			self.core.waitForDevice(camera)
+			profiler.stop('exposure_set', frameStart)
+			started = profiler.start()
+			self.core.snapImage()
+			snapped = clock.monotonic()
+			profiler.stop('snap', started)
+			if afterLastExposure is not None and e == len(exposures) - 1:
+				afterLastExposure()
+			started = profiler.start()
+			img = self.core.getImage()
+			profiler.stop('get_image', started)
+			frames.append((exposure, img, snapped - frameStart, clock.monotonic() - snapped))
+		return frames
+
+
+	def _acquireSequences(self, exposures, afterLastExposure):
+		if self.exposureSequencing and len(set(exposures)) > 1:
+			return self._sequence(exposures, 0, afterLastExposure)
+		frames = []
+		runs = [list(run) for exposure, run in groupby(exposures)]
+		for r, run in enumerate(runs):
+			callback = afterLastExposure if r == len(runs) - 1 else None
+			if len(run) == 1:
+				frames.extend(self._acquireSnaps(run, callback))
+			else:
+				frames.extend(self._sequence(run, 0, callback))
+		return frames
+
+
+	def _sequence(self, exposures, intervalMs, afterLastExposure):
+		self._checkHalt()
+		camera = self.core.getCameraDevice()
+		profiler = profiling.active
+		numFrames = len(exposures)
+		hardwareExposures = len(set(exposures)) > 1
+		started = profiler.start()
+		if hardwareExposures:
+			self.core.loadExposureSequence(camera, [float(e) for e in exposures])
+			self.core.startExposureSequence(camera)
+		else:
+			self.core.setProperty(camera, 'Exposure', exposures[0])
+		self.core.waitForDevice(camera)
+		profiler.stop('exposure_set', started)
+
+		sequenceStart = clock.monotonic()
+		self.core.startSequenceAcquisition(numFrames, intervalMs, True)
+		images = []
+		readoutTime = 0.0
+		exposed = None
+		try:
+			while len(images) < numFrames:
+				self._checkHalt()
+				if exposed is None and not self.core.isSequenceRunning():
+					exposed = clock.monotonic()
+					if afterLastExposure is not None:
+						afterLastExposure()
+				if self.core.getRemainingImageCount() > 0:
+					popStart = clock.monotonic()
+					images.append(self.core.popNextImage())
+					profiler.stop('get_image', popStart)
+					readoutTime += clock.monotonic() - popStart
+				elif exposed is not None:
+					raise RuntimeError('Sequence stopped after {} of {} frames'.format(len(images), numFrames))
+				else:
+					clock.sleep(self.pollInterval)
+		finally:
+			if hardwareExposures:
+				self.core.stopExposureSequence(camera)
+		if exposed is None:
+			exposed = clock.monotonic()
+			if afterLastExposure is not None:
+				afterLastExposure()
+		exposureTime = (exposed - sequenceStart) / numFrames
+		for exposure in exposures:
+			profiler.add('snap', exposureTime)
+		return [(exposure, img, exposureTime, readoutTime / numFrames)
+				for exposure, img in zip(exposures, images)]
@@ -0,0 +1,346 @@
+# title             : arbiter.py
+# description       : Earliest-deadline-first scan arbitration between devices
+# authors           : Daniel Mokhtari
+# credits           :
+# date              : 20201018
+# version update    : 20201018
+# version           : 0.1.1
+# python_version    : 2.7
+
+
+import heapq
+import itertools
+import threading
+
+import pandas as pd
+
+from runpack import clock
+from runpack.io import ExperimentalHarness as eh
+
+
+################################################################################
+
+
+class ScanRequest:
+	def __init__(self, args, kwargs, deadline, source, key, sequence):
+		"""A scan waiting for, or run by, the ScanArbiter
+
+		Args:
+			args (list): scan positional arguments
+			kwargs (dict): scan keyword arguments
+			deadline (float): requested start, on the runpack monotonic clock
+			source (str): requesting device or process (e.g. 'd1')
+			key (hashable): key of the scan's measured durations
+			sequence (int): submission order, breaking deadline ties
+
+		Returns:
+			None
+		"""
+		self.args = args
+		self.kwargs = kwargs
+		self.deadline = deadline
+		self.source = source
+		self.key = key
+		self.sequence = sequence
+		self.start = None
+		self.end = None
+		self.error = None
+		self.cancelled = False
+		self.done = threading.Event()
+
+
+	def __lt__(self, other):
+		return (self.deadline, self.sequence) < (other.deadline, other.sequence)
+
+
+	@property
+	def lateness(self):
+		"""Start minus requested start (s), once started"""
+		return None if self.start is None else self.start - self.deadline
+
+
+	def wait(self, timeout = None):
+		"""Blocks until the scan has run or was cancelled
+
+		Args:
+			timeout (float): maximum wait (s). Defaults to no limit.
+
+		Returns:
+			bool: True if the request is done
+		"""
+		return self.done.wait(timeout)
+
+
+	def result(self):
+		"""Blocks until the scan has run, then raises its error, or a
+		RuntimeError if it was cancelled
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		self.done.wait()
+		if self.error is not None:
+			raise self.error
+		if self.cancelled:
+			raise RuntimeError('Scan from {} cancelled'.format(self.source))
+
+
+
+class ScanArbiter:
+	def __init__(self, runScan, predictDuration = None, durationKey = None, halt = None,
+					pollInterval = 0.05, lateTolerance = 1.0):
+		"""Owner of the microscope, running scans requested by several devices
+		earliest deadline first
+
+		Devices submit scans with a requested start time. run() executes
+		each scan once its start time arrives, always choosing the earliest
+		deadline among the ready requests. Scan durations are measured per
+		duration key, and are used to predict conflicts: a submission that
+		is predicted to start more than lateTolerance late is warned about.
+		The lateness of every scan is logged and reported by report().
+
+		Sources register before submitting and release once they have no
+		more scans to submit. run() returns when every registered source
+		is released and all requests have run, or on shutdown().
+
+		Args:
+			runScan (callable): function running a scan from (*args, **kwargs)
+			predictDuration (callable): function of (args, kwargs) predicting
+				the duration (s) of a scan not yet measured
+			durationKey (callable): function of (args, kwargs) returning the
+				key of scans with the same duration. Defaults to the source.
+			halt (threading.Event): event that cancels pending scans when set
+			pollInterval (float): interval (s) at which waits check for new
+				requests and halts
+			lateTolerance (float): predicted lateness (s) above which a
+				conflict is warned about
+
+		Returns:
+			None
+		"""
+		self.runScan = runScan
+		self.predictDuration = predictDuration
+		self.durationKey = durationKey
+		self.halt = halt
+		self.pollInterval = pollInterval
+		self.lateTolerance = lateTolerance
+		self.pending = []
+		self.completed = []
+		self.durations = {}
+		self.sources = set()
+		self.running = None
+		self.stopping = False
+		self.counter = itertools.count()
+		self.lock = threading.Condition(threading.Lock())
+
+
+	def register(self, source):
+		"""Registers a source that will submit scans
+
+		Args:
+			source (str): device or process name (e.g. 'd1')
+
+		Returns:
+			None
+		"""
+		with self.lock:
+			self.sources.add(source)
+			self.stopping = False
+
+
+	def release(self, source):
+		"""Declares that a source will submit no more scans
+
+		Args:
+			source (str): device or process name
+
+		Returns:
+			None
+		"""
+		with self.lock:
+			self.sources.discard(source)
+			self.lock.notify_all()
+
+
+	def submit(self, args, kwargs = None, deadline = None, source = None):
+		"""Requests a scan
+
+		Args:
+			args (list): scan positional arguments
+			kwargs (dict): scan keyword arguments
+			deadline (float): requested start, on the runpack monotonic
+				clock. Defaults to now.
+			source (str): requesting device or process
+
+		Returns:
+			ScanRequest: the request, to wait on or inspect
+		"""
+		kwargs = dict(kwargs or {})
+		if deadline is None:
+			deadline = clock.monotonic()
+		key = source if self.durationKey is None else self.durationKey(args, kwargs)
+		with self.lock:
+			if self.stopping:
+				raise RuntimeError('Scan arbiter is shutting down, scan from {} rejected'.format(source))
+			request = ScanRequest(args, kwargs, deadline, source, key, next(self.counter))
+			if key not in self.durations and self.predictDuration is not None:
+				self.durations[key] = self.predictDuration(args, kwargs)
+			heapq.heappush(self.pending, request)
+			self.lock.notify_all()
+			schedule = self._predictSchedule()
+			running = [] if self.running is None else [self.running.source]
+		for other, start, lateness in schedule:
+			if other is request and lateness > self.lateTolerance:
+				blocking = running + [r.source for r, s, l in schedule if r is not request and s < start]
+				eh.acquilogger.warning('Scan from {} predicted to start {:.1f} s late, after scans from {}'.format(
+					source, lateness, sorted(set(blocking))))
+		return request
+
+
+	def _duration(self, request):
+		return self.durations.get(request.key, 0.0)
+
+
+	def _predictSchedule(self):
+		now = clock.monotonic()
+		free = now
+		if self.running is not None:
+			free = max(now, self.running.start + self._duration(self.running))
+		schedule = []
+		for request in sorted(self.pending):
+			start = max(free, request.deadline)
+			schedule.append((request, start, start - request.deadline))
+			free = start + self._duration(request)
+		return schedule
+
+
+	def predictSchedule(self):
+		"""Predicts the start and lateness of every pending scan, from their
+		measured (or predicted) durations
+
+		Args:
+			None
+
+		Returns:
+			pd.DataFrame: source, deadline, predicted start, and predicted
+				lateness (s) of each pending scan, in execution order
+		"""
+		with self.lock:
+			schedule = self._predictSchedule()
+		return pd.DataFrame([{'source': r.source, 'deadline': r.deadline, 'predicted_start': s,
+								'predicted_lateness_s': l} for r, s, l in schedule],
+							columns = ['source', 'deadline', 'predicted_start', 'predicted_lateness_s'])
+
+
+	def _halted(self):
+		return self.halt is not None and self.halt.is_set()
+
+
+	def _next(self):
+		with self.lock:
+			while True:
+				if self._halted():
+					self._cancelPending('emergency stop')
+					return None
+				if self.stopping and not self.pending:
+					return None
+				if not self.pending:
+					if not self.sources:
+						return None
+					self.lock.wait(self.pollInterval)
+					continue
+				delay = self.pending[0].deadline - clock.monotonic()
+				if delay <= 0:
+					self.running = heapq.heappop(self.pending)
+					return self.running
+				self.lock.release()
+				try:
+					clock.sleep(min(delay, self.pollInterval))
+				finally:
+					self.lock.acquire()
+
+
+	def run(self):
+		"""Runs requested scans on the calling thread until every source is
+		released and no scans are pending, or until shutdown
+
+		Args:
+			None
+
+		Returns:
+			pd.DataFrame: lateness report (see report())
+		"""
+		eh.acquilogger.info('Scan arbiter started')
+		while True:
+			request = self._next()
+			if request is None:
+				break
+			request.start = clock.monotonic()
+			try:
+				self.runScan(*request.args, **request.kwargs)
+			except Exception as e:
+				request.error = e
+				eh.acquilogger.exception('Scan from {} failed'.format(request.source))
+			request.end = clock.monotonic()
+			with self.lock:
+				if request.error is None:
+					self.durations[request.key] = request.end - request.start
+				self.running = None
+				self.completed.append(request)
+			request.done.set()
+			eh.acquilogger.info('Scan from {} started {:.2f} s late, took {:.1f} s'.format(
+				request.source, request.lateness, request.end - request.start))
+		eh.acquilogger.info('Scan arbiter stopped')
+		return self.report()
+
+
+	def _cancelPending(self, reason):
+		for request in self.pending:
+			request.cancelled = True
+			request.done.set()
+			self.completed.append(request)
+		if self.pending:
+			eh.acquilogger.warning('Cancelled {} pending scans ({})'.format(len(self.pending), reason))
+		self.pending = []
+
+
+	def shutdown(self, cancel = False):
+		"""Stops the arbiter. New submissions are rejected. run() returns
+		once pending scans have run, or after the running scan if cancel.
+
+		Args:
+			cancel (bool): flag to cancel pending scans
+
+		Returns:
+			None
+		"""
+		with self.lock:
+			self.stopping = True
+			if cancel:
+				self._cancelPending('shutdown')
+			self.lock.notify_all()
+
+
+	def report(self):
+		"""Reports the lateness of every completed or cancelled scan
+
+		Args:
+			None
+
+		Returns:
+			pd.DataFrame: source, deadline, start, end, lateness (s),
+				duration (s), and status of each scan, in execution order
+		"""
+		rows = []
+		with self.lock:
+			for r in self.completed:
+				status = 'cancelled' if r.cancelled else ('failed' if r.error is not None else 'done')
+				rows.append({'source': r.source, 'deadline': r.deadline, 'start': r.start, 'end': r.end,
+								'lateness_s': r.lateness,
+								'duration_s': None if r.start is None else r.end - r.start,
+								'status': status})
+		return pd.DataFrame(rows, columns = ['source', 'deadline', 'start', 'end', 'lateness_s',
+												'duration_s', 'status'])
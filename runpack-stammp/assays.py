@@ -8,9 +8,17 @@
 # python_version    : 2.7
 
 
-import time
+import threading
 from Queue import Queue
 
+import pandas as pd
+
+try:
+	import matplotlib.pyplot as pl
+except ImportError:
+	pl = None # required by plotTimeline only
+
+from runpack import clock
 from runpack.io import HardwareInterface
 from runpack.io import ExperimentalHarness as eh
 from runpack import imagingcontrol as imaging
@@ -20,7 +28,8 @@ from runpack import mitomiprotocols as protocols
 
 class Assay:
 	def __init__(self, dname, experimentalObject, inletPort, channelsExposures, assayTimesName, description, 
-		equilibrationTime = 480, treeFlushTime = 15, postEquilibrationImaging = True, forConcurrency = False):
+		equilibrationTime = 480, treeFlushTime = 15, postEquilibrationImaging = True, forConcurrency = False, 
+		postEquilibImageChanExp = {'4egfp':[500]}):
 		"""
 		Kinetic assay
 
@@ -36,6 +45,7 @@ class Assay:
 			(int) treeFlushTime: Time (s) to pre-flush the inlet tree with substrate/reagent
 			(bool) postEquilibrationImaging: flag to acquire chip image following equilibration
 			(bool) forConcurrency: flag to execute assay as part of concurrent imaging
+			(dict) postEquilibImageChanExp: channels mapped to exposures of the post-equilibration image
 		
 		Returns:
 			None
@@ -50,7 +60,8 @@ class Assay:
 		self.forConcurrency = forConcurrency
 		self.channelsExposures = channelsExposures
 		self.assayParams = {'equilibrationTime': equilibrationTime, 'treeFlushTime': treeFlushTime, 
-								'postEquilibrationImaging': postEquilibrationImaging}
+								'postEquilibrationImaging': postEquilibrationImaging, 
+								'postEquilibImageChanExp': postEquilibImageChanExp}
 		self.acquisitionObject = imaging.KineticAcquisition(dname, channelsExposures, 
 									experimentalObject.assayTimes[assayTimesName], description)
 		self.testParams()
@@ -68,7 +79,37 @@ class Assay:
 
 		protocols.flowSubstrateStartAssay(self.dname, self.inletPort, self.acquisitionObject, 
 			equilibrationTime = self.assayParams['equilibrationTime'], treeFlushTime = self.assayParams['treeFlushTime'], 
-			postEquilibrationImaging = self.assayParams['postEquilibrationImaging'], scanQueueFlag = self.forConcurrency)
+			postEquilibrationImaging = self.assayParams['postEquilibrationImaging'], 
+			postEquilibImageChanExp = self.assayParams['postEquilibImageChanExp'], scanQueueFlag = self.forConcurrency)
+
+	def predictTimeline(self):
+		"""
+		Predicted assay timeline, from the assay timings and the imaging cost model
+
+		Arguments:
+			None
+
+		Returns:
+			(list) (event, start (s), duration (s)) tuples relative to the assay start. 
+				Events are 'flush', 'equilibration', 'button scan', and 'scan <timepoint>'.
+		"""
+
+		positionList = self.experimentalObject.posLists[self.dname]
+		treeFlushTime = self.assayParams['treeFlushTime']
+		equilibrationTime = self.assayParams['equilibrationTime']
+		events = [('flush', 0, treeFlushTime), ('equilibration', treeFlushTime, equilibrationTime)]
+		t = treeFlushTime + equilibrationTime
+		if self.assayParams['postEquilibrationImaging']:
+			duration = imaging.predict_scan_duration(self.assayParams['postEquilibImageChanExp'], positionList)
+			events.append(('button scan', t, duration))
+			t += duration
+		t += 0.5 # closing valves, opening buttons
+		kinetic = self.acquisitionObject
+		duration = imaging.predict_scan_duration(self.channelsExposures, positionList, 
+			homeStage = not kinetic.alternateDirection)
+		for timepoint, requestedStart in enumerate(kinetic.absTimes):
+			events.append(('scan {}'.format(timepoint), t + requestedStart, duration))
+		return events
 
 	def testParams(self):
 		"""
@@ -147,67 +188,290 @@ class AssaySeries:
 		else:
 			while not self.assayQueue.empty():
 				for offset in self.offsets:
-					time.sleep(offset)
+					clock.sleep(offset)
 					nextAssay = self.assayQueue.get()
 					nextAssay.startAssay() #Except the backgrounded version
-		imaging.hardwareState += 1
+		imaging.getScanArbiter().release(self.dname)
+
+	def predictTimeline(self):
+		"""
+		Predicted timeline of the series, assuming every scan starts on time
+
+		Arguments:
+			None
+
+		Returns:
+			(pd.DataFrame) dname, assay, event, start (s), and end (s) of every assay event, 
+				relative to the series start
+		"""
+
+		rows = []
+		t = 0
+		for k, assay in enumerate(self.assayList):
+			if self.offsets:
+				t += self.offsets[k % len(self.offsets)]
+			events = assay.predictTimeline()
+			for event, start, duration in events:
+				rows.append({'dname': self.dname, 'assay': assay.description, 'event': event, 
+								'start': t + start, 'end': t + start + duration})
+			t += max(start + duration for event, start, duration in events)
+		return pd.DataFrame(rows, columns = ['dname', 'assay', 'event', 'start', 'end'])
 
 
 class RiffledAssaySeries:
 
-	def __init__(self, assaySeriesDict):
+	def __init__(self, assaySeriesDict, maxOffset = 3600):
 		"""
-		A Riffled (scheduled) Assay Series Class
-		Not yet implemented
+		A Riffled (scheduled) Assay Series, interleaving the assay series of several devices 
+		on the single microscope
+
+		Each device's series is started at an offset chosen so that its scans fall into the 
+		idle gaps between the scans of the other devices (e.g. during flushes, equilibrations, 
+		and kinetic delays). Devices are placed in turn: the first starts at once, and each 
+		following device gets the smallest offset that minimizes the total predicted scan 
+		lateness. Scans then run through the shared scan arbiter, earliest deadline first.
+
+		Arguments:
+			(dict) assaySeriesDict: device names mapped to their AssaySeries
+			(float) maxOffset: latest start offset (s) considered for a device
+		
+		Returns:
+			None
 		"""
 
 		self.assaySeriesDict = assaySeriesDict
-		# self.initialOffset = self.calculateInitialOffset()
-		# self.otherOffsets = self.calculateOtherOffsets()
-		self.assaySchedules = self.scheduleRiffle()
+		self.maxOffset = maxOffset
+		for assaySeries in assaySeriesDict.values():
+			for assay in assaySeries.assayList:
+				assay.forConcurrency = True # scans go through the scan arbiter
+		self.timelines = {dname: series.predictTimeline() for dname, series in assaySeriesDict.items()}
+		self.offsets = self.calculateOffsets()
+
+	@staticmethod
+	def scanIntervals(timeline):
+		"""
+		Microscope busy intervals of a predicted timeline
+
+		Arguments:
+			(pd.DataFrame) timeline: predicted timeline, as returned by AssaySeries.predictTimeline
+
+		Returns:
+			(list) (start, end) of every scan
+		"""
+
+		scans = timeline[timeline['event'].str.contains('scan')]
+		return list(zip(scans['start'], scans['end']))
+
+	@staticmethod
+	def arbitrate(scans):
+		"""
+		Predicts the start of riffled scans run earliest deadline first
+
+		Arguments:
+			(list) scans: (requested start, duration) of every scan
+
+		Returns:
+			(list) predicted start of every scan, in the order given
+		"""
+
+		starts = [0] * len(scans)
+		free = 0
+		for k in sorted(range(len(scans)), key = lambda k: scans[k][0]):
+			starts[k] = max(free, scans[k][0])
+			free = starts[k] + scans[k][1]
+		return starts
+
+	def _lateness(self, scans):
+		starts = self.arbitrate(scans)
+		return sum(start - requested for start, (requested, duration) in zip(starts, scans))
 
 	def calculateInitialOffset(self):
 		"""
-		To be implemented
+		Start offset of the first device, which starts at once
+
+		Arguments:
+			None
+
+		Returns:
+			(float) 0
+		"""
+
+		return 0.0
+
+	def calculateOtherOffsets(self, placed, dname):
+		"""
+		Chooses the start offset of a device against the already placed devices
+
+		Candidate offsets align each of the device's scans with the end of a placed scan. 
+		The smallest offset with the least total predicted lateness is chosen.
+
+		Arguments:
+			(list) placed: (requested start, duration) of the placed scans
+			(str) dname: device to place
+
+		Returns:
+			(float) start offset (s)
+		"""
+
+		own = [(start, end - start) for start, end in self.scanIntervals(self.timelines[dname])]
+		candidates = set([0.0])
+		for placedStart, placedDuration in placed:
+			for start, duration in own:
+				offset = round(placedStart + placedDuration - start, 3)
+				if 0 <= offset <= self.maxOffset:
+					candidates.add(offset)
+		best = None
+		for offset in sorted(candidates):
+			lateness = self._lateness(placed + [(start + offset, duration) for start, duration in own])
+			if best is None or lateness < best[1] - 1e-9:
+				best = (offset, lateness)
+			if lateness <= 1e-9:
+				break
+		return best[0]
+
+	def calculateOffsets(self):
+		"""
+		Start offsets of every device, placing devices in order of name
+
+		Arguments:
+			None
+
+		Returns:
+			(dict) device names mapped to start offsets (s)
 		"""
-		return
 
-	def calculateOtherOffsets(self):
+		offsets = {}
+		placed = []
+		for dname in sorted(self.assaySeriesDict):
+			if not offsets:
+				offsets[dname] = self.calculateInitialOffset()
+			else:
+				offsets[dname] = self.calculateOtherOffsets(placed, dname)
+			placed += [(start + offsets[dname], end - start) 
+						for start, end in self.scanIntervals(self.timelines[dname])]
+		return offsets
+
+	def predictTimeline(self):
 		"""
-		To be implemented
+		Predicted timeline of the riffled series, with scans arbitrated earliest deadline first
+
+		Arguments:
+			None
+
+		Returns:
+			(pd.DataFrame) dname, assay, event, requested start, predicted start and end (s), 
+				and predicted lateness (s) of every event, in order of predicted start
 		"""
-		return
 
-	def startAssays(self):
+		timelines = []
+		for dname, timeline in self.timelines.items():
+			timeline = timeline.copy()
+			timeline[['start', 'end']] += self.offsets[dname]
+			timelines.append(timeline)
+		timeline = pd.concat(timelines, ignore_index = True)
+		timeline['requested_start'] = timeline['start']
+		isScan = timeline['event'].str.contains('scan')
+		scans = timeline[isScan]
+		durations = (scans['end'] - scans['start']).values
+		starts = self.arbitrate(list(zip(scans['start'], durations)))
+		timeline.loc[isScan, 'start'] = starts
+		timeline.loc[isScan, 'end'] = durations + starts
+		timeline['lateness'] = timeline['start'] - timeline['requested_start']
+		timeline = timeline.sort_values('start').reset_index(drop = True)
+		return timeline[['dname', 'assay', 'event', 'requested_start', 'start', 'end', 'lateness']]
+
+	def utilization(self, timeline = None):
 		"""
-		To be implemented
+		Predicted fraction of the riffled series during which the microscope is scanning
+
+		Arguments:
+			(pd.DataFrame) timeline: predicted timeline. Defaults to predictTimeline().
+
+		Returns:
+			(float) microscope utilization (0-1)
 		"""
 
-		imaging.hardwareBlockingFlag = True
-		imaging.hardwareState = 0
-		self.assaySchedules.resume()
-		time.sleep(0.2)
-		self.assaySchedules.resume_job('d1')
-		print('d1 jobs resumed')
-		time.sleep(0.2)
-		self.assaySchedules.resume_job('d2')
-		print('d2 jobs resumed')
-		imaging.startHardwareQueue()
-		self.assaySchedules.shutdow()
-		return
-	
+		if timeline is None:
+			timeline = self.predictTimeline()
+		scans = timeline[timeline['event'].str.contains('scan')]
+		makespan = timeline['end'].max() - timeline['start'].min()
+		return (scans['end'] - scans['start']).sum() / makespan if makespan > 0 else 0.0
 
-	def scheduleRiffle(self):
+	def plotTimeline(self, timeline = None):
 		"""
-		To be implemented
+		Plots the predicted timeline, one row per device, with scans highlighted
+
+		Arguments:
+			(pd.DataFrame) timeline: predicted timeline. Defaults to predictTimeline().
+
+		Returns:
+			None
+		"""
+
+		if pl is None:
+			raise ImportError('Plotting the timeline requires matplotlib')
+		if timeline is None:
+			timeline = self.predictTimeline()
+		dnames = sorted(self.assaySeriesDict)
+		pl.figure(figsize = (12, 1 + len(dnames)))
+		for row, dname in enumerate(dnames):
+			events = timeline[timeline['dname'] == dname]
+			for isScan, color in ((False, 'lightgray'), (True, 'tab:blue')):
+				selected = events[events['event'].str.contains('scan') == isScan]
+				pl.broken_barh(list(zip(selected['start'], selected['end'] - selected['start'])), 
+								(row - 0.4, 0.8), facecolors = color)
+		pl.yticks(range(len(dnames)), dnames)
+		pl.xlabel('Time (s)')
+		pl.title('Predicted riffle, microscope utilization {:.0%}'.format(self.utilization(timeline)))
+		pl.show()
+
+	def startAssays(self, plot = False):
+		"""
+		Logs the predicted timeline and utilization, then starts every device's series at its 
+		offset and runs the scan arbiter until all series are complete
+
+		Arguments:
+			(bool) plot: flag to plot the predicted timeline before starting
+
+		Returns:
+			(pd.DataFrame) lateness report of every scan, from the scan arbiter
 		"""
-		startAssaySeries = lambda series: series.startAssays()
 
-		backgroundConfig = {'logger': eh.scriptlogger}
-		s = BackgroundScheduler(gconfig=backgroundConfig)
-		s.start()
-		s.pause()
+		timeline = self.predictTimeline()
+		scans = timeline[timeline['event'].str.contains('scan')]
+		eh.scriptlogger.info('>> Riffled assay series, offsets (s): {}, predicted duration {:.0f} s, '
+			'microscope utilization {:.0%}, predicted scan lateness {:.0f} s'.format(self.offsets, 
+			timeline['end'].max(), self.utilization(timeline), scans['lateness'].sum()))
+		eh.scriptlogger.info('>> Predicted riffle timeline:\n{}'.format(timeline.to_string()))
+		if plot:
+			self.plotTimeline(timeline)
+
+		scanArbiter = imaging.getScanArbiter()
+		for dname in self.assaySeriesDict:
+			scanArbiter.register(dname)
+		threads = []
 		for dname, assaySeries in self.assaySeriesDict.items():
-			assayArgs = [assaySeries]
-			s.add_job(startAssaySeries, id = dname, misfire_grace_time = 100, args = assayArgs, next_run_time = None)
-		return s
+			thread = threading.Thread(target = self._startSeries, args = (assaySeries, self.offsets[dname]), 
+										name = 'AssaySeries-{}'.format(dname))
+			thread.daemon = True
+			thread.start()
+			threads.append(thread)
+		try:
+			report = scanArbiter.run()
+			for thread in threads:
+				thread.join()
+		finally:
+			imaging.resetScanArbiter()
+		eh.scriptlogger.info('>> Riffled assay series complete, scan lateness mean {:.1f} s, max {:.1f} s'.format(
+			report['lateness_s'].mean(), report['lateness_s'].max()))
+		return report
+
+	def _startSeries(self, assaySeries, offset):
+		try:
+			clock.sleep(offset)
+			eh.scriptlogger.info('>> Assay series for {} started'.format(assaySeries.dname))
+			assaySeries.startAssays(scanQueueFlag = True)
+		except Exception:
+			eh.scriptlogger.exception('Assay series for {} failed'.format(assaySeries.dname))
+		finally:
+			imaging.getScanArbiter().release(assaySeries.dname)
@@ -0,0 +1,170 @@
+# title             : benchmarks.py
+# description       : Microbenchmarks for RunPack hot paths
+# authors           : Daniel Mokhtari
+# credits           :
+# date              : 20201018
+# version update    : 20201018
+# version           : 0.1.1
+# python_version    : 2.7
+
+
+import os
+import time
+import timeit
+import shutil
+import tempfile
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from runpack import storage
+from runpack.io import ValveIndex
+from runpack.positions import PositionList
+from runpack.simulation import SimulatedCore
+
+
+################################################################################
+
+
+defaultValvemap = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+								'valvemaps', '2block.csv')
+
+
+def benchmarkValveResolution(valvemapPath = defaultValvemap, reference = 'chip',
+								repeats = 2000):
+	"""Compares per-valve coil resolution cost of a valvemap DataFrame lookup
+	and the precompiled ValveIndex.
+
+	The DataFrame lookup mirrors the per-call name concatenation and column
+	match used by the acqpack Manifold.
+
+	Args:
+		valvemapPath (str): valvemap CSV path
+		reference (str): valvemap reference name
+		repeats (int): number of passes over every valve of every device
+
+	Returns:
+		dict: mean per-valve resolution time (us) for 'dataframe' and 'index',
+			and the 'speedup' of the index
+	"""
+
+	valvemap = pd.read_csv(valvemapPath, index_col = 0).fillna('')
+	index = ValveIndex.fromCsv(valvemapPath, reference)
+	devices = ['d{}'.format(dnum) for dnum in sorted(index.layerMasks)]
+	valves = index.layerValves('flow') + index.layerValves('control')
+	numValves = len(devices) * len(valves)
+
+	def dataframeLookup():
+		for device in devices:
+			for valve in valves:
+				valvemap.index[valvemap[reference] == valve+device[-1]][0]
+
+	def indexLookup():
+		for device in devices:
+			for valve in valves:
+				index.coil(device, valve)
+
+	dataframeTime = timeit.timeit(dataframeLookup, number = repeats) / (repeats * numValves)
+	indexTime = timeit.timeit(indexLookup, number = repeats) / (repeats * numValves)
+	return {'dataframe': dataframeTime * 1e6,
+			'index': indexTime * 1e6,
+			'speedup': dataframeTime / indexTime}
+
+
+def benchmarkPositionLookup(numPositions = 300, repeats = 20):
+	"""Compares the per-frame position lookup cost of a position list 
+	DataFrame and a PositionList.
+
+	Each frame reads x, y, z, and the position name, as scan and 
+	move_stage_poslist do.
+
+	Args:
+		numPositions (int): number of positions in the synthetic position list
+		repeats (int): number of passes over every position
+
+	Returns:
+		dict: mean per-frame lookup time (us) for 'dataframe' and 
+			'positionlist', and the 'speedup' of the PositionList
+	"""
+
+	xs, ys = np.meshgrid(np.arange(numPositions) * 100.0, [0.0])
+	df = pd.DataFrame({'name': ['Pos{}'.format(i) for i in range(numPositions)], 
+						'x': xs.ravel(), 'y': ys.ravel(), 
+						'z': np.zeros(numPositions)})
+	positionList = PositionList.fromDataFrame(df)
+
+	def dataframeLookup():
+		for i in range(numPositions):
+			x, y = df[['x','y']].iloc[i]
+			z = df[['z']].iloc[i]
+			name = df['name'].iloc[i]
+
+	def positionListLookup():
+		for i in range(numPositions):
+			x, y = positionList.x[i], positionList.y[i]
+			z = positionList.z[i]
+			name = positionList.names[i]
+
+	dataframeTime = timeit.timeit(dataframeLookup, number = repeats) / (repeats * numPositions)
+	positionListTime = timeit.timeit(positionListLookup, number = repeats) / (repeats * numPositions)
+	return {'dataframe': dataframeTime * 1e6,
+			'positionlist': positionListTime * 1e6,
+			'speedup': dataframeTime / positionListTime}
+
+
+def benchmarkCompression(codecs = ('none', 'deflate', 'lzw', 'zstd'), numFrames = 50, 
+							frameShape = (1024, 1024), workers = 2, mode = 'process', 
+							directory = None):
+	"""Measures write throughput and compression ratio of each TIFF codec 
+	over simulated 16-bit frames.
+
+	Frames are written through a FrameWriter as in a scan. Codecs that the 
+	installed PIL build cannot encode are skipped with a warning.
+
+	Args:
+		codecs (tuple): codecs to compare
+		numFrames (int): number of frames written per codec
+		frameShape (tuple): simulated frame shape (rows, columns)
+		workers (int): number of writer threads or processes
+		mode (str): writer pool type ('thread' | 'process')
+		directory (str): directory to write the frames in, e.g. on the 
+			acquisition disk. Defaults to a temporary directory.
+
+	Returns:
+		dict: codecs mapped to dicts of write throughput ('frames_per_s', 
+			'mb_per_s' of raw pixels), mean acquisition thread time per 
+			frame ('submit_ms'), and 'ratio' of raw to written bytes
+	"""
+
+	core = SimulatedCore(imageShape = frameShape, readoutTime = 0.0)
+	core.setProperty(core.camera, 'Exposure', 1)
+	frames = []
+	for k in range(numFrames):
+		core.snapImage()
+		frames.append(core.getImage())
+	rawBytes = sum(frame.nbytes for frame in frames)
+
+	results = {}
+	for codec in codecs:
+		if not storage.codecAvailable(codec):
+			warnings.warn('TIFF codec {} is not supported by this PIL build, skipping'.format(codec))
+			continue
+		outDir = tempfile.mkdtemp(dir = directory)
+		writer = storage.FrameWriter(workers, numFrames, mode, compression = codec)
+		try:
+			start = time.time()
+			for k, frame in enumerate(frames):
+				writer.submit(frame, os.path.join(outDir, 'frame{:04d}.tif'.format(k)), {})
+			submitted = time.time()
+			writer.flush()
+			elapsed = time.time() - start
+			writtenBytes = sum(os.path.getsize(os.path.join(outDir, f)) for f in os.listdir(outDir))
+		finally:
+			writer.close()
+			shutil.rmtree(outDir)
+		results[codec] = {'frames_per_s': numFrames / elapsed, 
+							'mb_per_s': rawBytes / elapsed / 1e6, 
+							'submit_ms': (submitted - start) / numFrames * 1e3, 
+							'ratio': float(rawBytes) / writtenBytes}
+	return results
@@ -0,0 +1,242 @@
+# title             : catalog.py
+# description       : Indexed SQLite catalog of acquired frames
+# authors           : Daniel Mokhtari
+# credits           :
+# date              : 20201018
+# version update    : 20201018
+# version           : 0.1.1
+# python_version    : 2.7
+
+
+import os
+import sqlite3
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+from runpack import records
+
+
+################################################################################
+
+
+def _sqlType(dtype):
+	dtype = np.dtype(dtype)
+	if dtype == np.dtype(np.float64):
+		return 'REAL'
+	if dtype in (np.dtype(np.int64), np.dtype(np.bool_)):
+		return 'INTEGER'
+	return 'TEXT'
+
+
+def _value(v):
+	return v.item() if isinstance(v, np.generic) else v
+
+
+def _filter(table, filters):
+	clauses, params = [], []
+	for column, value in filters:
+		if value is None:
+			continue
+		if isinstance(value, (list, tuple, set)):
+			value = list(value)
+			clauses.append('{}.{} IN ({})'.format(table, column, ', '.join('?' * len(value))))
+			params.extend(value)
+		else:
+			clauses.append('{}.{} = ?'.format(table, column))
+			params.append(value)
+	return clauses, params
+
+
+
+class ImagingCatalog:
+	indexed = ('dname', 'channel', 'raster_start_time', 'raster_index', 'scan_id')
+
+	def __init__(self, path, columns = records.imagingColumns):
+		"""Embedded SQLite catalog of acquired frames
+
+		Each scan is written as one transaction: a row in the scans table
+		and one row per frame in the frames table. Frames are indexed by
+		dname, channel, raster_start_time, raster_index, and scan. Queries
+		run in SQLite and return only matching frames. The database file is
+		created on the first write. A connection is opened per call, so the
+		catalog can be shared between acquisition threads.
+
+		Args:
+			path (str): SQLite database path
+			columns (list): (name, dtype) frame column specification
+
+		Returns:
+			None
+		"""
+		self.path = path
+		self.columns = list(columns)
+		self.initialized = False
+
+
+	@contextlib.contextmanager
+	def _connect(self):
+		connection = sqlite3.connect(self.path, timeout = 30)
+		try:
+			yield connection
+		finally:
+			connection.close()
+
+
+	def _initialize(self, connection):
+		frameColumns = ', '.join('{} {}'.format(name, _sqlType(dtype)) for name, dtype in self.columns)
+		connection.execute('CREATE TABLE IF NOT EXISTS scans (scan_id INTEGER PRIMARY KEY, '
+							'raster_start_time TEXT, dname TEXT, note TEXT, '
+							'scan_params TEXT, frames INTEGER)')
+		connection.execute('CREATE TABLE IF NOT EXISTS frames (frame_id INTEGER PRIMARY KEY, '
+							'scan_id INTEGER REFERENCES scans(scan_id), {})'.format(frameColumns))
+		for column in self.indexed:
+			connection.execute('CREATE INDEX IF NOT EXISTS frames_{0} ON frames ({0})'.format(column))
+		connection.execute('CREATE INDEX IF NOT EXISTS scans_dname_note ON scans (dname, note)')
+		self.initialized = True
+
+
+	def _addColumns(self, connection, names):
+		existing = set(row[1] for row in connection.execute('PRAGMA table_info(frames)'))
+		for name in names:
+			if name not in existing:
+				connection.execute('ALTER TABLE frames ADD COLUMN {} TEXT'.format(name))
+
+
+	def addScan(self, record):
+		"""Adds the frames of a scan in a single transaction
+
+		Args:
+			record (pd.DataFrame): per-frame scan record, as returned by scan
+
+		Returns:
+			int: scan ID
+		"""
+		names = [str(c) for c in record.columns]
+		values = [record[c].astype(object).where(record[c].notnull(), None).tolist() for c in record.columns]
+		rows = [tuple(_value(v) for v in row) for row in zip(*values)]
+		first = dict(zip(names, rows[0])) if rows else {}
+		scanValues = [first.get(c) for c in ('raster_start_time', 'dname', 'note', 'scan_params')]
+
+		with self._connect() as connection:
+			with connection:
+				if not self.initialized:
+					self._initialize(connection)
+				self._addColumns(connection, names)
+				cursor = connection.execute('INSERT INTO scans (raster_start_time, dname, note, scan_params, frames) '
+											'VALUES (?, ?, ?, ?, ?)', scanValues + [len(rows)])
+				scanID = cursor.lastrowid
+				connection.executemany('INSERT INTO frames (scan_id, {}) VALUES (?, {})'.format(
+										', '.join(names), ', '.join('?' * len(names))),
+										[(scanID,) + row for row in rows])
+		return scanID
+
+
+	def _query(self, columns, dname, channel, raster_start_time, raster_index, note, timepoint):
+		clauses, params = _filter('frames', (('dname', dname), ('channel', channel), ('note', note),
+											('raster_start_time', raster_start_time),
+											('raster_index', raster_index)))
+		if timepoint is not None:
+			scanIDs = self._timepointScans(dname, note, timepoint)
+			clauses.append('frames.scan_id IN ({})'.format(', '.join('?' * len(scanIDs))))
+			params.extend(scanIDs)
+		selected = '*' if columns is None else ', '.join(columns)
+		where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+		return 'SELECT {} FROM frames{} ORDER BY frame_id'.format(selected, where), params
+
+
+	def _timepointScans(self, dname, note, timepoint):
+		scans = self.scans(dname = dname, note = note)
+		if not len(scans):
+			raise IndexError('Timepoint {} out of range: no scans of dname {} and note {}'.format(
+								timepoint, dname, note))
+		scanIDs = []
+		for (scanDname, scanNote), group in scans.groupby(['dname', 'note'], sort = False):
+			if not -len(group) <= timepoint < len(group):
+				raise IndexError('Timepoint {} out of range: {} scans of dname {} and note {}'.format(
+									timepoint, len(group), scanDname, scanNote))
+			scanIDs.append(int(group['scan_id'].iloc[timepoint]))
+		return scanIDs
+
+
+	def frames(self, dname = None, channel = None, raster_start_time = None, raster_index = None,
+				note = None, timepoint = None, columns = None):
+		"""Returns the frames matching all given filters
+
+		Filters may be single values or lists of values.
+
+		Args:
+			dname (str): device name ('d1' | 'd2' | 'd3')
+			channel (str): channel
+			raster_start_time (str): scan start time (YYYYmmdd-HHMMSS)
+			raster_index (int): position list index
+			note (str): scan note
+			timepoint (int): index of the scan among the scans of the given
+				dname and note, in acquisition order (e.g. 2 for the third
+				kinetic timepoint). With several dnames or notes, selects
+				that scan of each dname and note. Raises IndexError if out
+				of range.
+			columns (list): columns to return. Defaults to all.
+
+		Returns:
+			pd.DataFrame: matching frames
+		"""
+		if not os.path.isfile(self.path):
+			return pd.DataFrame(columns = columns)
+		query, params = self._query(columns, dname, channel, raster_start_time, raster_index, note, timepoint)
+		with self._connect() as connection:
+			return pd.read_sql_query(query, connection, params = params)
+
+
+	def iterFrames(self, dname = None, channel = None, raster_start_time = None, raster_index = None,
+					note = None, timepoint = None, columns = None):
+		"""Iterates over the frames matching all given filters, one at a time
+
+		Args:
+			See frames()
+
+		Returns:
+			generator: dicts of frame column values
+		"""
+		if not os.path.isfile(self.path):
+			return
+		query, params = self._query(columns, dname, channel, raster_start_time, raster_index, note, timepoint)
+		with self._connect() as connection:
+			cursor = connection.execute(query, params)
+			names = [d[0] for d in cursor.description]
+			for row in cursor:
+				yield dict(zip(names, row))
+
+
+	def paths(self, dname = None, channel = None, raster_start_time = None, raster_index = None,
+				note = None, timepoint = None):
+		"""Returns the image paths of the frames matching all given filters
+
+		Args:
+			See frames()
+
+		Returns:
+			list: image paths
+		"""
+		return [frame['image_path'] for frame in self.iterFrames(dname, channel, raster_start_time,
+					raster_index, note, timepoint, columns = ['image_path'])]
+
+
+	def scans(self, dname = None, note = None):
+		"""Returns the cataloged scans in acquisition order
+
+		Args:
+			dname (str | list): device name filter
+			note (str | list): scan note filter
+
+		Returns:
+			pd.DataFrame: scan ID, start time, dname, note, scan parameters,
+				and frame count of each scan
+		"""
+		if not os.path.isfile(self.path):
+			return pd.DataFrame(columns = ['scan_id', 'raster_start_time', 'dname', 'note', 'scan_params', 'frames'])
+		clauses, params = _filter('scans', (('dname', dname), ('note', note)))
+		where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+		with self._connect() as connection:
+			return pd.read_sql_query('SELECT * FROM scans{} ORDER BY scan_id'.format(where), connection, params = params)
@@ -0,0 +1,240 @@
+# title             : clock.py
+# description       : Swappable real and virtual clocks for RunPack protocols
+# authors           : Daniel Mokhtari
+# credits           :
+# date              : 20201018
+# version update    : 20201018
+# version           : 0.1.1
+# python_version    : 2.7
+
+
+import sys
+import time
+import warnings
+import threading
+
+
+################################################################################
+
+
+class RealClock:
+	"""Wall clock. Sleeps block for their full duration."""
+
+	def time(self):
+		return time.time()
+
+
+	def monotonic(self):
+		return _monotonic()
+
+
+	def sleep(self, seconds):
+		if seconds > 0:
+			time.sleep(seconds)
+
+
+
+class VirtualClock:
+	def __init__(self, start = None):
+		"""Simulated clock whose sleeps advance virtual time instantly
+
+		Suited to single-threaded runs (e.g. a protocol or AssaySeries)
+		against simulated hardware. Threads sharing a VirtualClock each
+		advance it by their own sleeps, so use an AcceleratedClock for
+		concurrent runs.
+
+		Args:
+			start (float): initial virtual epoch time (s). Defaults to now.
+
+		Returns:
+			None
+		"""
+		self.start = time.time() if start is None else start
+		self.now = self.start
+		self.lock = threading.Lock()
+
+
+	def time(self):
+		return self.now
+
+
+	def monotonic(self):
+		return self.now - self.start
+
+
+	def sleep(self, seconds):
+		if seconds > 0:
+			with self.lock:
+				self.now += seconds
+
+
+	def elapsed(self):
+		"""Returns virtual time elapsed since the clock started (s)"""
+		return self.now - self.start
+
+
+
+class AcceleratedClock:
+	def __init__(self, factor):
+		"""Real clock running factor times faster than the wall clock
+
+		Sleeps block for 1/factor of their duration, so concurrent threads
+		keep their relative timing.
+
+		Args:
+			factor (float): time compression factor (e.g. 100)
+
+		Returns:
+			None
+		"""
+		self.factor = float(factor)
+		self.realStart = _monotonic()
+		self.start = time.time()
+
+
+	def time(self):
+		return self.start + self.monotonic()
+
+
+	def monotonic(self):
+		return (_monotonic() - self.realStart) * self.factor
+
+
+	def sleep(self, seconds):
+		if seconds > 0:
+			time.sleep(seconds / self.factor)
+
+
+	def elapsed(self):
+		"""Returns accelerated time elapsed since the clock started (s)"""
+		return self.monotonic()
+
+
+
+def _posixMonotonic():
+	import ctypes
+	import ctypes.util
+
+	class timespec(ctypes.Structure):
+		_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+	libraries = [ctypes.util.find_library('rt'), ctypes.util.find_library('c'), None]
+	for library in libraries:
+		try:
+			clockGettime = ctypes.CDLL(library, use_errno = True).clock_gettime
+			break
+		except (OSError, AttributeError):
+			continue
+	else:
+		return None
+	clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+	clockID = 6 if sys.platform == 'darwin' else 1 # CLOCK_MONOTONIC
+	value = timespec()
+
+	def monotonic():
+		if clockGettime(clockID, ctypes.byref(value)) != 0:
+			raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+		return value.tv_sec + value.tv_nsec * 1e-9
+	try:
+		monotonic()
+	except OSError:
+		return None
+	return monotonic
+
+
+def _monotonicSource():
+	"""Returns a high-resolution monotonic counter function (s)
+
+	Uses time.perf_counter where available (Python 3), time.clock on 
+	Windows (QueryPerformanceCounter), and clock_gettime(CLOCK_MONOTONIC) 
+	on POSIX. Falls back to time.time, which can jump with system clock 
+	changes, with a warning.
+
+	Args:
+		None
+
+	Returns:
+		callable: counter function
+	"""
+	if hasattr(time, 'perf_counter'):
+		return time.perf_counter
+	if sys.platform == 'win32':
+		return time.clock
+	source = _posixMonotonic()
+	if source is None:
+		warnings.warn('No monotonic clock available, timing with time.time')
+		return time.time
+	return source
+
+
+_monotonic = _monotonicSource()
+
+
+activeClock = RealClock()
+
+
+def setClock(clock):
+	"""Sets the clock used by protocols, assays, and acquisition scheduling
+
+	Args:
+		clock (RealClock | VirtualClock | AcceleratedClock): clock to use
+
+	Returns:
+		None
+	"""
+	global activeClock
+	activeClock = clock
+
+
+def getClock():
+	"""Returns the active clock"""
+	return activeClock
+
+
+def now():
+	"""Returns the active clock's epoch time (s)"""
+	return activeClock.time()
+
+
+def monotonic():
+	"""Returns the active clock's monotonic time (s), for measuring intervals"""
+	return activeClock.monotonic()
+
+
+def counter():
+	"""Returns a real high-resolution monotonic counter (s), whatever the 
+	active clock, for timeouts and timing of real hardware"""
+	return _monotonic()
+
+
+def sleep(seconds):
+	"""Sleeps for the given number of seconds on the active clock"""
+	activeClock.sleep(seconds)
+
+
+def localtime():
+	"""Returns the active clock's time as a local time struct"""
+	return time.localtime(activeClock.time())
+
+
+def estimateDuration(func, *args, **kwargs):
+	"""Runs a function on a VirtualClock and returns its virtual duration
+
+	Use with simulated hardware: the function runs in full, only its sleeps
+	are skipped. The previously active clock is restored afterwards.
+
+	Args:
+		func (callable): protocol, assay, or acquisition to run
+		*args, **kwargs: arguments passed to func
+
+	Returns:
+		float: virtual time elapsed while running func (s)
+	"""
+	previous = getClock()
+	virtual = VirtualClock()
+	setClock(virtual)
+	try:
+		func(*args, **kwargs)
+	finally:
+		setClock(previous)
+	return virtual.elapsed()
@@ -10,15 +10,33 @@
 
 
 import os
+import json
 import time
 import datetime
+import functools
+import warnings
 import numpy as np
 import pandas as pd
-from PIL import Image
-from Queue import Queue
-import matplotlib.pyplot as pl
 
-from acqpack import gui
+try:
+	import matplotlib.pyplot as pl
+except ImportError:
+	pl = None # required to show images only
+
+try:
+	from acqpack import gui
+except ImportError:
+	gui = None
+
+from runpack import clock
+from runpack import acquisition
+from runpack import arbiter
+from runpack import pathplanning
+from runpack import positions
+from runpack import profiling
+from runpack import records
+from runpack import storage
+from runpack import stacks
 from runpack.io import HardwareInterface as hi
 from runpack.io import ExperimentalHarness as eh
 
@@ -26,9 +44,9 @@ from runpack.io import ExperimentalHarness as eh
 ################################################################################
 
 
-hardwareQueue = Queue()
-hardwareBlockingFlag = True
-hardwareState = 0 #State: 0 = Resting, 1 = One Queue Complete, 2 = Both Complete
+scanArbiter = None #shared multi-device scan arbiter
+frameWriter = None #shared background frame writer
+
 
 def snap(show = True, vmin = 0, vmax = 65535, figsize = (4, 4)):
 	"""Snaps an image and returns the resulting image array.
@@ -46,9 +64,11 @@ def snap(show = True, vmin = 0, vmax = 65535, figsize = (4, 4)):
 	hi.core.snapImage()
 	imgArr = hi.core.getImage()
 	if show:
+		if pl is None:
+			raise ImportError('Showing images requires matplotlib')
 		pl.figure(figsize = figsize)
 		pl.imshow(imgArr, cmap='gray', vmin = vmin, vmax = vmax)
-		pl.title('Snapped Imaged, {}'.format(time.strftime("%Y%m%d-%H%M%S", time.localtime())))
+		pl.title('Snapped Imaged, {}'.format(time.strftime("%Y%m%d-%H%M%S", clock.localtime())))
 		pl.axis('off')
 		pl.show()
 	return imgArr
@@ -66,23 +86,89 @@ def live():
 		None
 	"""
 
+	if gui is None:
+		raise ImportError('Live video requires acqpack')
 	gui.video(hi.core, loop_pause=0.05)
 
 
-def startHardwareQueue():
-	"""Start the hardware job queue
+def getScanArbiter():
+	"""Returns the shared scan arbiter, creating it if needed.
+
+	Devices imaging concurrently submit their scans to the arbiter, which 
+	runs them on the microscope earliest deadline first. Scans of the 
+	same device, channels, and position count share measured durations. 
+	Unmeasured scans are predicted from the imaging cost model.
 
 	Args:
 		None
 
+	Returns:
+		arbiter.ScanArbiter: the shared scan arbiter
+	"""
+
+	global scanArbiter
+	if scanArbiter is None:
+		predictDuration = lambda args, kwargs: predict_scan_duration(args[1], args[4], 
+			homeStage = kwargs.get('homeStage', True))
+		durationKey = lambda args, kwargs: (args[2], json.dumps(args[1], sort_keys = True), len(args[4]))
+		scanArbiter = arbiter.ScanArbiter(scan, predictDuration, durationKey, halt = hi.haltEvent)
+	return scanArbiter
+
+
+def resetScanArbiter(cancel = False):
+	"""Shuts down the shared scan arbiter and discards it, so that the next 
+	getScanArbiter() call creates a new one.
+
+	Args:
+		cancel (bool): flag to cancel scans still pending
+
 	Returns:
 		None
 	"""
 
-	eh.acquilogger.info('HardwareQueue Started')
-	while hardwareState < 2:
-		args, kwargs = hardwareQueue.get(block = hardwareBlockingFlag)
-		scan(*args, **kwargs)
+	global scanArbiter
+	if scanArbiter is not None:
+		scanArbiter.shutdown(cancel)
+		scanArbiter = None
+
+
+def getFrameWriter():
+	"""Returns the shared background frame writer, creating it if needed.
+
+	The writer pool is configured by the optional 'imaging' software config 
+	keys 'writer_workers', 'writer_queue', 'writer_mode', 'writer_timeout', 
+	and 'compression'. With the 'spool' imaging config set, frames are 
+	spooled to a memory-mapped file in <root>/spool and converted in the 
+	background (see storage.FrameSpool). Spools left by a crash are 
+	replayed first.
+
+	Args:
+		None
+
+	Returns:
+		storage.FrameWriter | storage.FrameSpool: the shared frame writer
+	"""
+
+	global frameWriter
+	if frameWriter is None:
+		settings = (eh.config or {}).get('imaging', {})
+		compression = settings.get('compression', 'none')
+		if settings.get('spool', False):
+			spoolDir = os.path.join(eh.rootPath, 'spool')
+			for spoolPath in storage.pendingSpools(spoolDir):
+				recovered = storage.replaySpool(spoolPath, compression = compression)
+				eh.acquilogger.info('Recovered {} frames from spool {}'.format(recovered, spoolPath))
+			spoolName = 'frames-{}'.format(time.strftime("%Y%m%d-%H%M%S", clock.localtime()))
+			frameWriter = storage.FrameSpool(os.path.join(spoolDir, spoolName), 
+												workers = settings.get('writer_workers', 2), 
+												compression = compression)
+		else:
+			frameWriter = storage.FrameWriter(workers = settings.get('writer_workers', 2), 
+												maxQueued = settings.get('writer_queue', 16), 
+												mode = settings.get('writer_mode', 'thread'), 
+												compression = compression, 
+												writeTimeout = settings.get('writer_timeout', 60.0))
+	return frameWriter
 
 
 def get_stage_position():
@@ -114,11 +200,12 @@ def move_stage_custom(x, y, z):
 def move_stage_poslist(position_list, poslistIndex, zControl = True):
 	"""Move the xy(z) stage to cooredinates specified by the ith
 	entry in the position list. It is likely that you want to position list
-	in sorted order. 
+	in sorted order (see ExperimentalHarness.optimizePositionList). 
 	
 	Args:
-		position_list (pd.DataFrame): stage xy(z) position list. z position 
-			is not required. The default behavior is to move to z if present 
+		position_list (PositionList | pd.DataFrame): stage xy(z) position 
+			list. z position is not required. The default behavior is to 
+			move to z if present 
 		poslistIndex (int): row index of position list to move to
 		zControl (bool): flag to move to home z position or retain current z
 
@@ -126,21 +213,80 @@ def move_stage_poslist(position_list, poslistIndex, zControl = True):
 		None
 	"""
 
+	profiler = profiling.active
+	if isinstance(position_list, positions.PositionList):
+		started = profiler.start()
+		hi.core.setXYPosition(position_list.x[poslistIndex], position_list.y[poslistIndex])
+		hi.core.waitForDevice(hi.core.getXYStageDevice())
+		profiler.stop('xy_move', started)
+
+		if (position_list.z is not None) and zControl:
+			started = profiler.start()
+			hi.core.setPosition(hi.core.getFocusDevice(), position_list.z[poslistIndex])
+			hi.core.waitForDevice(hi.core.getFocusDevice())
+			profiler.stop('z_move', started)
+		return
+
 	x,y = position_list[['x','y']].iloc[poslistIndex]
+	started = profiler.start()
 	hi.core.setXYPosition(x,y)
 	hi.core.waitForDevice(hi.core.getXYStageDevice())
+	profiler.stop('xy_move', started)
 	
 	if ('z' in position_list.columns) and zControl:
 		z = position_list[['z']].iloc[poslistIndex]
+		started = profiler.start()
 		hi.core.setPosition(hi.core.getFocusDevice(), z)
 		hi.core.waitForDevice(hi.core.getFocusDevice())
+		profiler.stop('z_move', started)
+
+
+def start_stage_move(position_list, poslistIndex, zControl = True):
+	"""Issues the xy and z moves to the ith entry in the position list 
+	together, without waiting for either to finish (see wait_for_stage)
+
+	Args:
+		position_list (PositionList): stage xy(z) position list
+		poslistIndex (int): row index of position list to move to
+		zControl (bool): flag to move to home z position or retain current z
+
+	Returns:
+		None
+	"""
+
+	hi.core.setXYPosition(position_list.x[poslistIndex], position_list.y[poslistIndex])
+	if (position_list.z is not None) and zControl:
+		hi.core.setPosition(hi.core.getFocusDevice(), position_list.z[poslistIndex])
+
+
+def wait_for_stage(position_list, zControl = True):
+	"""Waits for xy and z moves issued by start_stage_move to finish. 
+	When profiled, the move phases are the remaining wait of each move.
+
+	Args:
+		position_list (PositionList): stage xy(z) position list
+		zControl (bool): flag for whether z moves were issued
+
+	Returns:
+		None
+	"""
+
+	profiler = profiling.active
+	started = profiler.start()
+	hi.core.waitForDevice(hi.core.getXYStageDevice())
+	profiler.stop('xy_move', started)
+	if (position_list.z is not None) and zControl:
+		started = profiler.start()
+		hi.core.waitForDevice(hi.core.getFocusDevice())
+		profiler.stop('z_move', started)
 
 
 def home_stage(position_list, zControl = True):
 	"""Brings the stage to its initial pinlist position
 
 	Args:
-		position_list (pd.DataFrame): xy-stage or xyz-stage position list
+		position_list (PositionList | pd.DataFrame): xy-stage or xyz-stage 
+			position list
 		zControl (bool): flag to move to home z position or retain current z
 
 	Returns:
@@ -152,11 +298,16 @@ def home_stage(position_list, zControl = True):
 
 def scan(data_dir, channelsExposures, dname, note, position_list, 
 			wrappingFolder = False, write_imaging_record = True, 
-			return_imaging_record = False, zControl = True):
+			return_imaging_record = False, zControl = True, writer = None, 
+			reverse = False, homeStage = True, order = None, pipelined = None, 
+			acquisitionMode = None, storage = None, stack = None, timepoint = 0, 
+			schedule = None, profile = None):
 	"""Rastered image acquisition. 
 	
 	Acquires images in a raster patern and saves the results.
-	Writes metadata to the acquired images.
+	Writes metadata to the acquired images. Frames are encoded and written 
+	by a background writer; the scan waits for all of its frames to be 
+	written before it returns or writes the imaging record.
 	
 	Args:
 		data_dir (str): root directory of image acquisitions
@@ -164,10 +315,48 @@ def scan(data_dir, channelsExposures, dname, note, position_list,
 			(e.g., {'2bf':[50, 500], '1pbp':[100, 200]})
 		dname (str): device name ('d1' | 'd2' |'d3')
 		note (str): Scan note, to be used in the image filename
-		position_list (pd.DataFrame): stage xy(z) position list
+		position_list (PositionList | pd.DataFrame): stage xy(z) position list
 		wrappingFolder (bool): flag to wrap acquistions inside another 
 			directory of name notes
 		zControl (bool): flag to move to home z position or retain current z
+		writer (storage.FrameWriter): frame writer. Defaults to the shared 
+			writer from getFrameWriter().
+		reverse (bool): flag to visit the position list last to first
+		homeStage (bool): flag to return the stage to the first position of 
+			the position list after the scan
+		order (str): acquisition order. 'position' images every channel at 
+			each position; 'channel' images every position in each channel; 
+			'hybrid' does the same within blocks of positions; 'auto' picks 
+			the order with the lowest predicted duration (see 
+			pathplanning.ScanCostModel). Defaults to the 'scan_order' imaging 
+			config, else 'position'.
+		pipelined (bool): flag to issue each stage move (xy and z together) 
+			as soon as the last exposure at a position is snapped, 
+			overlapping the move with image transfer and writing. Defaults 
+			to the 'pipelined' imaging config, else False.
+		acquisitionMode (str): frame acquisition mode. 'snap' snaps every 
+			frame; 'sequence' acquires repeated exposures as camera 
+			sequences, falling back to snaps when unsupported (see 
+			acquisition.AcquisitionEngine). Defaults to the 
+			'acquisition_mode' imaging config, else 'snap'.
+		storage (str): image storage. 'files' writes one TIFF per frame; 
+			'zarr' and 'ome-tiff' write the scan to a single stack (see 
+			stacks.FrameStack). Defaults to the 'storage_backend' imaging 
+			config, else 'files'. Ignored if a stack is given.
+		stack (stacks.FrameStack): stack to write the frames to (e.g. the 
+			stack of a kinetic acquisition). The scan finishes its timepoint 
+			of the stack.
+		timepoint (int): timepoint index of the scan (e.g. in a stack or 
+			kinetic acquisition)
+		schedule (tuple): (reference time, requested start (s)) of a 
+			scheduled scan, on the runpack monotonic clock. The requested 
+			and actual start (s after the reference time) and their 
+			difference (jitter) are recorded in the imaging record.
+		profile (bool): flag to time every phase of the scan (stage moves, 
+			channel switches, exposure sets, snaps, image transfers, and 
+			frame writing) and write a per-phase summary (mean, p95, max) 
+			to <data_dir>/<start time>_<note>_profile.json. Defaults to the 
+			'profile' imaging config, else False.
 		
 	Returns:
 		(pd.DataFrame | None): Pandas dataframe with a summary of the image raster
@@ -182,96 +371,413 @@ def scan(data_dir, channelsExposures, dname, note, position_list,
 	eh.acquilogger.info(startMessage)
 	
 	if wrappingFolder:
-		timeString = time.strftime("%Y%m%d-%H%M%S", time.localtime())
+		timeString = time.strftime("%Y%m%d-%H%M%S", clock.localtime())
 		scanfolder = (os.path.join(data_dir, '{}-{}_{}'.format(timeString, dname, note.replace(' ', '_'))))
 		data_dir = scanfolder
 		makeDir(scanfolder)
 
+	settings = (eh.config or {}).get('imaging', {})
+	if storage is None:
+		storage = settings.get('storage_backend', 'files')
+	ownStack = stack is None and storage != 'files'
+
 	scanDirs = {}
 
-	startTime = time.strftime("%Y%m%d-%H%M%S", time.localtime())
+	startTime = time.strftime("%Y%m%d-%H%M%S", clock.localtime())
 	for channel in channelsExposures.keys():
 		scan_dir = '{}_{}_{}'.format(startTime, note.replace(' ', '_'), channel)
 		scanDirs[channel] = scan_dir
-		outDir = os.path.join(data_dir, channel, scan_dir)
-		makeDir(outDir)
+		if stack is None and not ownStack:
+			makeDir(os.path.join(data_dir, channel, scan_dir))
 	
-	if hi.temp:
+	if hi.environment is not None:
+		temp, hum = hi.environment.latest() # cached; frames get the nearest reading
+	elif hi.temp:
 	   temp = hi.temp.getProbeTemp() # Get temperature for metadata
 	   hum = hi.temp.getHumidity() # Get humidity for metadata
 	else:
 		temp = 999.9
 		hum = 999.9
 
-	scanRecord = []
-	for i in xrange(len(position_list)):
-		move_stage_poslist(position_list, i, zControl)
-		x,y = position_list[['x','y']].iloc[i]
-
-		for channel in channelsExposures.keys():
-			hi.core.setConfig('Channel', channel)
-			hi.core.waitForSystem()
-			timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime())
-			for exposure in channelsExposures[channel]:
-				hi.core.setProperty(hi.core.getCameraDevice(), 'Exposure', exposure)
-				hi.core.waitForDevice(hi.core.getCameraDevice())
-				hi.core.snapImage()
-				img = hi.core.getImage()
-				image = Image.fromarray(img)
-				timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime())
-				positionname = position_list['name'].iloc[i]
-				
-				outPath = os.path.join(data_dir, channel, scanDirs[channel])
-				frameName = '{}/{}_{}.tif'.format(outPath, positionname, exposure)
-				imagePath = os.path.join(outPath, frameName)
+	if writer is None:
+		writer = getFrameWriter()
+
+	position_list = positions.asPositionList(position_list)
+	visitOrder = xrange(len(position_list))
+	if reverse:
+		visitOrder = reversed(visitOrder)
+
+	if order is None:
+		order = settings.get('scan_order', 'position')
+	costModel = pathplanning.ScanCostModel.fromConfig(settings)
+	steps, scanOrder, predictedDuration = pathplanning.planScanOrder(position_list.xy, visitOrder, 
+		channelsExposures, costModel, order = order, homeStage = homeStage)
+	eh.acquilogger.info('Scan order {}, predicted duration {:.1f} s'.format(scanOrder, predictedDuration))
+
+	if pipelined is None:
+		pipelined = settings.get('pipelined', False)
+	if acquisitionMode is None:
+		acquisitionMode = settings.get('acquisition_mode', 'snap')
+	engine = acquisition.AcquisitionEngine(hi.core, acquisitionMode, halt = hi.haltEvent)
+
+	if profile is None:
+		profile = settings.get('profile', False)
+	profiler = profiling.ScanProfiler() if profile else profiling.nullProfiler
+
+	if ownStack:
+		stackPath = os.path.join(data_dir, '{}_{}'.format(startTime, note.replace(' ', '_')))
+		stack = open_stack(storage, stackPath, 1, channelsExposures, position_list)
+	profiling.activate(profiler)
+	try:
+		scanStart = clock.monotonic()
+		numFrames = sum(len(channelsExposures[channel]) for i, channel in steps)
+		scanRecord = records.RecordBuilder(records.imagingColumns, capacity = numFrames)
+		scanRecord.setConstants(raster_start_time = startTime, 
+								scan_params = json.dumps(channelsExposures, sort_keys = True), 
+								dname = dname, note = note, setup = hi.setup, 
+								experimental_desc = eh.experimentalDescription, 
+								scan_order = scanOrder, pipelined = pipelined, 
+								acquisition_mode = engine.mode, timepoint = timepoint)
+		if schedule is not None:
+			referenceTime, requestedStart = schedule
+			actualStart = scanStart - referenceTime
+			scanRecord.setConstants(requested_start_s = requestedStart, actual_start_s = actualStart, 
+									start_jitter_s = actualStart - requestedStart)
+			eh.acquilogger.info('Timepoint {} started {:.2f} s after its requested start'.format(
+				timepoint, actualStart - requestedStart))
+		currentPosition, currentChannel, movingTo = None, None, None
+		frameTimeTotals = np.zeros(4) # stage wait, channel wait, snap, readout
+		for k, (i, channel) in enumerate(steps):
+			stageStart = clock.monotonic()
+			if i != currentPosition:
+				if not pipelined:
+					move_stage_poslist(position_list, i, zControl)
+				else:
+					if movingTo != i:
+						start_stage_move(position_list, i, zControl)
+					wait_for_stage(position_list, zControl)
+					movingTo = None
+				x, y = position_list.x[i], position_list.y[i]
+				positionname = position_list.names[i]
+				currentPosition = i
+
+			channelStart = clock.monotonic()
+			if channel != currentChannel:
+				hi.core.setConfig('Channel', channel)
+				hi.core.waitForSystem()
+				currentChannel = channel
+				profiler.stop('channel_switch', channelStart)
+			stageWait = channelStart - stageStart
+			channelWait = clock.monotonic() - channelStart
+
+			if k + 1 < len(steps):
+				nextPosition = steps[k + 1][0]
+			else:
+				nextPosition = 0 if homeStage else None
+			if hi.haltEvent.is_set():
+				raise RuntimeError('Scan of {} halted by emergency stop'.format(dname))
+			afterLastExposure = None
+			if pipelined and nextPosition not in (None, i):
+				afterLastExposure = functools.partial(start_stage_move, position_list, nextPosition, zControl)
+				movingTo = nextPosition
+			timestamp = time.strftime("%Y%m%d-%H%M%S", clock.localtime())
+			frames = engine.acquire(channelsExposures[channel], afterLastExposure)
+			for e, (exposure, img, snapTime, readoutTime) in enumerate(frames):
+				submitStart = clock.monotonic()
+				timestamp = time.strftime("%Y%m%d-%H%M%S", clock.localtime())
+			
+				if stack is None:
+					outPath = os.path.join(data_dir, channel, scanDirs[channel])
+					frameName = '{}/{}_{}.tif'.format(outPath, positionname, exposure)
+					imagePath = os.path.join(outPath, frameName)
+				else:
+					stackIndex = stack.index(timepoint, channel, e, i)
+					imagePath = stack.framePath(stackIndex)
 
 				summary = 'Device: {}, Note: {}, ExpDescription: {}'.format('Setup 3', note, eh.experimentalDescription)
 				frameInfo = '{{Channel: {}, Index:{}, Pos:({},{})}}'.format(channel, i, x, y)
-				frameTime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-				recordLabels = ['raster_start_time', 'scan_params', 'channel', 
-								'exposure_ms', 'image_path', 'raster_index',
-								'x', 'y', 'dname', 'frame_time', 'temperature', 
-								'humidity', 'note','setup', 'experimental_desc']
-				recordFeatures = [startTime, channelsExposures, channel, exposure, 
-									imagePath, i, x, y, dname, frameTime, temp, 
-									hum, note, hi.setup, 
-									eh.experimentalDescription]
-				scanRecord.append(dict(zip(recordLabels, recordFeatures)))
-				
+				frameTimestamp = clock.now()
+				frameTime = datetime.datetime.fromtimestamp(frameTimestamp).strftime("%Y-%m-%d %H:%M:%S")
+				if hi.environment is not None:
+					temp, hum = hi.environment.nearest(frameTimestamp)
+			
 				exifIDs = [37888, 37889, 33434, 37510, 270, 306]
 				exifValues = [temp, hum, exposure/1000.0, summary, frameInfo, frameTime]
 				tags = dict(zip(exifIDs, exifValues))
 
-				image.save(imagePath, tiffinfo = tags)
-
-	messageItems = str(dname), str(channelsExposures), str(note.replace(" ", "_"))
-	endMessage = 'Completed Scan of {}, channelsExposures = {}, note = {}'.format(*messageItems)
-	eh.acquilogger.info(endMessage)
-	home_stage(position_list, zControl = zControl)
-	
+				submitted = profiler.start()
+				if stack is None:
+					writer.submit(img, imagePath, tags)
+				else:
+					stack.submit(img, stackIndex, tags)
+				profiler.stop('submit', submitted)
+				readoutTime += clock.monotonic() - submitStart
+
+				firstFrame = e == 0
+				frameTimes = [stageWait * firstFrame, channelWait * firstFrame, 
+								snapTime, readoutTime]
+				frameTimeTotals += frameTimes
+				scanRecord.append(channel = channel, exposure_ms = exposure, 
+									image_path = imagePath, raster_index = i, x = x, y = y, 
+									frame_time = frameTime, temperature = temp, 
+									humidity = hum, stage_wait_s = frameTimes[0], 
+									channel_wait_s = frameTimes[1], snap_s = snapTime, 
+									readout_s = readoutTime)
+				eh.acquilogger.debug('Frame {} {} {}ms: stage wait {:.3f} s, channel wait {:.3f} s, snap {:.3f} s, readout {:.3f} s'.format(
+					positionname, channel, exposure, *frameTimes))
+
+		messageItems = str(dname), str(channelsExposures), str(note.replace(" ", "_"))
+		endMessage = 'Completed Scan of {}, channelsExposures = {}, note = {}'.format(*messageItems)
+		eh.acquilogger.info(endMessage)
+		if homeStage and movingTo is not None:
+			wait_for_stage(position_list, zControl)
+		elif homeStage:
+			home_stage(position_list, zControl = zControl)
+		if stack is not None and not ownStack:
+			stack.finishTimepoint(timepoint)
+	finally:
+		try:
+			if stack is None:
+				writer.flush()
+			elif ownStack:
+				stack.close()
+		finally:
+			profiling.deactivate()
+	scanDuration = clock.monotonic() - scanStart
+	durationItems = [scanOrder, predictedDuration, scanDuration]
+	eh.acquilogger.info('Scan order {}, predicted duration {:.1f} s, actual duration {:.1f} s'.format(*durationItems))
+	eh.acquilogger.info('Scan frame times (pipelined {}): stage wait {:.2f} s, channel wait {:.2f} s, '
+		'snap {:.2f} s, readout {:.2f} s, over {:.1f} s'.format(pipelined, *(list(frameTimeTotals) + [scanDuration])))
+	scanRecord.setConstants(predicted_duration_s = predictedDuration, 
+							scan_duration_s = scanDuration)
+	if profile:
+		profilePath = os.path.join(data_dir, '{}_{}_profile.json'.format(startTime, note.replace(' ', '_')))
+		profiler.write(profilePath, raster_start_time = startTime, dname = dname, note = note, 
+						frames = numFrames, scan_order = scanOrder, pipelined = pipelined, 
+						acquisition_mode = engine.mode, predicted_duration_s = predictedDuration, 
+						scan_duration_s = scanDuration)
+		eh.acquilogger.info('Scan profile written to {}'.format(profilePath))
 	
-	scanRecordDF = pd.DataFrame(scanRecord)
+	scanRecordDF = scanRecord.toDataFrame()
 	if write_imaging_record:
-		imageRecordsPath = os.path.join(eh.rootPath, 'imaging.csv')
-		imageRecordExists = os.path.isfile(imageRecordsPath)
-		with open(imageRecordsPath, 'a+') as ir:
-			if imageRecordExists:
-				scanRecordDF.to_csv(ir, header=False)
-			else:
-				scanRecordDF.to_csv(ir, header=True)
+		writeImagingRecord(scanRecordDF)
+		writeEnvironmentRecord()
+		if eh.imagingRecord is not None and settings.get('catalog', True):
+			eh.imagingRecord.addScan(scanRecordDF)
 
 	if return_imaging_record:
 		return scanRecordDF
 
 
+def open_stack(backend, path, timepoints, channelsExposures, position_list):
+	"""Creates an image stack sized for scans of a position list with the 
+	current camera
+
+	Args:
+		backend (str): stack format ('zarr' | 'ome-tiff')
+		path (str): stack path, without extension
+		timepoints (int): number of timepoints (scans) in the stack
+		channelsExposures (dict): channels mapped to exposure lists (ms)
+		position_list (PositionList | pd.DataFrame): stage xy(z) position list
+
+	Returns:
+		stacks.FrameStack: the stack
+	"""
+
+	settings = (eh.config or {}).get('imaging', {})
+	names = positions.asPositionList(position_list).names
+	frameShape = (hi.core.getImageHeight(), hi.core.getImageWidth())
+	dtype = {1: np.uint8, 2: np.uint16, 4: np.uint32}.get(hi.core.getBytesPerPixel(), np.uint16)
+	attrs = {'setup': hi.setup, 'experimental_desc': eh.experimentalDescription}
+	return stacks.openStack(backend, path, timepoints, channelsExposures, names, frameShape, dtype, 
+							attrs, settings.get('writer_workers', 2), settings.get('writer_queue', 16))
+
+
+def predict_scan_duration(channelsExposures, position_list, order = None, homeStage = True):
+	"""Predicts the duration of a scan from the imaging cost model
+
+	Args:
+		channelsExposures (dict): channels mapped to exposure lists (ms)
+		position_list (PositionList | pd.DataFrame): stage xy(z) position list
+		order (str): acquisition order. Defaults to the 'scan_order' 
+			imaging config, else 'position'.
+		homeStage (bool): flag to include the return to the first position
+
+	Returns:
+		float: predicted scan duration (s)
+	"""
+
+	settings = (eh.config or {}).get('imaging', {})
+	if order is None:
+		order = settings.get('scan_order', 'position')
+	xy = positions.asPositionList(position_list).xy
+	costModel = pathplanning.ScanCostModel.fromConfig(settings)
+	steps, scanOrder, predictedDuration = pathplanning.planScanOrder(xy, xrange(len(xy)), 
+		channelsExposures, costModel, order = order, homeStage = homeStage)
+	return predictedDuration
+
+
+def writeImagingRecord(record, name = 'imaging', columns = records.imagingColumns):
+	"""Appends acquisition records to an experiment record in the 
+	experimental root
+
+	The format is set by the 'record_format' imaging config: 'csv' appends 
+	to <name>.csv, 'parquet' appends a row group to the <name>.parquet 
+	dataset. Defaults to 'csv', and falls back to 'csv' with a warning if 
+	pyarrow is not installed.
+
+	Args:
+		record (pd.DataFrame): per-frame acquisition records
+		name (str): record name ('imaging' | 'bursts' | 'environment')
+		columns (list): (name, dtype) column specification of the record
+
+	Returns:
+		None
+	"""
+
+	fmt = (eh.config or {}).get('imaging', {}).get('record_format', 'csv')
+	if fmt == 'parquet' and not records.parquetAvailable():
+		warnings.warn('pyarrow is not installed, writing the {} record as CSV'.format(name))
+		fmt = 'csv'
+	records.appendRecord(record, eh.rootPath, name, fmt, columns)
+
+
+def writeEnvironmentRecord():
+	"""Appends the temperature and humidity readings sampled since the last 
+	call to the environment record in the experimental root
+
+	Args:
+		None
+
+	Returns:
+		None
+	"""
+
+	if hi.environment is None:
+		return
+	readings = hi.environment.drain()
+	if len(readings):
+		readings['setup'] = hi.setup
+		writeImagingRecord(readings, 'environment', records.environmentColumns)
+
+
+def burst(data_dir, channel, exposure, numFrames, dname, note, intervalMs = 0, 
+			acquisitionMode = 'sequence', writer = None, write_imaging_record = True, 
+			return_imaging_record = False):
+	"""Acquires a tight kinetic burst of frames at the current stage position.
+
+	In 'sequence' mode the burst runs as a single camera sequence 
+	acquisition, falling back to timed snaps if sequences are unsupported.
+
+	Args:
+		data_dir (str): root directory of image acquisitions
+		channel (str): channel, as per Channel preset group
+		exposure (float): camera exposure (ms)
+		numFrames (int): number of frames
+		dname (str): device name ('d1' | 'd2' |'d3')
+		note (str): burst note, to be used in the image folder name
+		intervalMs (float): interval between frame starts (ms). 0 acquires 
+			as fast as the camera allows.
+		acquisitionMode (str): frame acquisition mode ('snap' | 'sequence')
+		writer (storage.FrameWriter): frame writer. Defaults to the shared 
+			writer from getFrameWriter().
+		write_imaging_record (bool): flag to append the burst to the bursts record
+		return_imaging_record (bool): flag to return the burst record
+
+	Returns:
+		(pd.DataFrame | None): Pandas dataframe with a summary of the burst
+	"""
+
+	startTime = time.strftime("%Y%m%d-%H%M%S", clock.localtime())
+	outPath = os.path.join(data_dir, channel, '{}_{}_{}_burst'.format(startTime, note.replace(' ', '_'), channel))
+	if not os.path.isdir(outPath):
+		os.makedirs(outPath)
+	if writer is None:
+		writer = getFrameWriter()
+	eh.acquilogger.info('Started Burst of {}, {} x {}ms {}, note = {}'.format(dname, numFrames, exposure, channel, note))
+
+	hi.core.setConfig('Channel', channel)
+	hi.core.waitForSystem()
+	engine = acquisition.AcquisitionEngine(hi.core, acquisitionMode, halt = hi.haltEvent)
+	burstStart = clock.monotonic()
+	frames = engine.burst(exposure, numFrames, intervalMs)
+	burstDuration = clock.monotonic() - burstStart
+
+	burstRecord = records.RecordBuilder(records.burstColumns, capacity = len(frames))
+	burstRecord.setConstants(raster_start_time = startTime, channel = channel, 
+								dname = dname, note = note, setup = hi.setup, 
+								experimental_desc = eh.experimentalDescription, 
+								acquisition_mode = engine.mode)
+	for k, (exposure, img, snapTime, readoutTime, frameOffset) in enumerate(frames):
+		imagePath = os.path.join(outPath, 'frame{:04d}_{}.tif'.format(k, exposure))
+		frameTime = datetime.datetime.fromtimestamp(clock.now()).strftime("%Y-%m-%d %H:%M:%S")
+		tags = dict(zip([33434, 270, 306], [exposure/1000.0, '{{Channel: {}, Frame:{}}}'.format(channel, k), frameTime]))
+		writer.submit(img, imagePath, tags)
+		burstRecord.append(exposure_ms = exposure, image_path = imagePath, 
+							frame_index = k, frame_offset_s = frameOffset, 
+							frame_time = frameTime, snap_s = snapTime, 
+							readout_s = readoutTime)
+	writer.flush()
+	eh.acquilogger.info('Completed Burst of {}, {} frames in {:.3f} s ({})'.format(dname, len(frames), burstDuration, 
+		'sequence' if engine.sequencing else 'snap'))
+
+	burstRecordDF = burstRecord.toDataFrame()
+	if write_imaging_record:
+		writeImagingRecord(burstRecordDF, 'bursts', records.burstColumns)
+	if return_imaging_record:
+		return burstRecordDF
+
+
 class KineticAcquisition():
-	def __init__(self, deviceName, channelsExposures, delayTimes, description):
+	def __init__(self, deviceName, channelsExposures, delayTimes, description, 
+					alternateDirection = False):
 		self.device = deviceName #either d1, d2, or d1d2
 		self.channelsExposures = channelsExposures # dict
 		self.delayTimes = delayTimes #as a tuple
 		self.absTimes = self.getTimeSpacings()
 		self.note = description.replace(" ", "_")
+		self.alternateDirection = alternateDirection # reverse every other scan, skip homing
+		self.stack = None # single stack of every timepoint, if not writing files
+
+	def scanOptions(self, timepoint):
+		"""Scan keyword arguments for a kinetic timepoint.
+
+		With alternateDirection, odd timepoints visit the position list in 
+		reverse and no scan returns the stage home, so each scan starts 
+		where the previous one ended. With a stack, each scan writes its 
+		timepoint of the acquisition's stack.
+
+		Args:
+			timepoint (int): index of the kinetic timepoint
+
+		Returns:
+			dict: keyword arguments for scan()
+		"""
+		options = {'timepoint': timepoint}
+		if self.alternateDirection:
+			options.update({'reverse': timepoint % 2 == 1, 'homeStage': False})
+		if self.stack is not None:
+			options['stack'] = self.stack
+		return options
+
+	def checkDelays(self, scanDuration, source):
+		"""Warns if any delay is shorter than the scan duration, in which case 
+		the following timepoints start late
+
+		Args:
+			scanDuration (float): scan duration (s)
+			source (str): origin of the duration, for the warning 
+				('predicted' | 'measured')
+
+		Returns:
+			bool: True if every delay fits a scan
+		"""
+		short = [delay for delay in self.delayTimes if delay < scanDuration]
+		if short:
+			warnings.warn('Kinetic delays {} s are shorter than the {} scan duration of {:.1f} s, '
+							'timepoints will start late'.format(short, source, scanDuration))
+		return not short
+
 
 	def getTimeSpacings(self):
 		"""
@@ -311,65 +817,69 @@ class KineticAcquisition():
 	def startAssay(self, data_dir, position_list, scanQueueFlag = False):
 		"""Brings the stage home, schedules the scans, then starts the image acquisitions
 
+		Timepoints are scheduled at absTimes after the start, on the 
+		monotonic clock, so a late scan does not delay the ones after it. 
+		The requested and actual start of each timepoint are recorded in 
+		the imaging record.
+
 		Args:
 			data_dir (str): directory to write image folder
 			post_list (pd.DataFrame): position list
-			scanQueueFlag (bool): flag to add scan to the common scan queue
+			scanQueueFlag (bool): flag to submit the scans to the shared scan 
+				arbiter (see getScanArbiter) rather than scan directly. Returns 
+				once every scan has run, then raises the error of the first 
+				failed or cancelled timepoint.
 		
 		Returns:
 			None
 		"""
 		
 		kineticSubfolder = '{}_{}'.format(time.strftime("%Y%m%d_%H%M%S", 
-														time.localtime()), 
+														clock.localtime()), 
 											self.note.replace(" ", "_")
 											)
 		kineticDirectory = os.path.join(data_dir, kineticSubfolder)
 		os.makedirs(kineticDirectory)
+
+		storageBackend = (eh.config or {}).get('imaging', {}).get('storage_backend', 'files')
+		if storageBackend != 'files':
+			self.stack = open_stack(storageBackend, os.path.join(kineticDirectory, self.note), 
+									len(self.absTimes), self.channelsExposures, position_list)
 			
-		eh.acquilogger.info(self.__str__())
-		eh.acquilogger.info('Kinetic acquisition started: ' + str(self.note.replace(" ", "_")))
+		try:
+			eh.acquilogger.info(self.__str__())
+			eh.acquilogger.info('Kinetic acquisition started: ' + str(self.note.replace(" ", "_")))
 		
-		delaysToQueue = [0] + self.delayTimes
-		scanQueue = Queue()
+			scanDuration = predict_scan_duration(self.channelsExposures, position_list, 
+													homeStage = not self.alternateDirection)
+			self.checkDelays(scanDuration, 'predicted')
 
-		list(map(lambda k: scanQueue.put(k), delaysToQueue))
-		
-		lastScanTime = time.time()
-		while not scanQueue.empty():
-			nextScanDelay = scanQueue.get()
-			deltaTime = (nextScanDelay + lastScanTime) - time.time()
-			if deltaTime <= 0:
-				lastScanTime = time.time()
-				if scanQueueFlag == True:
-					args = [kineticDirectory, 
-							self.channelsExposures, 
-							self.device, 
-							self.note.replace(" ", "_"), 
-							position_list]
-					kwargs = {}
-					hardwareQueue.put((args, kwargs))
-				else:
-					scan(kineticDirectory, 
-						self.channelsExposures, 
-						self.device, 
-						self.note.replace(" ", "_"), 
-						position_list)
+			args = [kineticDirectory, 
+					self.channelsExposures, 
+					self.device, 
+					self.note.replace(" ", "_"), 
+					position_list]
+			referenceTime = clock.monotonic()
+			if scanQueueFlag == True:
+				requests = []
+				for timepoint, requestedStart in enumerate(self.absTimes):
+					kwargs = dict(self.scanOptions(timepoint), schedule = (referenceTime, requestedStart))
+					requests.append(getScanArbiter().submit(args, kwargs, referenceTime + requestedStart, 
+															self.device))
+				for request in requests:
+					request.wait()
+				for request in requests:
+					request.result()
 			else:
-				time.sleep(deltaTime)
-				lastScanTime = time.time()
-				if scanQueueFlag == True:
-					args = [kineticDirectory, 
-							self.channelsExposures, 
-							self.device, 
-							self.note.replace(" ", "_"), 
-							position_list]
-					kwargs = {}
-					hardwareQueue.put((args, kwargs))
-				else:
-					scan(kineticDirectory, 
-						self.channelsExposures, 
-						self.device, 
-						self.note.replace(" ", "_"), 
-						position_list)
+				for timepoint, requestedStart in enumerate(self.absTimes):
+					clock.sleep(referenceTime + requestedStart - clock.monotonic())
+					kwargs = dict(self.scanOptions(timepoint), schedule = (referenceTime, requestedStart))
+					scanStart = clock.monotonic()
+					scan(*args, **kwargs)
+					if timepoint == 0:
+						self.checkDelays(clock.monotonic() - scanStart, 'measured')
+		finally:
+			if self.stack is not None:
+				self.stack.close()
+				self.stack = None
 		eh.acquilogger.info('Kinetic Read Complete')
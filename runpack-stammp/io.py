@@ -10,17 +10,33 @@
 
 import os
 import sys
+import csv
 import time
+import atexit
 import json
 import logging
 import warnings
+import threading
+import numpy as np
 import pandas as pd
+from Queue import Queue, Full
 
-import visa
+try:
+	import visa
+except ImportError:
+	visa = None # required by the temperature probe only
 
-from acqpack import Manifold
-from acqpack import utils as ut
-from acqpack import gui
+try:
+	from acqpack import Manifold
+	from acqpack import utils as ut
+except ImportError:
+	Manifold = ut = None # required by the manifold and .pos files only
+
+from runpack import clock
+from runpack import simulation
+from runpack import positions
+from runpack import catalog
+from runpack import pathplanning
 
 
 ################################################################################
@@ -36,9 +52,11 @@ class ExperimentalHarness:
 	config = None
 	experimentalDescription = ''
 	assayTimes = {}
-	imagingRecord = pd.DataFrame()
+	imagingRecord = None #ImagingCatalog of acquired frames
+	logQueue = None
+	stagePaths = {}
 
-	def __init__(self, root, description, loggername = 'experiment'):
+	def __init__(self, root, description, loggername = 'experiment', queuedLogging = False):
 		"""Experimental Harness constructor
 		
 		TODO: refactor as parent class
@@ -48,6 +66,8 @@ class ExperimentalHarness:
 			(str) description: brterse exeperimental description
 			(str) loggername: custom name for the experimental logger. Will be 
 				propogated to the experimental log.
+			(bool) queuedLogging: flag to hand log records to a background 
+				thread instead of writing them on the calling thread
 
 		Returns:
 			None
@@ -55,27 +75,70 @@ class ExperimentalHarness:
 
 		ExperimentalHarness.rootPath = self.root = root
 		ExperimentalHarness.experimentalDescription = self.description = description
+		ExperimentalHarness.imagingRecord = catalog.ImagingCatalog(os.path.join(root, 'imaging.sqlite'))
 		time.sleep(0.2)
 		
-		self.initializeLogger(loggername)
+		self.initializeLogger(loggername, queued = queuedLogging)
 
 
 	def addPositionList(self, dname, path):
 		"""Adds a MicroManager position list to the experimental harness
 
+		Position lists are stored as array-backed PositionLists.
+
 		Args:
 			(str) dname: device name ('d1' | 'd2' | 'd3')
-			(str) path: path of the MicroManager position list (.pos file)
+			(str | PositionList | pd.DataFrame) path: path of the MicroManager 
+				position list (.pos file), or a loaded position list
 
 		Returns:
 			None
 		"""
 
-		posList = ut.load_mm_positionlist(path)
+		if isinstance(path, (positions.PositionList, pd.DataFrame)):
+			posList = positions.asPositionList(path)
+		else:
+			if ut is None:
+				raise ImportError('Loading MicroManager position lists requires acqpack')
+			posList = positions.PositionList.fromDataFrame(ut.load_mm_positionlist(path))
 		ExperimentalHarness.posLists[dname] = posList
+		ExperimentalHarness.stagePaths.pop(dname, None)
 		logging.info('Added Position List for Device {}'.format(dname))
 
 
+	def optimizePositionList(self, dname, method = 'serpentine', returnHome = True):
+		"""Reorders a device's position list into a low-travel visiting order
+
+		Plans are cached per position list and method. The position list as 
+		added is kept, so re-planning with another method starts from it.
+
+		Args:
+			(str) dname: device name ('d1' | 'd2' | 'd3')
+			(str) method: path planning method ('serpentine' | 'nearest')
+			(bool) returnHome: flag to count the move home after each scan. 
+				Set False for kinetic acquisitions that alternate direction.
+
+		Returns:
+			dict: stage travel of the 'original' and 'planned' orders and the 
+				travel 'saved' (stage units, typically um)
+		"""
+
+		paths = ExperimentalHarness.stagePaths.setdefault(dname, 
+					{'original': ExperimentalHarness.posLists[dname], 'plans': {}})
+		original = paths['original']
+		key = (method, returnHome)
+		if key not in paths['plans']:
+			paths['plans'][key] = pathplanning.planPath(original, method, returnHome)
+		order, stats = paths['plans'][key]
+		if isinstance(original, positions.PositionList):
+			ExperimentalHarness.posLists[dname] = original.take(order)
+		else:
+			ExperimentalHarness.posLists[dname] = original.iloc[order].reset_index(drop = True)
+		logging.info('Planned {} stage path for Device {}: travel {:.0f} -> {:.0f} ({:.0f} saved)'.format(
+			method, dname, stats['original'], stats['planned'], stats['saved']))
+		return stats
+
+
 	def removePositionList(self, dname):
 		"""Removes a MicroManager position list from the experimental harness
 
@@ -87,6 +150,7 @@ class ExperimentalHarness:
 		"""
 
 		ExperimentalHarness.posLists.pop(dname)
+		ExperimentalHarness.stagePaths.pop(dname, None)
 		logging.info('Remove Posiiton List for Device {}'.format(dname))
 
 
@@ -112,31 +176,58 @@ class ExperimentalHarness:
 			ExperimentalHarness.userlogger.info(note)
 
 
-	def initializeLogger(self, name):
+	def initializeLogger(self, name, queued = False, queueSize = 10000, overflow = 'drop'):
 		"""Initializes the loggers
 
 		These loggers include a valve logger, script logger, acquisition 
 		logger, and user logger.
 
+		If queued, the file and console handlers are driven by a background 
+		listener thread fed through a bounded queue, so logging calls never 
+		block on file or console I/O. Queued records are flushed at exit.
+
 		Args:
 			(str) name: log file name
+			(bool) queued: flag to log through a background listener thread
+			(int) queueSize: maximum number of records waiting in the queue
+			(str) overflow: policy when the queue is full ('drop' | 'block'). 
+				Dropped records are counted and reported in the log.
 
 		Return:
 			None
 		"""
-		logging.basicConfig(level=logging.INFO,
-					format = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-					datefmt = '%y-%m-%d %H:%M:%S',
-					filename = os.path.join(self.root, '{}.log'.format(name)),
-					filemode = 'a+')
-
-		console = logging.StreamHandler()
-		console.setLevel(logging.INFO)
-		formatter = logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s', '%y-%m-%d %H:%M:%S')
-		console.setFormatter(formatter)
-
-		# add the handler to the root logger
-		logging.getLogger('').addHandler(console)
+		logFormat = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+		dateFormat = '%y-%m-%d %H:%M:%S'
+		logPath = os.path.join(self.root, '{}.log'.format(name))
+
+		if queued:
+			logfile = logging.FileHandler(logPath, mode = 'a+')
+			logfile.setFormatter(logging.Formatter(logFormat, dateFormat))
+			console = logging.StreamHandler()
+			console.setLevel(logging.INFO)
+			console.setFormatter(logging.Formatter(logFormat, dateFormat))
+
+			ExperimentalHarness.logQueue = QueueLogHandler([logfile, console], 
+															queueSize = queueSize, 
+															overflow = overflow)
+			root = logging.getLogger('')
+			root.setLevel(logging.INFO)
+			root.addHandler(ExperimentalHarness.logQueue)
+			atexit.register(ExperimentalHarness.logQueue.close)
+		else:
+			logging.basicConfig(level=logging.INFO,
+						format = logFormat,
+						datefmt = dateFormat,
+						filename = logPath,
+						filemode = 'a+')
+
+			console = logging.StreamHandler()
+			console.setLevel(logging.INFO)
+			formatter = logging.Formatter(logFormat, dateFormat)
+			console.setFormatter(formatter)
+
+			# add the handler to the root logger
+			logging.getLogger('').addHandler(console)
 		logging.captureWarnings(True)
 
 		ExperimentalHarness.valvelogger = logging.getLogger('Valves')
@@ -215,6 +306,127 @@ class ExperimentalHarness:
 
 
 
+class QueueLogHandler(logging.Handler):
+	def __init__(self, handlers, queueSize = 10000, overflow = 'drop'):
+		"""Logging handler that hands records to a background listener thread
+
+		Records are queued on the logging thread and written to the target 
+		handlers by the listener, so file and console I/O stay off hardware
+		control threads.
+
+		Args:
+			handlers (list): logging handlers the listener writes to
+			queueSize (int): maximum number of records waiting in the queue
+			overflow (str): policy when the queue is full. 'drop' discards the 
+				record and counts it, 'block' waits for space ('drop' | 'block')
+
+		Returns:
+			None
+		"""
+		if overflow not in ('drop', 'block'):
+			raise ValueError('Log queue overflow policy must be \'drop\' or \'block\'')
+		logging.Handler.__init__(self)
+		self.handlers = handlers
+		self.overflow = overflow
+		self.dropped = 0
+		self.reportedDropped = 0
+		self.queue = Queue(queueSize)
+		self.closed = False
+		self.listener = threading.Thread(target = self._listen, name = 'LogListener')
+		self.listener.daemon = True
+		self.listener.start()
+
+
+	def emit(self, record):
+		"""Queues a record, formatting its message on the calling thread
+
+		Args:
+			record (logging.LogRecord): record to queue
+
+		Returns:
+			None
+		"""
+		try:
+			record.msg = record.getMessage()
+			record.args = None
+			if record.exc_info:
+				record.exc_text = logging.Formatter().formatException(record.exc_info)
+				record.exc_info = None
+			if self.overflow == 'block':
+				self.queue.put(record)
+			else:
+				self.queue.put_nowait(record)
+		except Full:
+			self.dropped += 1
+		except Exception:
+			self.handleError(record)
+
+
+	def _listen(self):
+		while True:
+			record = self.queue.get()
+			try:
+				if record is None:
+					return
+				if self.dropped > self.reportedDropped:
+					self._handle(self._droppedRecord())
+				self._handle(record)
+			finally:
+				self.queue.task_done()
+
+
+	def _handle(self, record):
+		for handler in self.handlers:
+			if record.levelno >= handler.level:
+				handler.handle(record)
+
+
+	def _droppedRecord(self):
+		dropped = self.dropped
+		newlyDropped = dropped - self.reportedDropped
+		self.reportedDropped = dropped
+		message = 'Log queue full: dropped {} record(s), {} in total'.format(newlyDropped, dropped)
+		return logging.LogRecord('Logging', logging.WARNING, __file__, 0, message, None, None)
+
+
+	def flush(self):
+		"""Blocks until every queued record has been written
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		if not self.closed:
+			self.queue.join()
+		for handler in self.handlers:
+			handler.flush()
+
+
+	def close(self):
+		"""Writes all queued records, stops the listener, and closes the 
+		target handlers
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		if not self.closed:
+			self.closed = True
+			self.queue.put(None)
+			self.listener.join()
+			if self.dropped > self.reportedDropped:
+				self._handle(self._droppedRecord())
+			for handler in self.handlers:
+				handler.flush()
+				handler.close()
+		logging.Handler.close(self)
+
+
+
 class HardwareInterface:
 
 	config = None
@@ -230,10 +442,14 @@ class HardwareInterface:
 	coreTimeout = 20000 #ms
 	core = None #MM core
 	temp = None #temperature & humidity probe
+	environment = None #background temperature & humidity sampler
 	m = None #manifold
 	flowValves = None
 	controlValves = None
 	valveReferenceIndex = 'chip'
+	valveIndex = None #precompiled valvemap lookup
+	valveState = None #shadow register of commanded coil states
+	haltEvent = threading.Event() #set by an emergency stop
 
 
 	def __init__(self, loadAllHardware = True, configLoc = ''):
@@ -262,11 +478,13 @@ class HardwareInterface:
 	def initializeHardware(self, subset = 'all'):
 		"""Initializes control of the hardware by adding it to the hardware interface. 
 		
-		Possible subsets are 'all', 'manifold', 'microscope', and 'temperature'.
+		Possible subsets are 'all', 'manifold', 'microscope', 'temperature', 
+		and 'simulated'. 'simulated' installs in-memory stand-ins for all 
+		hardware, configured by the optional 'simulation' hardware config.
 
 		Args:
 			subset (str): subset of hardware to initialize ('all' | 'manifold' 
-				| 'microscope' | 'temperature'.)
+				| 'microscope' | 'temperature' | 'simulated')
 
 		Returns:
 			None
@@ -282,6 +500,8 @@ class HardwareInterface:
 			self.initializeMicroManager()
 		elif subset == 'temperature':
 			self.initializeTempProbe()
+		elif subset == 'simulated':
+			self.initializeSimulatedHardware()
 		elif subset is None:
 			warnings.warn('No hardware was selected to initialize')
 		else:
@@ -299,12 +519,31 @@ class HardwareInterface:
 			None
 		"""
 		hi = HardwareInterface
+		if Manifold is None:
+			raise ImportError('Manifold control requires acqpack')
 		HardwareInterface.m = Manifold(hi.manifoldAddress, 
 										str(hi.valvemapPath), 
 										hi.manifoldOffset)
+		self.loadValvemap()
+		logging.info('Manifold Control Established')
+
+
+	def loadValvemap(self):
+		"""Prepares the valvemap, valve index, and valve state register of 
+		the loaded manifold.
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		hi = HardwareInterface
 		HardwareInterface.m.valvemap.fillna('', inplace=True)
+		HardwareInterface.valveIndex = ValveIndex.fromCsv(hi.valvemapPath, 
+															hi.valveReferenceIndex)
 		self.assignValvetypes()
-		logging.info('Manifold Control Established')
+		self.initializeValveState()
 
 
 	def assignValvetypes(self):
@@ -317,12 +556,27 @@ class HardwareInterface:
 			None
 		"""
 
-		valves = HardwareInterface.m.valvemap.copy().dropna()
-		device = valves['device'].drop_duplicates().tolist()[0]
-		valves['chipshort'] = valves.chip.apply(lambda v: v[:-1]) # Shorthand valve notation
+		index = HardwareInterface.valveIndex
+		HardwareInterface.flowValves = index.layerValves('flow')
+		HardwareInterface.controlValves = index.layerValves('control')
 
-		HardwareInterface.flowValves = valves.loc[valves.layer == 'flow'].chipshort.drop_duplicates().tolist()
-		HardwareInterface.controlValves = valves.loc[valves.layer == 'control'].chipshort.drop_duplicates().tolist()
+
+	def initializeValveState(self):
+		"""Creates the shadow register of coil states and syncs it with the manifold.
+
+		Every coil write made through the manifold client, including those 
+		from the manifold GUI widget, is recorded in the register.
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+
+		register = ValveStateRegister(HardwareInterface.valveIndex.numCoils)
+		register.attach(HardwareInterface.m, HardwareInterface.manifoldOffset)
+		HardwareInterface.valveState = register
 
 
 	def initializeMicroManager(self):
@@ -338,13 +592,76 @@ class HardwareInterface:
 		logging.info('Trying to Establish Microscope Control...')
 		sys.path.insert(0, HardwareInterface.mm_version) # make it so python can find MMCorePy
 		import MMCorePy
-		HardwareInterface.core = MMCorePy.CMMCore()
+		HardwareInterface.core = self.wrapCore(MMCorePy.CMMCore())
 		HardwareInterface.core.loadSystemConfiguration(str(HardwareInterface.mmcfg))
 		HardwareInterface.core.setTimeoutMs(HardwareInterface.coreTimeout)
 		logging.info('Microscope Control Established')
 
 		defaults = self.config['mm']['defaults']
 		self.setScopeConfig(exposure = defaults['exposure'], binning = defaults['binning'])
+
+
+	def wrapCore(self, core):
+		"""Wraps a MicroManager core in a CachedCore, unless the 'mm' hardware 
+		config sets 'property_cache' to false
+
+		Args:
+			core (MMCorePy.CMMCore): MicroManager core
+
+		Returns:
+			CachedCore | MMCorePy.CMMCore: the core to use
+		"""
+
+		if HardwareInterface.config['mm'].get('property_cache', True):
+			return CachedCore(core)
+		return core
+
+
+	def initializeSimulatedHardware(self):
+		"""Installs in-memory simulated manifold, microscope, and temperature probe.
+
+		Timings are read from the optional 'simulation' hardware config. If the 
+		configured valvemap is missing, the bundled 2block valvemap is used.
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+
+		hi = HardwareInterface
+		sim = HardwareInterface.config.get('simulation', {})
+		if not os.path.isfile(hi.valvemapPath):
+			bundled = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+									'valvemaps', '2block.csv')
+			warnings.warn('Valvemap {} not found, using {}'.format(hi.valvemapPath, bundled))
+			HardwareInterface.valvemapPath = bundled
+		HardwareInterface.m = simulation.SimulatedManifold(hi.valvemapPath, 
+															hi.manifoldOffset, 
+															sim.get('write_latency', 0.002))
+		self.loadValvemap()
+		logging.info('Simulated Manifold Control Established')
+
+		HardwareInterface.core = self.wrapCore(simulation.SimulatedCore(hi.filterBlockName, 
+									hi.channels, 
+									imageShape = tuple(sim.get('image_shape', (512, 512))), 
+									stageSpeed = sim.get('stage_speed', 10000.0), 
+									stageSettle = sim.get('stage_settle', 0.05), 
+									focusSpeed = sim.get('focus_speed', 1000.0), 
+									filterSwitchTime = sim.get('filter_switch_time', 0.3), 
+									exposureSetTime = sim.get('exposure_set_time', 0.01), 
+									readoutTime = sim.get('readout_time', 0.03), 
+									exposureSequencing = sim.get('exposure_sequencing', True)))
+		HardwareInterface.core.setTimeoutMs(HardwareInterface.coreTimeout)
+		defaults = self.config['mm']['defaults']
+		self.setScopeConfig(exposure = defaults['exposure'], binning = defaults['binning'])
+		logging.info('Simulated Microscope Control Established')
+
+		HardwareInterface.temp = simulation.SimulatedTemperatureProbe(
+									queryLatency = sim.get('probe_latency', 0.02))
+		logging.info('Simulated Temperature and Humidity Probe Connected')
+		self.startEnvironmentSampler()
 	
 
 	def initializeTempProbe(self):
@@ -361,6 +678,34 @@ class HardwareInterface:
 		HardwareInterface.temp = TemperatureProbe(th['vid'], th['pid'])
 		HardwareInterface.temp.load()
 		logging.info('Temperature and Humidity Probe Connected')
+		self.startEnvironmentSampler()
+
+
+	def startEnvironmentSampler(self):
+		"""Starts background sampling of the temperature probe
+
+		The sampling interval (s) and ring buffer size (readings) are set by 
+		the optional 'temp_hum' config keys 'sample_interval' and 
+		'buffer_size'. A 'sample_interval' of 0 disables the sampler, and 
+		scans query the probe directly.
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+
+		th = HardwareInterface.config.get('temp_hum', {})
+		interval = th.get('sample_interval', 5.0)
+		if HardwareInterface.environment is not None:
+			HardwareInterface.environment.stop()
+			HardwareInterface.environment = None
+		if interval:
+			HardwareInterface.environment = EnvironmentSampler(HardwareInterface.temp, interval, 
+																th.get('buffer_size', 17280))
+			HardwareInterface.environment.start()
+			logging.info('Temperature and Humidity Sampling Started, every {} s'.format(interval))
 	
 
 	def setScopeConfig(self, exposure = None, binning = None, channel = None):
@@ -389,8 +734,7 @@ class HardwareInterface:
 		if channel:
 			HardwareInterface.core.setConfig('Channel', str(channel))
 			logging.info('Camera Channel Set: {}'.format(channel))
-		# HardwareInterface.core.waitForDevice(HardwareInterface.filterBlockName)
-		HardwareInterface.core.waitForSystem()
+		HardwareInterface.core.waitForSystem() # waits only on changed devices if cached
 
 
 	def unloadHardware(self):
@@ -405,6 +749,7 @@ class HardwareInterface:
 
 		try:
 			HardwareInterface.m.exit()
+			HardwareInterface.valveState = None
 			logging.info('Manifold Control Unloaded')
 		except Exception:
 			warnings.warn('Could Not Unload Manifold')
@@ -418,6 +763,9 @@ class HardwareInterface:
 			warnings.warn('Could Not Unload Micromanager')
 			pass
 		try:
+			if HardwareInterface.environment is not None:
+				HardwareInterface.environment.stop()
+				HardwareInterface.environment = None
 			del(HardwareInterface.temp)
 			logging.info('Temperature Probe Disconnected')
 		except Exception:
@@ -488,6 +836,481 @@ class HardwareInterface:
 
 
 
+class ValveIndex:
+	def __init__(self, offsets, names, layers, devices, reference = 'chip'):
+		"""Precompiled valvemap lookup from (device, shorthand valve) to coil offset
+
+		Valve names, layers, and device numbers are held in arrays indexed by 
+		coil offset. Per-device flow and control layer bitmasks (bit i = coil 
+		offset i) are built once for bulk valve operations.
+
+		Args:
+			offsets (list): coil offset of each valve
+			names (list): full valve name of each valve (e.g. 'bb1')
+			layers (list): layer of each valve ('flow' | 'control')
+			devices (list): device of each valve (e.g. 'd1')
+			reference (str): valvemap reference name the names were read from
+
+		Returns:
+			None
+		"""
+		self.reference = reference
+		self.numCoils = max(offsets) + 1 if offsets else 0
+		self.names = np.full(self.numCoils, '', dtype=object)
+		self.layers = np.full(self.numCoils, '', dtype=object)
+		self.dnums = np.full(self.numCoils, '', dtype=object)
+		self.coilLookup = {}
+		self.nameLookup = {}
+		self.layerMasks = {}
+		self.shortNames = {'flow': [], 'control': []}
+		self._layerCoilCache = {}
+
+		for offset, name, layer, device in zip(offsets, names, layers, devices):
+			dnum = str(device)[-1]
+			short = name[:-1] # Shorthand valve notation
+			self.names[offset] = name
+			self.layers[offset] = layer
+			self.dnums[offset] = dnum
+			self.coilLookup[(dnum, short)] = offset
+			self.nameLookup[name] = offset
+			masks = self.layerMasks.setdefault(dnum, {'flow': 0, 'control': 0})
+			masks[layer] = masks.get(layer, 0) | 1 << offset
+			if short not in self.shortNames.setdefault(layer, []):
+				self.shortNames[layer].append(short)
+
+
+	@classmethod
+	def fromCsv(cls, path, reference = 'chip'):
+		"""Builds a ValveIndex from a valvemap CSV
+
+		Rows without a valve name (unused coils) are skipped.
+
+		Args:
+			path (str): valvemap CSV path (e.g. valvemaps/2block.csv)
+			reference (str): valvemap column holding valve names
+
+		Returns:
+			ValveIndex: the compiled index
+		"""
+		offsets, names, layers, devices = [], [], [], []
+		with open(path) as valvemap:
+			for row in csv.DictReader(valvemap):
+				if not row[reference]:
+					continue
+				offsets.append(int(row['valve']))
+				names.append(row[reference])
+				layers.append(row['layer'])
+				devices.append(row['device'])
+		return cls(offsets, names, layers, devices, reference)
+
+
+	def coil(self, device, valve):
+		"""Returns the coil offset of a device's valve
+
+		Args:
+			device (str): device name (e.g. 'd1')
+			valve (str): shorthand valve name (e.g. 'bb')
+
+		Returns:
+			int: coil offset relative to the manifold offset
+		"""
+		try:
+			return self.coilLookup[(str(device)[-1], valve)]
+		except KeyError:
+			raise ValueError('Valve {} not found for device {}'.format(valve, device))
+
+
+	def coils(self, devices, valves):
+		"""Returns the coil offsets of the given valves on each given device
+
+		Args:
+			devices (list | tuple): list of devices (e.g. ['d1', 'd2'])
+			valves (list | tuple): list of shorthand valves (e.g. ['bb', 'na'])
+
+		Returns:
+			list: coil offsets
+		"""
+		return [self.coil(device, valve) for device in devices for valve in valves]
+
+
+	def mask(self, devices, layer = 'all'):
+		"""Returns the bitmask of all valves of a layer on the given devices
+
+		Args:
+			devices (list | tuple): list of devices (e.g. ['d1', 'd2'])
+			layer (str): valve layer ('all' | 'flow' | 'control')
+
+		Returns:
+			int: bitmask with bit i set for each matching coil offset i
+		"""
+		layers = ['flow', 'control'] if layer == 'all' else [layer]
+		mask = 0
+		for device in devices:
+			masks = self.layerMasks.get(str(device)[-1], {})
+			for l in layers:
+				mask |= masks.get(l, 0)
+		return mask
+
+
+	def layerCoils(self, devices, layer = 'all'):
+		"""Returns the coil offsets of all valves of a layer on the given devices
+
+		Results are cached per device group and layer.
+
+		Args:
+			devices (list | tuple): list of devices (e.g. ['d1', 'd2'])
+			layer (str): valve layer ('all' | 'flow' | 'control')
+
+		Returns:
+			tuple: coil offsets, ascending
+		"""
+		key = (tuple(devices), layer)
+		if key not in self._layerCoilCache:
+			mask = self.mask(devices, layer)
+			self._layerCoilCache[key] = tuple(c for c in range(self.numCoils) if mask >> c & 1)
+		return self._layerCoilCache[key]
+
+
+	def layerValves(self, layer):
+		"""Returns the shorthand names of all valves of a layer
+
+		Args:
+			layer (str): valve layer ('flow' | 'control')
+
+		Returns:
+			list: shorthand valve names, in valvemap order
+		"""
+		return list(self.shortNames.get(layer, []))
+
+
+
+class ValveStateRegister:
+	def __init__(self, numCoils):
+		"""Shadow register of the last commanded state of every manifold coil
+
+		Coil states are held in a bitfield indexed by valvemap coil offset, 
+		alongside a second bitfield marking which coils have a known state.
+
+		Args:
+			numCoils (int): number of coils in the valvemap
+
+		Returns:
+			None
+		"""
+		self.numCoils = numCoils
+		self.states = 0
+		self.known = 0
+
+
+	def attach(self, manifold, offset):
+		"""Routes the manifold's coil writes through the register and reads 
+		the current coil states.
+
+		Args:
+			manifold (acqpack.Manifold): manifold to shadow
+			offset (int): WAGO coil address of valvemap offset 0
+
+		Returns:
+			None
+		"""
+		client = getattr(manifold, 'client', None)
+		if client is None or isinstance(client, _ShadowedClient):
+			return
+		manifold.client = _ShadowedClient(client, self, offset)
+		if hasattr(client, 'read_coils'):
+			try:
+				response = client.read_coils(offset, self.numCoils)
+				if not (hasattr(response, 'isError') and response.isError()):
+					self.update(dict(enumerate(response.bits[:self.numCoils])))
+			except Exception:
+				warnings.warn('Could not read initial coil states')
+
+
+	def get(self, coil):
+		"""Returns the last commanded state of a coil
+
+		Args:
+			coil (int): coil offset
+
+		Returns:
+			bool | None: coil state, or None if the state is unknown
+		"""
+		bit = 1 << coil
+		if not self.known & bit:
+			return None
+		return bool(self.states & bit)
+
+
+	def isKnown(self, first, count):
+		"""Checks whether every coil in a contiguous span has a known state
+
+		Args:
+			first (int): first coil offset
+			count (int): number of coils
+
+		Returns:
+			bool: True if all coils in the span are known
+		"""
+		mask = ((1 << count) - 1) << first
+		return self.known & mask == mask
+
+
+	def coils(self, first, count):
+		"""Returns the states of a contiguous span of coils
+
+		Args:
+			first (int): first coil offset
+			count (int): number of coils
+
+		Returns:
+			list: coil states (bool)
+		"""
+		return [bool(self.states >> coil & 1) for coil in range(first, first + count)]
+
+
+	def changes(self, coilStates):
+		"""Filters requested coil states down to those that would change a coil
+
+		Args:
+			coilStates (dict): coil offsets mapped to coil states (bool)
+
+		Returns:
+			dict: coil offsets mapped to coil states that differ from the register
+		"""
+		return {c: s for c, s in coilStates.items() if self.get(c) != bool(s)}
+
+
+	def update(self, coilStates):
+		"""Records commanded coil states
+
+		Args:
+			coilStates (dict): coil offsets mapped to coil states (bool)
+
+		Returns:
+			None
+		"""
+		for coil, state in coilStates.items():
+			if not 0 <= coil < self.numCoils:
+				continue
+			bit = 1 << coil
+			self.known |= bit
+			if state:
+				self.states |= bit
+			else:
+				self.states &= ~bit
+
+
+	def invalidate(self):
+		"""Marks every coil state as unknown
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		self.known = 0
+
+
+
+class _ShadowedClient:
+	def __init__(self, client, register, offset):
+		"""Modbus client proxy that records successful coil writes in a 
+		ValveStateRegister
+
+		Args:
+			client (pymodbus client): manifold Modbus client
+			register (ValveStateRegister): register to update
+			offset (int): WAGO coil address of valvemap offset 0
+
+		Returns:
+			None
+		"""
+		self._client = client
+		self._register = register
+		self._offset = offset
+
+
+	def write_coil(self, address, value, *args, **kwargs):
+		response = self._client.write_coil(address, value, *args, **kwargs)
+		if not (hasattr(response, 'isError') and response.isError()):
+			self._register.update({address - self._offset: bool(value)})
+		return response
+
+
+	def write_coils(self, address, values, *args, **kwargs):
+		response = self._client.write_coils(address, values, *args, **kwargs)
+		if not (hasattr(response, 'isError') and response.isError()):
+			first = address - self._offset
+			self._register.update({first + i: bool(v) for i, v in enumerate(values)})
+		return response
+
+
+	def __getattr__(self, name):
+		return getattr(self._client, name)
+
+
+
+class CachedCore:
+	_queries = ('get', 'is', 'has', 'deviceBusy', 'systemBusy', 'supportsDevice', 
+				'waitForConfig', 'waitForImageSynchro', 'popNextImage')
+	_cameraCommands = ('startSequenceAcquisition', 'stopSequenceAcquisition', 
+						'loadExposureSequence', 'startExposureSequence', 
+						'stopExposureSequence')
+
+	def __init__(self, core):
+		"""MicroManager core proxy that skips redundant device commands and waits
+
+		Tracks the last value set for each device property and config group. 
+		setProperty and setConfig calls that would not change anything are 
+		skipped. Devices commanded through the proxy are marked as changed, 
+		and waitForDevice/waitForSystem only wait on changed devices. Calls 
+		the proxy does not know (other than queries) mark every device as 
+		changed, so the next waitForSystem waits on the whole system. Call 
+		invalidate() after changing devices outside RunPack (e.g. the 
+		MicroManager GUI).
+
+		Args:
+			core (MMCorePy.CMMCore): MicroManager core
+
+		Returns:
+			None
+		"""
+		self._core = core
+		self._properties = {}
+		self._configs = {}
+		self._configDevices = {}
+		self._changed = set()
+		self._allChanged = True
+		self.skipped = 0
+
+
+	def invalidate(self):
+		"""Forgets all cached property and config values
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		self._properties = {}
+		self._configs = {}
+		self._configDevices = {}
+		self._allChanged = True
+
+
+	def _devicesOf(self, group, config):
+		key = (group, config)
+		if key not in self._configDevices:
+			try:
+				data = self._core.getConfigData(group, config)
+				devices = set(data.getSetting(i).getDeviceLabel() for i in range(data.size()))
+			except Exception:
+				devices = None # unknown, so treat every device as changed
+			self._configDevices[key] = devices
+		return self._configDevices[key]
+
+
+	def setProperty(self, device, name, value):
+		key = (device, name)
+		if self._properties.get(key) == str(value):
+			self.skipped += 1
+			return
+		self._core.setProperty(device, name, value)
+		self._properties[key] = str(value)
+		self._changed.add(device)
+
+
+	def getProperty(self, device, name):
+		value = self._core.getProperty(device, name)
+		self._properties[(device, name)] = str(value)
+		return value
+
+
+	def setConfig(self, group, config):
+		if self._configs.get(group) == config:
+			self.skipped += 1
+			return
+		self._core.setConfig(group, config)
+		self._configs[group] = config
+		devices = self._devicesOf(group, config)
+		if devices is None:
+			self._properties = {}
+			self._allChanged = True
+		else:
+			self._properties = {k: v for k, v in self._properties.items() if k[0] not in devices}
+			self._changed.update(devices)
+
+
+	def getCurrentConfig(self, group):
+		config = self._core.getCurrentConfig(group)
+		self._configs[group] = config
+		return config
+
+
+	def setXYPosition(self, *args):
+		self._core.setXYPosition(*args)
+		self._changed.add(args[0] if len(args) == 3 else self._core.getXYStageDevice())
+
+
+	def setPosition(self, *args):
+		self._core.setPosition(*args)
+		self._changed.add(args[0] if len(args) == 2 else self._core.getFocusDevice())
+
+
+	def snapImage(self):
+		self._core.snapImage()
+		self._changed.add(self._core.getCameraDevice())
+
+
+	def waitForDevice(self, device):
+		if self._allChanged or device in self._changed:
+			self._core.waitForDevice(device)
+			self._changed.discard(device)
+		else:
+			self.skipped += 1
+
+
+	def waitForSystem(self):
+		if self._allChanged:
+			self._core.waitForSystem()
+			self._allChanged = False
+		else:
+			for device in list(self._changed):
+				self._core.waitForDevice(device)
+		self._changed = set()
+
+
+	def loadSystemConfiguration(self, path):
+		self._core.loadSystemConfiguration(path)
+		self.invalidate()
+
+
+	def reset(self):
+		self._core.reset()
+		self.invalidate()
+
+
+	def __getattr__(self, name):
+		attr = getattr(self._core, name)
+		if not callable(attr) or name.startswith(self._queries):
+			return attr
+		if name in self._cameraCommands:
+			def cameraCommand(*args, **kwargs):
+				camera = self._core.getCameraDevice()
+				self._changed.add(camera)
+				if 'ExposureSequence' in name:
+					self._properties.pop((camera, 'Exposure'), None)
+				return attr(*args, **kwargs)
+			return cameraCommand
+		def command(*args, **kwargs):
+			self._allChanged = True
+			return attr(*args, **kwargs)
+		return command
+
+
+
 class TemperatureProbe:
 	def __init__(self, vid = '0x1313', pid = '0x80F8'):
 		"""Temperature Probe object for connection and query of Thorlabs TSP01
@@ -501,6 +1324,8 @@ class TemperatureProbe:
 		"""
 		self.vid = vid
 		self.pid = pid
+		if visa is None:
+			raise ImportError('The temperature probe requires pyvisa (pip install pyvisa)')
 		self.rm = visa.ResourceManager() #pyvisa
 
 
@@ -605,4 +1430,150 @@ class TemperatureProbe:
 
 	def __del__(self):
 		self.inst.close()
-		self.rm.close()
\ No newline at end of file
+		self.rm.close()
+
+
+
+class EnvironmentSampler:
+	def __init__(self, probe, interval = 5.0, capacity = 17280):
+		"""Background sampler of probe temperature and humidity
+
+		A daemon thread queries the probe every interval seconds and stores 
+		the readings in a fixed-size NumPy ring buffer, so acquisitions read 
+		cached values instead of making blocking VISA queries. Failed 
+		readings (999.9) are stored as NaN and skipped by lookups. Readings 
+		not yet drained are overwritten once the buffer wraps (24 h at the 
+		defaults).
+
+		Args:
+			probe (TemperatureProbe): temperature and humidity probe
+			interval (float): sampling interval (s)
+			capacity (int): number of readings held in the ring buffer
+
+		Returns:
+			None
+		"""
+		self.probe = probe
+		self.interval = interval
+		self.capacity = int(capacity)
+		self.buffer = np.full((self.capacity, 3), np.nan) # time, temperature, humidity
+		self.samples = 0
+		self.drained = 0
+		self.lock = threading.Lock()
+		self.stopEvent = threading.Event()
+		self.thread = None
+
+
+	def start(self):
+		"""Takes a first reading, then starts the sampling thread
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		self.sample()
+		self.stopEvent.clear()
+		self.thread = threading.Thread(target = self._run, name = 'EnvironmentSampler')
+		self.thread.daemon = True
+		self.thread.start()
+
+
+	def stop(self):
+		"""Stops the sampling thread
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		self.stopEvent.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+
+	def _run(self):
+		while not self.stopEvent.wait(self.interval):
+			try:
+				self.sample()
+			except Exception as e:
+				warnings.warn('Temperature and humidity sampling failed: {}'.format(e))
+
+
+	def sample(self):
+		"""Queries the probe and stores a reading
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		temperature = self.probe.getProbeTemp()
+		humidity = self.probe.getHumidity()
+		reading = [clock.now()] + [np.nan if v == 999.9 else v for v in (temperature, humidity)]
+		with self.lock:
+			self.buffer[self.samples % self.capacity] = reading
+			self.samples += 1
+
+
+	def nearest(self, t):
+		"""Returns the reading nearest in time to t
+
+		Args:
+			t (float): time (s since epoch, on the runpack clock)
+
+		Returns:
+			tuple: (temperature, humidity). 999.9 if no valid reading.
+		"""
+		best = None
+		with self.lock:
+			for k in xrange(min(self.samples, self.capacity)): # newest first
+				row = self.buffer[(self.samples - 1 - k) % self.capacity]
+				if np.isnan(row[1]) and np.isnan(row[2]):
+					continue
+				if best is None or abs(row[0] - t) < abs(best[0] - t):
+					best = row.copy()
+				if row[0] <= t:
+					break
+		if best is None:
+			return (999.9, 999.9)
+		return tuple(999.9 if np.isnan(v) else float(v) for v in best[1:])
+
+
+	def latest(self):
+		"""Returns the latest valid reading, without querying the probe
+
+		Args:
+			None
+
+		Returns:
+			tuple: (temperature, humidity). 999.9 if no valid reading.
+		"""
+		return self.nearest(clock.now())
+
+
+	def drain(self):
+		"""Returns the readings taken since the last drain, oldest first
+
+		Args:
+			None
+
+		Returns:
+			pd.DataFrame: sample_time, timestamp (s since epoch), temperature, 
+				and humidity of each reading
+		"""
+		with self.lock:
+			first = max(self.drained, self.samples - self.capacity)
+			if first > self.drained:
+				warnings.warn('{} temperature and humidity readings were overwritten before being recorded'.format(
+					first - self.drained))
+			rows = self.buffer[np.arange(first, self.samples) % self.capacity].copy()
+			self.drained = self.samples
+		sampleTimes = [time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)) for t in rows[:, 0]]
+		return pd.DataFrame({'sample_time': sampleTimes, 'timestamp': rows[:, 0], 
+								'temperature': rows[:, 1], 'humidity': rows[:, 2]}, 
+							columns = ['sample_time', 'timestamp', 'temperature', 'humidity'])
\ No newline at end of file
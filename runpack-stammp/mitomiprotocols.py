@@ -6,13 +6,11 @@
 # python_version    : 2.7
 
 
-import time
 from Queue import Queue
 
 import numpy as np
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.schedulers.blocking import BlockingScheduler
 
+from runpack import clock
 from runpack import valvecontrol as vc
 from runpack import imagingcontrol as ic
 from runpack.io import HardwareInterface as hi
@@ -77,91 +75,103 @@ def patternDevices(devices, inletNames = None, blocknames = None):
     eh.scriptlogger.info('2/18. Opening sandwiches, outlet, bBSA inlet, and waste. \
         Flushing bBSA through inlet tree to waste for 30s')
     vc.openValves(devices, sandwichValves + outlet + bbsaValve + wasteValve)
-    time.sleep(30)
+    clock.sleep(30)
 
     eh.scriptlogger.info('3/18. Done Flushing bBSA to waste. Flushing bBSA through \
         devices with buttons closed for 5min')
-    vc.closeValves(devices, wasteValve)
-    vc.openValves(devices, inletValve)
-    time.sleep(300)
+    with vc.transaction(devices):
+        vc.closeValves(devices, wasteValve)
+        vc.openValves(devices, inletValve)
+    clock.sleep(300)
 
     eh.scriptlogger.info('4/18. Opened buttons with bBSA flowing through devices to waste for 35min')
     vc.openValves(devices, buttonValves)
-    time.sleep(2100)
+    clock.sleep(2100)
 
     eh.scriptlogger.info('5/18. Done Flowing bBSA through devices and closed inlet. \
         Flushing PBS through inlet tree to waste for 30s')
-    vc.closeValves(devices, bbsaValve + inletValve)
-    vc.openValves(devices, bufferValve + wasteValve)
-    time.sleep(30)
+    with vc.transaction(devices):
+        vc.closeValves(devices, bbsaValve + inletValve)
+        vc.openValves(devices, bufferValve + wasteValve)
+    clock.sleep(30)
 
     eh.scriptlogger.info('6/18. Done flowing PBS to waste. Flushing PBS through device \
         with  buttons open for 10min')
-    vc.closeValves(devices,  wasteValve)
-    vc.openValves(devices, inletValve)
-    time.sleep(600)
+    with vc.transaction(devices):
+        vc.closeValves(devices,  wasteValve)
+        vc.openValves(devices, inletValve)
+    clock.sleep(600)
 
     eh.scriptlogger.info('7/18. Done flushing PBS through devices. \
         Flowing neutravidin through inlet tree to waste for 30s')
-    vc.closeValves(devices, bufferValve + inletValve)
-    vc.openValves(devices, naValve + wasteValve)
-    time.sleep(30)
+    with vc.transaction(devices):
+        vc.closeValves(devices, bufferValve + inletValve)
+        vc.openValves(devices, naValve + wasteValve)
+    clock.sleep(30)
 
     eh.scriptlogger.info('8/18. Done flushing Neutravidin to waste. \
         Flowing Neutravidin through devices with buttons open for 30min')
-    vc.closeValves(devices, wasteValve)
-    vc.openValves(devices, inletValve)
-    time.sleep(1800)
+    with vc.transaction(devices):
+        vc.closeValves(devices, wasteValve)
+        vc.openValves(devices, inletValve)
+    clock.sleep(1800)
 
     eh.scriptlogger.info('9/18. Done flowing Neutravidin through devices. \
         Flowing PBS through devices with buttons open for 10min')
-    vc.closeValves(devices, naValve)
-    vc.openValves(devices, bufferValve)
-    time.sleep(600)
+    with vc.transaction(devices):
+        vc.closeValves(devices, naValve)
+        vc.openValves(devices, bufferValve)
+    clock.sleep(600)
 
     eh.scriptlogger.info('10/18. Done flowing PBS through devices and closed buttons. \
         Flowing bBSA through the device for another 35min (quench walls only)')
-    vc.closeValves(devices, bufferValve + buttonValves)
-    vc.openValves(devices, bbsaValve)   
-    time.sleep(2100)
+    with vc.transaction(devices):
+        vc.closeValves(devices, bufferValve + buttonValves)
+        vc.openValves(devices, bbsaValve)
+    clock.sleep(2100)
 
     eh.scriptlogger.info('11/18. Done flowing bBSA through devices. \
         Flowing PBS through the device for 10min. **NEXT STEP IS ANTIBODY FLOWING**')
-    vc.closeValves(devices, bbsaValve)
-    vc.openValves(devices, bufferValve)
-    time.sleep(600)
+    with vc.transaction(devices):
+        vc.closeValves(devices, bbsaValve)
+        vc.openValves(devices, bufferValve)
+    clock.sleep(600)
 
     eh.scriptlogger.info('12/18. Done flowing PBS through devices and closed inlet. \
         Flowing Antibody through inlet tree to waste for 30s')
-    vc.closeValves(devices, bufferValve + inletValve)
-    vc.openValves(devices, antibodyValve + wasteValve)
-    time.sleep(30)
+    with vc.transaction(devices):
+        vc.closeValves(devices, bufferValve + inletValve)
+        vc.openValves(devices, antibodyValve + wasteValve)
+    clock.sleep(30)
             
     eh.scriptlogger.info('13/18. Done flowing Antibody through inlet tree. Flowing \
         Antibody through device for 2min')
-    vc.closeValves(devices, wasteValve)
-    vc.openValves(devices, inletValve)
-    time.sleep(120)
+    with vc.transaction(devices):
+        vc.closeValves(devices, wasteValve)
+        vc.openValves(devices, inletValve)
+    clock.sleep(120)
 
     eh.scriptlogger.info('14/18. While flowing Antibody through devices, opened buttons. \
         Flowing for 13.3min')
     vc.openValves(devices, buttonValves)
-    time.sleep(800)
+    clock.sleep(800)
 
     eh.scriptlogger.info('15/18. Closed buttons while flowing Antibody through device for 30s')
     vc.closeValves(devices, buttonValves)
-    time.sleep(30)
+    clock.sleep(30)
 
     eh.scriptlogger.info('16/18. Done flowing Antibody through device. Flowing PBS through \
         inlet tree to waste for 30s')
-    vc.closeValves(devices, antibodyValve + inletValve)
-    vc.openValves(devices, bufferValve + wasteValve)
-    time.sleep(30)      
+    with vc.transaction(devices):
+        vc.closeValves(devices, antibodyValve + inletValve)
+        vc.openValves(devices, bufferValve + wasteValve)
+    clock.sleep(30)      
 
     eh.scriptlogger.info('17/18. Done flowing PBS to waste. Flowing PBS through device for 10min')
-    vc.closeValves(devices, wasteValve)
-    vc.openValves(devices, inletValve)
-    time.sleep(600)
+    with vc.transaction(devices):
+        vc.closeValves(devices, wasteValve)
+        vc.openValves(devices, inletValve)
+    clock.sleep(600)
 
     eh.scriptlogger.info('18/18. Closed the outlets')
     vc.closeValves(devices, outlet)
@@ -199,17 +209,18 @@ def flowSubstrateStartAssay(deviceName, substrateInput, KineticAcquisition,
     eh.scriptlogger.info('The inlet tree wash started for substrate in ' + str(substrateInput))
     vc.returnToSafeState([deviceName])
     vc.openValves([deviceName], [inputValve, 'w'])
-    time.sleep(treeFlushTime)
+    clock.sleep(treeFlushTime)
     eh.scriptlogger.info('The inlet tree wash done for substrate in ' + str(substrateInput))
     
     #Expose chip to substrate, equilibrate for equilibrationTime
     eh.scriptlogger.info('Chip equilibration started for substrate in ' + str(substrateInput))
-    if inputValve == 'w': #For the instance where the waste line is the input
-        pass
-    else:
-        vc.closeValves([deviceName], ['w'])
-    vc.openValves([deviceName], ['in', 'out', 's1', 's2'])
-    time.sleep(equilibrationTime)
+    with vc.transaction([deviceName]):
+        if inputValve == 'w': #For the instance where the waste line is the input
+            pass
+        else:
+            vc.closeValves([deviceName], ['w'])
+        vc.openValves([deviceName], ['in', 'out', 's1', 's2'])
+    clock.sleep(equilibrationTime)
     eh.scriptlogger.info('Chip equilibration done for substrate in ' + str(substrateInput))
 
 
@@ -220,8 +231,8 @@ def flowSubstrateStartAssay(deviceName, substrateInput, KineticAcquisition,
                     deviceName, 
                     KineticAcquisition.note.replace(" ", "_")+'_PreAssay_ButtonQuant', 
                     eh.posLists[deviceName]]
-            kwargs = {wrappingFolder: True}
-            ic.hardwareQueue.put((args, kwargs))
+            kwargs = {'wrappingFolder': True}
+            ic.getScanArbiter().submit(args, kwargs, source = deviceName).result()
         else:
             ic.scan(eh.rootPath, 
                 postEquilibImageChanExp, 
@@ -232,7 +243,7 @@ def flowSubstrateStartAssay(deviceName, substrateInput, KineticAcquisition,
 
     #Close things to prep for assay, and open buttons
     vc.closeValves([deviceName], [substrateInput[:-1], 'in', 'out', 's1', 's2'])
-    time.sleep(0.5)
+    clock.sleep(0.5)
     vc.openValves([deviceName], ['b1', 'b2'])
   
     #Start the assay
@@ -295,7 +306,7 @@ def flushInletTree(deviceNames, inputInlet, vacantInlets, flushTime):
     # Now from close to far, open the valve and wash for the flushTime
     for inlet in sorted(vacantInletsOrganized.keys()):
         vc.openValves(deviceNames, vacantInletsOrganized[inlet])
-        time.sleep(flushTime)
+        clock.sleep(flushTime)
         vc.closeValves(deviceNames, vacantInletsOrganized[inlet])
 
     # Close all the inlets AND the tree inlet (again, make no assumptions)
@@ -0,0 +1,328 @@
+# title             : pathplanning.py
+# description       : Stage path and scan order planning for MicroManager position lists
+# authors           : Daniel Mokhtari
+# credits           :
+# date              : 20201018
+# version update    : 20201018
+# version           : 0.1.1
+# python_version    : 2.7
+
+
+import numpy as np
+
+from runpack import positions
+
+
+################################################################################
+
+
+def _coordinates(position_list):
+	return positions.asPositionList(position_list).xy
+
+
+def _distances(xy, origin):
+	"""Stage travel from one point to many. The XY axes move simultaneously,
+	so travel is the larger of the two axis displacements (Chebyshev)."""
+	return np.abs(xy - origin).max(axis = 1)
+
+
+def pathLength(xy, order, returnHome = True):
+	"""Stage travel of visiting positions in the given order
+
+	Args:
+		xy (np.ndarray): (n, 2) array of stage x, y coordinates
+		order (list | np.ndarray): visiting order of position indices
+		returnHome (bool): flag to include the move back to the first position
+
+	Returns:
+		float: total travel (stage units, typically um)
+	"""
+	path = xy[np.asarray(order, dtype = int)]
+	if returnHome and len(path) > 1:
+		path = np.vstack([path, path[:1]])
+	if len(path) < 2:
+		return 0.0
+	return float(np.abs(np.diff(path, axis = 0)).max(axis = 1).sum())
+
+
+def serpentineOrder(xy, rowTolerance = None):
+	"""Visits positions row by row, alternating x direction on each row
+
+	Args:
+		xy (np.ndarray): (n, 2) array of stage x, y coordinates
+		rowTolerance (float): maximum y difference of positions in the same
+			row. Defaults to half the median y spacing between rows.
+
+	Returns:
+		np.ndarray: visiting order of position indices
+	"""
+	if len(xy) < 2:
+		return np.arange(len(xy))
+	byY = np.argsort(xy[:, 1], kind = 'mergesort')
+	ys = xy[byY, 1]
+	if rowTolerance is None:
+		gaps = np.diff(ys)
+		rowGaps = gaps[gaps > 0]
+		rowTolerance = np.median(rowGaps) / 2.0 if len(rowGaps) else 0.0
+	rowStarts = np.concatenate([[0], np.nonzero(np.diff(ys) > rowTolerance)[0] + 1, [len(ys)]])
+	order = []
+	for r in range(len(rowStarts) - 1):
+		row = byY[rowStarts[r]:rowStarts[r + 1]]
+		row = row[np.argsort(xy[row, 0], kind = 'mergesort')]
+		order.extend(row[::-1] if r % 2 else row)
+	return np.asarray(order, dtype = int)
+
+
+def nearestNeighborOrder(xy, start = 0):
+	"""Greedily visits the closest unvisited position next
+
+	Args:
+		xy (np.ndarray): (n, 2) array of stage x, y coordinates
+		start (int): index of the first position
+
+	Returns:
+		np.ndarray: visiting order of position indices
+	"""
+	n = len(xy)
+	visited = np.zeros(n, dtype = bool)
+	order = [start]
+	visited[start] = True
+	for k in range(n - 1):
+		d = _distances(xy, xy[order[-1]])
+		d[visited] = np.inf
+		nxt = int(np.argmin(d))
+		order.append(nxt)
+		visited[nxt] = True
+	return np.asarray(order, dtype = int)
+
+
+def twoOpt(xy, order, returnHome = True, maxPasses = 20):
+	"""Improves a visiting order by reversing segments that shorten the path
+
+	The first position is kept fixed.
+
+	Args:
+		xy (np.ndarray): (n, 2) array of stage x, y coordinates
+		order (list | np.ndarray): initial visiting order
+		returnHome (bool): flag to optimize the closed path back to the first
+			position rather than an open path
+		maxPasses (int): maximum number of improvement passes
+
+	Returns:
+		np.ndarray: improved visiting order
+	"""
+	order = np.array(order, dtype = int)
+	n = len(order)
+	if n < 4:
+		return order
+	for p in range(maxPasses):
+		improved = False
+		for i in range(1, n - 1):
+			path = xy[order]
+			a, b = path[i - 1], path[i]
+			c = path[i + 1:]
+			if returnHome:
+				d = np.vstack([path[i + 2:], path[:1]])
+			else:
+				d = path[i + 2:]
+			removed = np.abs(a - b).max() + np.abs(c[:len(d)] - d).max(axis = 1)
+			added = _distances(c[:len(d)], a) + _distances(d, b)
+			delta = added - removed
+			if not returnHome:
+				# reversing through the end of an open path drops the c-d edge
+				tail = _distances(c[-1:], a) - np.abs(a - b).max()
+				delta = np.concatenate([delta, tail])
+			j = int(np.argmin(delta))
+			if delta[j] < -1e-9:
+				order[i:i + j + 2] = order[i:i + j + 2][::-1]
+				improved = True
+		if not improved:
+			break
+	return order
+
+
+def planPath(position_list, method = 'serpentine', returnHome = True):
+	"""Computes a low-travel visiting order for a MicroManager position list
+
+	Args:
+		position_list (PositionList | pd.DataFrame): stage xy(z) position list
+		method (str): planning method. 'serpentine' snakes across rows;
+			'nearest' is nearest-neighbor followed by 2-opt
+			('serpentine' | 'nearest')
+		returnHome (bool): flag to count the move back to the first position,
+			as made by home_stage after a scan
+
+	Returns:
+		(np.ndarray, dict): visiting order of position indices, and travel
+			statistics with keys 'original', 'planned', and 'saved'
+			(stage units, typically um)
+	"""
+	xy = _coordinates(position_list)
+	if method == 'serpentine':
+		order = serpentineOrder(xy)
+	elif method == 'nearest':
+		start = int(serpentineOrder(xy)[0]) if len(xy) else 0
+		order = twoOpt(xy, nearestNeighborOrder(xy, start), returnHome = returnHome)
+	else:
+		raise ValueError('Path planning method must be \'serpentine\' or \'nearest\'')
+	original = pathLength(xy, np.arange(len(xy)), returnHome)
+	planned = pathLength(xy, order, returnHome)
+	if planned > original:
+		order, planned = np.arange(len(xy)), original
+	return order, {'original': original, 'planned': planned, 'saved': original - planned}
+
+
+class ScanCostModel:
+	def __init__(self, stageSpeed = 10000.0, stageSettle = 0.05, filterSwitchTime = 0.3, 
+					exposureSetTime = 0.01, frameOverhead = 0.05):
+		"""Predicts scan duration from stage travel, filter switches, 
+		exposure changes, and frame acquisition
+
+		Args:
+			stageSpeed (float): XY stage speed (um/s)
+			stageSettle (float): stage settling time per move (s)
+			filterSwitchTime (float): time per Channel change, including the 
+				wait for the filter block (s)
+			exposureSetTime (float): time per camera exposure change (s)
+			frameOverhead (float): per-frame snap, readout, and save overhead 
+				beyond the exposure itself (s)
+
+		Returns:
+			None
+		"""
+		self.stageSpeed = stageSpeed
+		self.stageSettle = stageSettle
+		self.filterSwitchTime = filterSwitchTime
+		self.exposureSetTime = exposureSetTime
+		self.frameOverhead = frameOverhead
+
+
+	@classmethod
+	def fromConfig(cls, settings):
+		"""Builds a cost model from the 'cost_model' imaging config, if any
+
+		Args:
+			settings (dict): 'imaging' software config
+
+		Returns:
+			ScanCostModel: the cost model
+		"""
+		cm = settings.get('cost_model', {})
+		return cls(stageSpeed = cm.get('stage_speed', 10000.0), 
+					stageSettle = cm.get('stage_settle', 0.05), 
+					filterSwitchTime = cm.get('filter_switch_time', 0.3), 
+					exposureSetTime = cm.get('exposure_set_time', 0.01), 
+					frameOverhead = cm.get('frame_overhead', 0.05))
+
+
+	def predict(self, xy, steps, channelsExposures, homeStage = True):
+		"""Predicts the duration of a scan
+
+		Args:
+			xy (np.ndarray): (n, 2) array of stage x, y coordinates
+			steps (list): (position index, channel) pairs in acquisition order
+			channelsExposures (dict): channels mapped to exposure lists (ms)
+			homeStage (bool): flag to include the move back to the first 
+				position of the position list
+
+		Returns:
+			float: predicted scan duration (s)
+		"""
+		duration = 0.0
+		position, channel, exposure = None, None, None
+		for i, ch in steps:
+			if i != position:
+				if position is not None:
+					duration += np.abs(xy[i] - xy[position]).max() / self.stageSpeed
+				duration += self.stageSettle
+				position = i
+			if ch != channel:
+				duration += self.filterSwitchTime
+				channel = ch
+			for e in channelsExposures[ch]:
+				if e != exposure:
+					duration += self.exposureSetTime
+					exposure = e
+				duration += e / 1000.0 + self.frameOverhead
+		if homeStage and position is not None and len(xy):
+			duration += np.abs(xy[0] - xy[position]).max() / self.stageSpeed + self.stageSettle
+		return duration
+
+
+
+def scanSteps(visitOrder, channels, order = 'position', blockSize = 1):
+	"""Sequences the (position, channel) steps of a scan
+
+	'position' images every channel at a position before moving on. 
+	'channel' visits every position for one channel before switching, 
+	alternating direction between channels. 'hybrid' does the same within 
+	consecutive blocks of blockSize positions.
+
+	Args:
+		visitOrder (list): position indices in visiting order
+		channels (list): channels in acquisition order
+		order (str): scan order ('position' | 'channel' | 'hybrid')
+		blockSize (int): positions per block for 'hybrid'
+
+	Returns:
+		list: (position index, channel) pairs in acquisition order
+	"""
+	visitOrder = list(visitOrder)
+	if order == 'position':
+		return [(i, ch) for i in visitOrder for ch in channels]
+	if order == 'channel':
+		blockSize = max(len(visitOrder), 1)
+	elif order != 'hybrid':
+		raise ValueError('Scan order must be \'position\', \'channel\', \'hybrid\', or \'auto\'')
+	steps = []
+	for start in range(0, len(visitOrder), blockSize):
+		block = visitOrder[start:start + blockSize]
+		for k, ch in enumerate(channels):
+			steps.extend((i, ch) for i in (block if k % 2 == 0 else block[::-1]))
+	return steps
+
+
+def planScanOrder(xy, visitOrder, channelsExposures, model, order = 'auto', homeStage = True):
+	"""Chooses the scan order with the lowest predicted duration
+
+	For 'hybrid', block sizes of 2, 4, 8, ... positions are compared. For 
+	'auto', position-major, channel-major, and every hybrid are compared.
+
+	Args:
+		xy (np.ndarray): (n, 2) array of stage x, y coordinates
+		visitOrder (list): position indices in visiting order
+		channelsExposures (dict): channels mapped to exposure lists (ms)
+		model (ScanCostModel): cost model
+		order (str): requested scan order ('position' | 'channel' | 
+			'hybrid' | 'auto')
+		homeStage (bool): flag to include the move home after the scan
+
+	Returns:
+		(list, str, float): (position index, channel) steps, the chosen 
+			order, and its predicted duration (s)
+	"""
+	channels = list(channelsExposures.keys())
+	visitOrder = list(visitOrder)
+	candidates = []
+	if order in ('position', 'auto') or len(channels) < 2:
+		candidates.append(('position', 1))
+	if order in ('channel', 'auto') and len(channels) > 1:
+		candidates.append(('channel', len(visitOrder)))
+	if order in ('hybrid', 'auto') and len(channels) > 1:
+		blockSize = 2
+		while blockSize < len(visitOrder):
+			candidates.append(('hybrid', blockSize))
+			blockSize *= 2
+		if order == 'hybrid' and len(candidates) == 0:
+			candidates.append(('channel', len(visitOrder)))
+	if not candidates:
+		raise ValueError('Scan order must be \'position\', \'channel\', \'hybrid\', or \'auto\'')
+
+	best = None
+	for name, blockSize in candidates:
+		steps = scanSteps(visitOrder, channels, name, blockSize)
+		predicted = model.predict(xy, steps, channelsExposures, homeStage)
+		if best is None or predicted < best[2]:
+			label = name if name != 'hybrid' else 'hybrid-{}'.format(blockSize)
+			best = (steps, label, predicted)
+	return best
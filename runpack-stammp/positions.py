@@ -0,0 +1,114 @@
+# title             : positions.py
+# description       : Array-backed MicroManager stage position lists
+# authors           : Daniel Mokhtari
+# credits           :
+# date              : 20201018
+# version update    : 20201018
+# version           : 0.1.1
+# python_version    : 2.7
+
+
+import numpy as np
+import pandas as pd
+
+
+################################################################################
+
+
+class PositionList:
+	def __init__(self, x, y, z = None, names = None):
+		"""Stage position list held as contiguous NumPy arrays
+
+		Indexing an array element is far cheaper than a pandas iloc lookup,
+		so acquisition loops read positions from here rather than from the
+		position list DataFrame.
+
+		Args:
+			x (array-like): stage x coordinates
+			y (array-like): stage y coordinates
+			z (array-like | None): focus z coordinates, if any
+			names (array-like | None): position names. Defaults to the
+				position indices.
+
+		Returns:
+			None
+		"""
+		self.x = np.ascontiguousarray(x, dtype = float)
+		self.y = np.ascontiguousarray(y, dtype = float)
+		self.z = None if z is None else np.ascontiguousarray(z, dtype = float)
+		if names is None:
+			names = [str(i) for i in range(len(self.x))]
+		self.names = np.array([str(n) for n in names], dtype = object)
+		self.xy = np.ascontiguousarray(np.column_stack([self.x, self.y]))
+		if not len(self.x) == len(self.y) == len(self.names) or \
+				(self.z is not None and len(self.z) != len(self.x)):
+			raise ValueError('Position list coordinates and names must have equal lengths')
+
+
+	@classmethod
+	def fromDataFrame(cls, df):
+		"""Builds a PositionList from a position list DataFrame, as returned by
+		acqpack.utils.load_mm_positionlist
+
+		Args:
+			df (pd.DataFrame): position list with 'x', 'y', and optional 'z'
+				and 'name' columns
+
+		Returns:
+			PositionList: the position list
+		"""
+		z = df['z'].values if 'z' in df.columns else None
+		names = df['name'].values if 'name' in df.columns else None
+		return cls(df['x'].values, df['y'].values, z, names)
+
+
+	def toDataFrame(self):
+		"""Returns the position list as a DataFrame
+
+		Args:
+			None
+
+		Returns:
+			pd.DataFrame: position list with 'name', 'x', 'y' (and 'z') columns
+		"""
+		columns = [('name', self.names), ('x', self.x), ('y', self.y)]
+		if self.z is not None:
+			columns.append(('z', self.z))
+		return pd.DataFrame(dict(columns), columns = [c[0] for c in columns])
+
+
+	def take(self, order):
+		"""Returns a position list reordered by position indices
+
+		Args:
+			order (array-like): position indices in the new order
+
+		Returns:
+			PositionList: the reordered position list
+		"""
+		order = np.asarray(order, dtype = int)
+		z = None if self.z is None else self.z[order]
+		return PositionList(self.x[order], self.y[order], z, self.names[order])
+
+
+	def __len__(self):
+		return len(self.x)
+
+
+	def __repr__(self):
+		return 'PositionList({} positions{})'.format(len(self), ', xyz' if self.z is not None else '')
+
+
+
+def asPositionList(position_list):
+	"""Returns a position list as a PositionList, converting a DataFrame
+
+	Args:
+		position_list (PositionList | pd.DataFrame): stage xy(z) position list
+
+	Returns:
+		PositionList: the position list
+	"""
+	if isinstance(position_list, PositionList):
+		return position_list
+	return PositionList.fromDataFrame(position_list)
@@ -0,0 +1,144 @@
+# title             : profiling.py
+# description       : Per-phase timing profiles of RunPack scans
+# authors           : Daniel Mokhtari
+# credits           :
+# date              : 20201018
+# version update    : 20201018
+# version           : 0.1.1
+# python_version    : 2.7
+
+
+import json
+from collections import defaultdict
+
+import numpy as np
+
+from runpack import clock
+
+
+################################################################################
+
+
+phases = ['xy_move', 'z_move', 'channel_switch', 'exposure_set', 'snap', 'get_image',
+			'submit', 'save']
+
+
+
+class ScanProfiler:
+	enabled = True
+
+	def __init__(self):
+		"""Collects the duration of each phase of a scan, per occurrence
+
+		Instrumented code times a phase with start() and stop(). With the
+		real clock active, phases are timed with the high-resolution
+		clock.counter(), and otherwise on the simulated clock. Phases are
+		typically 'xy_move', 'z_move', 'channel_switch', 'exposure_set',
+		'snap', 'get_image', 'submit' (waiting on the frame writer), and
+		'save' (frame encode and write, timed on the writer threads, and not
+		recorded by process writer pools). Stage settling is part of the
+		move phases. Under a VirtualClock, 'save' also counts virtual time
+		advanced meanwhile by the acquisition thread.
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		self.samples = defaultdict(list)
+		self.timer = clock.counter if isinstance(clock.getClock(), clock.RealClock) else clock.monotonic
+
+
+	def start(self):
+		"""Returns the start time of a phase"""
+		return self.timer()
+
+
+	def stop(self, phase, started):
+		"""Records a phase begun at started (see start())"""
+		self.samples[phase].append(self.timer() - started) # list.append is thread-safe
+
+
+	def add(self, phase, seconds):
+		"""Records a phase duration (s) measured elsewhere"""
+		self.samples[phase].append(seconds)
+
+
+	def summary(self):
+		"""Summarizes the recorded durations of each phase
+
+		Args:
+			None
+
+		Returns:
+			dict: phases mapped to dicts of 'count', and 'mean_s', 'p95_s',
+				'max_s', and 'total_s' durations
+		"""
+		summary = {}
+		order = phases + sorted(set(self.samples) - set(phases))
+		for phase in order:
+			durations = np.asarray(self.samples.get(phase, []))
+			if not len(durations):
+				continue
+			summary[phase] = {'count': len(durations), 'mean_s': durations.mean(),
+								'p95_s': np.percentile(durations, 95), 'max_s': durations.max(),
+								'total_s': durations.sum()}
+		return summary
+
+
+	def write(self, path, **info):
+		"""Writes the phase summary to a JSON sidecar file
+
+		Args:
+			path (str): sidecar path
+			**info: scan details to include (e.g. dname, note, duration)
+
+		Returns:
+			dict: the written profile
+		"""
+		profile = dict(info, phases = self.summary())
+		with open(path, 'w') as f:
+			json.dump(profile, f, indent = 2, sort_keys = True)
+		return profile
+
+
+
+class NullProfiler:
+	"""Profiler doing nothing, active when profiling is off. See ScanProfiler."""
+	enabled = False
+
+	def start(self):
+		return 0.0
+
+
+	def stop(self, phase, started):
+		pass
+
+
+	def add(self, phase, seconds):
+		pass
+
+
+
+nullProfiler = NullProfiler()
+active = nullProfiler # profiler of the running scan
+
+
+def activate(profiler):
+	"""Makes a profiler receive the timings of instrumented code
+
+	Args:
+		profiler (ScanProfiler): the profiler
+
+	Returns:
+		None
+	"""
+	global active
+	active = profiler
+
+
+def deactivate():
+	"""Turns profiling off"""
+	global active
+	active = nullProfiler
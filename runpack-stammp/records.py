@@ -0,0 +1,322 @@
+# title             : records.py
+# description       : Columnar acquisition records with CSV and Parquet storage
+# authors           : Daniel Mokhtari
+# credits           :
+# date              : 20201018
+# version update    : 20201018
+# version           : 0.1.1
+# python_version    : 2.7
+
+
+import os
+import csv
+import time
+import uuid
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = pq = None
+
+
+################################################################################
+
+
+imagingColumns = [('raster_start_time', object), ('scan_params', object),
+					('channel', object), ('exposure_ms', np.float64),
+					('image_path', object), ('raster_index', np.int64),
+					('x', np.float64), ('y', np.float64), ('dname', object),
+					('frame_time', object), ('temperature', np.float64),
+					('humidity', np.float64), ('note', object), ('setup', object),
+					('experimental_desc', object), ('scan_order', object),
+					('pipelined', np.bool_), ('acquisition_mode', object),
+					('stage_wait_s', np.float64), ('channel_wait_s', np.float64),
+					('snap_s', np.float64), ('readout_s', np.float64),
+					('predicted_duration_s', np.float64),
+					('scan_duration_s', np.float64), ('timepoint', np.int64),
+					('requested_start_s', np.float64),
+					('actual_start_s', np.float64),
+					('start_jitter_s', np.float64)]
+
+burstColumns = [('raster_start_time', object), ('channel', object),
+				('exposure_ms', np.float64), ('image_path', object),
+				('frame_index', np.int64), ('frame_offset_s', np.float64),
+				('dname', object), ('frame_time', object), ('note', object),
+				('setup', object), ('experimental_desc', object),
+				('acquisition_mode', object), ('snap_s', np.float64),
+				('readout_s', np.float64)]
+
+environmentColumns = [('sample_time', object), ('timestamp', np.float64),
+						('temperature', np.float64), ('humidity', np.float64),
+						('setup', object)]
+
+_missing = {np.dtype(np.float64): np.nan, np.dtype(np.int64): -1,
+			np.dtype(np.bool_): False, np.dtype(object): None}
+
+
+def _arrowType(dtype):
+	return {np.dtype(np.float64): pa.float64(), np.dtype(np.int64): pa.int64(),
+			np.dtype(np.bool_): pa.bool_()}.get(np.dtype(dtype), pa.string())
+
+
+def arrowSchema(columns):
+	"""Returns the Arrow schema of a record column specification
+
+	Args:
+		columns (list): (name, dtype) column specification
+
+	Returns:
+		pyarrow.Schema: the schema
+	"""
+	_requireArrow()
+	return pa.schema([pa.field(name, _arrowType(dtype)) for name, dtype in columns])
+
+
+def parquetAvailable():
+	"""Returns True if pyarrow is installed for Parquet records"""
+	return pa is not None
+
+
+def _requireArrow():
+	if pa is None:
+		raise ImportError('Parquet records require pyarrow (pip install pyarrow)')
+
+
+
+class RecordBuilder:
+	def __init__(self, columns, capacity = 256):
+		"""Accumulates acquisition records in typed, preallocated columns
+
+		Values shared by every record (e.g. scan parameters) are set once
+		with setConstants rather than per record. Columns grow by doubling
+		if capacity is exceeded.
+
+		Args:
+			columns (list): (name, dtype) column specification
+				(e.g. imagingColumns)
+			capacity (int): number of records to preallocate
+
+		Returns:
+			None
+		"""
+		self.columns = OrderedDict((name, np.dtype(dtype)) for name, dtype in columns)
+		self.capacity = max(int(capacity), 1)
+		self.size = 0
+		self.constants = {}
+		self.data = {name: self._empty(dtype, self.capacity) for name, dtype in self.columns.items()}
+
+
+	def _empty(self, dtype, n):
+		return np.full(n, _missing[dtype], dtype = dtype)
+
+
+	def _grow(self):
+		for name, dtype in self.columns.items():
+			self.data[name] = np.concatenate([self.data[name], self._empty(dtype, self.capacity)])
+		self.capacity *= 2
+
+
+	def append(self, **fields):
+		"""Appends a record
+
+		Args:
+			**fields: column values of the record. Missing columns are left
+				empty (NaN, -1, False, or None by type).
+
+		Returns:
+			None
+		"""
+		if self.size == self.capacity:
+			self._grow()
+		for name, value in fields.items():
+			self.data[name][self.size] = value
+		self.size += 1
+
+
+	def setConstants(self, **fields):
+		"""Sets column values shared by every record
+
+		Args:
+			**fields: column values
+
+		Returns:
+			None
+		"""
+		self.constants.update(fields)
+
+
+	def __len__(self):
+		return self.size
+
+
+	def toDataFrame(self):
+		"""Returns the records as a DataFrame with typed columns
+
+		Args:
+			None
+
+		Returns:
+			pd.DataFrame: the records
+		"""
+		data = OrderedDict()
+		for name, dtype in self.columns.items():
+			if name in self.constants:
+				column = self._empty(dtype, self.size)
+				column[:] = self.constants[name]
+				data[name] = column
+			else:
+				data[name] = self.data[name][:self.size]
+		return pd.DataFrame(data, columns = list(self.columns))
+
+
+
+def appendCsv(record, path):
+	"""Appends records to a CSV, aligning columns to an existing header
+
+	Columns the existing CSV lacks are dropped with a warning.
+
+	Args:
+		record (pd.DataFrame): records
+		path (str): CSV path
+
+	Returns:
+		None
+	"""
+	exists = os.path.isfile(path)
+	if exists:
+		with open(path) as f:
+			header = next(csv.reader(f), [''])[1:]
+		dropped = [c for c in record.columns if c not in header]
+		if dropped:
+			warnings.warn('Columns {} are not in {} and were not recorded'.format(dropped, path))
+		record = record.reindex(columns = header)
+	with open(path, 'a+') as f:
+		record.to_csv(f, header = not exists)
+
+
+def appendParquet(record, datasetPath, columns = None):
+	"""Appends records to a Parquet dataset as a new row group file
+
+	The file is written under a temporary name and renamed into place, so
+	readers never see a partial file.
+
+	Args:
+		record (pd.DataFrame): records
+		datasetPath (str): Parquet dataset directory
+		columns (list): (name, dtype) column specification fixing the
+			dataset schema. Defaults to the types inferred from record.
+
+	Returns:
+		str: path of the written file
+	"""
+	_requireArrow()
+	if not os.path.isdir(datasetPath):
+		os.makedirs(datasetPath)
+	if columns is not None:
+		record = record.reindex(columns = [name for name, dtype in columns])
+		table = pa.Table.from_pandas(record, schema = arrowSchema(columns), preserve_index = False)
+	else:
+		table = pa.Table.from_pandas(record, preserve_index = False)
+	name = 'part-{:.6f}-{}.parquet'.format(time.time(), uuid.uuid4().hex[:8]) # sorts in write order
+	path = os.path.join(datasetPath, name)
+	pq.write_table(table, path + '.tmp', row_group_size = max(len(record), 1))
+	os.rename(path + '.tmp', path)
+	return path
+
+
+def appendRecord(record, root, name = 'imaging', fmt = 'csv', columns = None):
+	"""Appends records to an experiment record in the experimental root
+
+	Args:
+		record (pd.DataFrame): records
+		root (str): experimental root path
+		name (str): record name (e.g. 'imaging' | 'bursts')
+		fmt (str): record format. 'csv' appends to <name>.csv; 'parquet'
+			appends a row group to the <name>.parquet dataset directory.
+		columns (list): (name, dtype) column specification for Parquet
+
+	Returns:
+		None
+	"""
+	if fmt == 'csv':
+		appendCsv(record, os.path.join(root, '{}.csv'.format(name)))
+	elif fmt == 'parquet':
+		appendParquet(record, os.path.join(root, '{}.parquet'.format(name)), columns)
+	else:
+		raise ValueError('Record format must be \'csv\' or \'parquet\'')
+
+
+def readRecord(root, name = 'imaging', columns = None):
+	"""Reads an experiment record, combining its Parquet dataset and CSV
+
+	Args:
+		root (str): experimental root path
+		name (str): record name (e.g. 'imaging' | 'bursts')
+		columns (list): column names to read. Defaults to all.
+
+	Returns:
+		pd.DataFrame: the record
+	"""
+	parts = []
+	datasetPath = os.path.join(root, '{}.parquet'.format(name))
+	if os.path.isdir(datasetPath) and any(f.endswith('.parquet') for f in os.listdir(datasetPath)):
+		_requireArrow()
+		files = sorted(os.path.join(datasetPath, f) for f in os.listdir(datasetPath) if f.endswith('.parquet'))
+		parts.extend(pq.read_table(f, columns = columns).to_pandas() for f in files)
+	csvPath = os.path.join(root, '{}.csv'.format(name))
+	if os.path.isfile(csvPath):
+		record = pd.read_csv(csvPath, index_col = 0)
+		parts.append(record if columns is None else record.reindex(columns = columns))
+	if not parts:
+		return pd.DataFrame(columns = columns)
+	return pd.concat(parts, ignore_index = True)
+
+
+def convertCsvRecord(csvPath, datasetPath = None, columns = imagingColumns, chunksize = 100000, 
+						archive = True):
+	"""Converts a CSV record (e.g. an existing imaging.csv) to a Parquet dataset
+
+	The CSV is read in chunks, so large records are converted in bounded
+	memory. Each chunk becomes one row group file. Columns in the
+	specification are coerced to their types. Other columns are kept as
+	strings. The CSV is then renamed to <csvPath>.converted so that 
+	readRecord does not count its records twice.
+
+	Args:
+		csvPath (str): CSV record path
+		datasetPath (str): Parquet dataset directory. Defaults to the CSV
+			path with a .parquet extension.
+		columns (list): (name, dtype) column specification
+		chunksize (int): rows per chunk
+		archive (bool): flag to rename the CSV once converted
+
+	Returns:
+		int: number of records converted
+	"""
+	_requireArrow()
+	if datasetPath is None:
+		datasetPath = os.path.splitext(csvPath)[0] + '.parquet'
+	known = OrderedDict(columns)
+	converted = 0
+	for chunk in pd.read_csv(csvPath, index_col = 0, chunksize = chunksize, dtype = object):
+		spec = [(name, known[name]) for name in known if name in chunk.columns]
+		spec += [(name, object) for name in chunk.columns if name not in known]
+		for name, dtype in spec:
+			dtype = np.dtype(dtype)
+			if dtype == np.dtype(np.bool_):
+				chunk[name] = chunk[name].map({'True': True, 'False': False}).fillna(False).astype(bool)
+			elif dtype == np.dtype(np.int64):
+				chunk[name] = pd.to_numeric(chunk[name], errors = 'coerce').fillna(-1).astype(np.int64)
+			elif dtype != np.dtype(object):
+				chunk[name] = pd.to_numeric(chunk[name], errors = 'coerce')
+		appendParquet(chunk.reset_index(drop = True), datasetPath, spec)
+		converted += len(chunk)
+	if archive:
+		os.rename(csvPath, csvPath + '.converted')
+	return converted
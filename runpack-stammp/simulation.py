@@ -0,0 +1,506 @@
+# title             : simulation.py
+# description       : In-memory simulated hardware for off-rig RunPack runs
+# authors           : Daniel Mokhtari
+# credits           :
+# date              : 20201018
+# version update    : 20201018
+# version           : 0.1.1
+# python_version    : 2.7
+
+
+import numpy as np
+import pandas as pd
+
+from runpack import clock
+
+
+################################################################################
+
+
+class SimulatedModbusResponse:
+	def __init__(self, bits = None):
+		"""Minimal pymodbus response
+
+		Args:
+			bits (list): coil states read, if any
+
+		Returns:
+			None
+		"""
+		self.bits = bits
+
+
+	def isError(self):
+		return False
+
+
+
+class SimulatedModbusClient:
+	def __init__(self, numCoils = 1024, writeLatency = 0.002):
+		"""In-memory stand-in for the WAGO Modbus TCP client
+
+		Every request, single or multi-coil, costs one round trip of
+		writeLatency seconds.
+
+		Args:
+			numCoils (int): number of addressable coils
+			writeLatency (float): simulated round trip time per request (s)
+
+		Returns:
+			None
+		"""
+		self.coils = [False] * numCoils
+		self.writeLatency = writeLatency
+		self.requests = 0
+
+
+	def _roundTrip(self):
+		self.requests += 1
+		if self.writeLatency:
+			clock.sleep(self.writeLatency)
+
+
+	def read_coils(self, address, count = 1, **kwargs):
+		self._roundTrip()
+		bits = self.coils[address:address + count]
+		return SimulatedModbusResponse(bits + [False] * (-len(bits) % 8)) # bits arrive padded to a byte
+
+
+	def write_coil(self, address, value, **kwargs):
+		self._roundTrip()
+		self.coils[address] = bool(value)
+		return SimulatedModbusResponse()
+
+
+	def write_coils(self, address, values, **kwargs):
+		self._roundTrip()
+		self.coils[address:address + len(values)] = [bool(v) for v in values]
+		return SimulatedModbusResponse()
+
+
+	def close(self):
+		pass
+
+
+
+class SimulatedManifold:
+	def __init__(self, valvemapPath, offset = 512, writeLatency = 0.002):
+		"""In-memory stand-in for the acqpack WAGO Manifold
+
+		Args:
+			valvemapPath (str): valvemap CSV path
+			offset (int): WAGO coil address of valvemap offset 0
+			writeLatency (float): simulated round trip time per request (s)
+
+		Returns:
+			None
+		"""
+		self.valvemap = pd.read_csv(valvemapPath, index_col = 0)
+		self.offset = offset
+		self.client = SimulatedModbusClient(offset + len(self.valvemap) + 1, writeLatency)
+
+
+	def get_address(self, lookup_col, name):
+		matches = self.valvemap.index[self.valvemap[lookup_col] == name]
+		if len(matches) == 0:
+			raise ValueError('Valve {} not found in valvemap column {}'.format(name, lookup_col))
+		return self.offset + int(matches[0])
+
+
+	def read_valve(self, lookup_col, name):
+		return self.client.read_coils(self.get_address(lookup_col, name)).bits[0]
+
+
+	def pressurize(self, lookup_col, name):
+		self.client.write_coil(self.get_address(lookup_col, name), True)
+
+
+	def depressurize(self, lookup_col, name):
+		self.client.write_coil(self.get_address(lookup_col, name), False)
+
+
+	def open(self, lookup_col, name):
+		self.depressurize(lookup_col, name)
+
+
+	def close(self, lookup_col, name):
+		self.pressurize(lookup_col, name)
+
+
+	def exit(self):
+		self.client.close()
+
+
+
+class SimulatedConfiguration:
+	def __init__(self, settings):
+		"""Minimal MMCorePy.Configuration
+
+		Args:
+			settings (list): (device, property, value) tuples
+
+		Returns:
+			None
+		"""
+		self.settings = [SimulatedPropertySetting(*setting) for setting in settings]
+
+
+	def size(self):
+		return len(self.settings)
+
+
+	def getSetting(self, i):
+		return self.settings[i]
+
+
+
+class SimulatedPropertySetting:
+	def __init__(self, device, name, value):
+		"""Minimal MMCorePy.PropertySetting
+
+		Args:
+			device (str): device label
+			name (str): property name
+			value (str): property value
+
+		Returns:
+			None
+		"""
+		self.device = device
+		self.name = name
+		self.value = value
+
+
+	def getDeviceLabel(self):
+		return self.device
+
+
+	def getPropertyName(self):
+		return self.name
+
+
+	def getPropertyValue(self):
+		return self.value
+
+
+
+class SimulatedCore:
+	camera = 'SimCamera'
+	xyStage = 'SimXYStage'
+	focus = 'SimZStage'
+
+	def __init__(self, filterBlockName = 'SimFilterBlock', channels = None,
+				imageShape = (512, 512), stageSpeed = 10000.0, stageSettle = 0.05,
+				focusSpeed = 1000.0, filterSwitchTime = 0.3, exposureSetTime = 0.01,
+				readoutTime = 0.03, exposureSequencing = True):
+		"""In-memory stand-in for MMCorePy.CMMCore
+
+		Implements the subset of the core used by RunPack. Delays run on the
+		active runpack clock. Device moves and
+		switches run in the background: a command marks its device busy for
+		the simulated duration and waitForDevice/waitForSystem block until it
+		is idle. Snapped images are synthetic 16-bit frames. Sequence 
+		acquisitions overlap readout with the next exposure, so each frame 
+		takes the longer of its exposure and the readout time.
+
+		Args:
+			filterBlockName (str): name of the filter block device
+			channels (list): Channel group presets
+			imageShape (tuple): unbinned frame shape (rows, columns)
+			stageSpeed (float): XY stage speed (um/s)
+			stageSettle (float): XY stage settling time after a move (s)
+			focusSpeed (float): focus drive speed (um/s)
+			filterSwitchTime (float): time to switch filter block position (s)
+			exposureSetTime (float): time to apply a camera exposure change (s)
+			readoutTime (float): camera readout time per frame (s)
+			exposureSequencing (bool): flag for camera support of hardware 
+				exposure sequences
+
+		Returns:
+			None
+		"""
+		self.filterBlock = filterBlockName
+		self.channels = list(channels or [])
+		self.imageShape = imageShape
+		self.stageSpeed = stageSpeed
+		self.stageSettle = stageSettle
+		self.focusSpeed = focusSpeed
+		self.filterSwitchTime = filterSwitchTime
+		self.exposureSetTime = exposureSetTime
+		self.readoutTime = readoutTime
+		self.exposureSequencing = exposureSequencing
+
+		self.properties = {self.camera: {'Exposure': 10.0, 'Binning': '1x1'}}
+		self.configs = {'Channel': self.channels[0] if self.channels else ''}
+		self.xy = (0.0, 0.0)
+		self.z = 0.0
+		self.busyUntil = {}
+		self.timeoutMs = 5000
+		self.image = None
+		self.framesSnapped = 0
+		self.baseFrame = None
+		self.sequence = [] # (ready time, frame) of frames not yet popped
+		self.sequenceEnd = 0
+		self.exposureSequence = None
+		self.exposureSequenceLoaded = []
+
+
+	def _busy(self, device, duration):
+		self.busyUntil[device] = max(self.busyUntil.get(device, 0), clock.now()) + duration
+
+
+	def _wait(self, devices):
+		remaining = max([self.busyUntil.get(d, 0) for d in devices] + [0]) - clock.now()
+		if remaining > 0:
+			clock.sleep(remaining)
+
+
+	def loadSystemConfiguration(self, path):
+		pass
+
+
+	def setTimeoutMs(self, timeoutMs):
+		self.timeoutMs = timeoutMs
+
+
+	def unloadAllDevices(self):
+		pass
+
+
+	def reset(self):
+		self.busyUntil = {}
+
+
+	def getCameraDevice(self):
+		return self.camera
+
+
+	def getXYStageDevice(self):
+		return self.xyStage
+
+
+	def getFocusDevice(self):
+		return self.focus
+
+
+	def getProperty(self, device, name):
+		return str(self.properties.get(device, {})[name])
+
+
+	def setProperty(self, device, name, value):
+		self.properties.setdefault(device, {})[name] = value
+		if device == self.camera and name == 'Exposure':
+			self._busy(device, self.exposureSetTime)
+
+
+	def getCurrentConfig(self, group):
+		return self.configs.get(group, '')
+
+
+	def setConfig(self, group, config):
+		if self.configs.get(group) != config and group == 'Channel':
+			self._busy(self.filterBlock, self.filterSwitchTime)
+		self.configs[group] = config
+
+
+	def getConfigData(self, group, config):
+		if group == 'Channel':
+			return SimulatedConfiguration([(self.filterBlock, 'Label', config)])
+		return SimulatedConfiguration([])
+
+
+	def getXYPosition(self):
+		return self.xy
+
+
+	def getXPosition(self, device = None):
+		return self.xy[0]
+
+
+	def getYPosition(self, device = None):
+		return self.xy[1]
+
+
+	def setXYPosition(self, *args):
+		x, y = float(args[-2]), float(args[-1])
+		distance = max(abs(x - self.xy[0]), abs(y - self.xy[1]))
+		self.xy = (x, y)
+		self._busy(self.xyStage, distance / self.stageSpeed + self.stageSettle)
+
+
+	def getPosition(self, device = None):
+		return self.z
+
+
+	def setPosition(self, *args):
+		z = float(np.asarray(args[-1]).ravel()[0])
+		distance = abs(z - self.z)
+		self.z = z
+		self._busy(self.focus, distance / self.focusSpeed)
+
+
+	def deviceBusy(self, device):
+		return self.busyUntil.get(device, 0) > clock.now()
+
+
+	def systemBusy(self):
+		return any(self.deviceBusy(d) for d in self.busyUntil)
+
+
+	def waitForDevice(self, device):
+		self._wait([device])
+
+
+	def waitForSystem(self):
+		self._wait(list(self.busyUntil))
+
+
+	def getImageWidth(self):
+		return self._shape()[1]
+
+
+	def getImageHeight(self):
+		return self._shape()[0]
+
+
+	def getBytesPerPixel(self):
+		return 2
+
+
+	def getImageBitDepth(self):
+		return 16
+
+
+	def _shape(self):
+		binning = int(str(self.properties[self.camera].get('Binning', '1x1')).split('x')[0])
+		return (self.imageShape[0] // binning, self.imageShape[1] // binning)
+
+
+	def _frame(self, exposure = None):
+		shape = self._shape()
+		if self.baseFrame is None or self.baseFrame.shape != shape:
+			rng = np.random.RandomState(0)
+			self.baseFrame = rng.randint(500, 1500, size = shape).astype(np.uint16)
+		if exposure is None:
+			exposure = float(self.properties[self.camera]['Exposure'])
+		signal = int(min(exposure, 1000.0) * 20 + self.framesSnapped % 64)
+		return self.baseFrame + np.uint16(signal)
+
+
+	def snapImage(self):
+		self.waitForDevice(self.camera)
+		clock.sleep(float(self.properties[self.camera]['Exposure']) / 1000.0)
+		self.image = self._frame()
+		self.framesSnapped += 1
+		self._busy(self.camera, self.readoutTime)
+
+
+	def getImage(self):
+		self.waitForDevice(self.camera)
+		if self.image is None:
+			raise RuntimeError('No image has been snapped')
+		return self.image
+
+
+	def isExposureSequenceable(self, camera):
+		return self.exposureSequencing
+
+
+	def loadExposureSequence(self, camera, exposures):
+		if not self.exposureSequencing:
+			raise RuntimeError('Camera exposure is not sequenceable')
+		self.exposureSequenceLoaded = [float(e) for e in exposures]
+
+
+	def startExposureSequence(self, camera):
+		self.exposureSequence = list(self.exposureSequenceLoaded)
+
+
+	def stopExposureSequence(self, camera):
+		if self.exposureSequence:
+			self.properties[self.camera]['Exposure'] = self.exposureSequence[-1]
+		self.exposureSequence = None
+
+
+	def startSequenceAcquisition(self, numImages, intervalMs, stopOnOverflow):
+		self.waitForDevice(self.camera)
+		if self.exposureSequence:
+			exposures = [self.exposureSequence[k % len(self.exposureSequence)] for k in range(numImages)]
+		else:
+			exposures = [float(self.properties[self.camera]['Exposure'])] * numImages
+		ready = clock.now()
+		self.sequence = []
+		for exposure in exposures:
+			ready += max(exposure / 1000.0, self.readoutTime, intervalMs / 1000.0)
+			self.sequence.append((ready, self._frame(exposure)))
+			self.framesSnapped += 1
+		self.sequenceEnd = ready
+		self.busyUntil[self.camera] = ready
+
+
+	def isSequenceRunning(self):
+		return self.sequenceEnd > clock.now()
+
+
+	def getRemainingImageCount(self):
+		now = clock.now()
+		return sum(1 for ready, frame in self.sequence if ready <= now)
+
+
+	def popNextImage(self):
+		if not self.sequence or self.sequence[0][0] > clock.now():
+			raise RuntimeError('Circular buffer is empty')
+		return self.sequence.pop(0)[1]
+
+
+	def stopSequenceAcquisition(self):
+		now = clock.now()
+		self.sequence = [(ready, frame) for ready, frame in self.sequence if ready <= now]
+		self.sequenceEnd = min(self.sequenceEnd, now)
+		self.busyUntil[self.camera] = min(self.busyUntil.get(self.camera, 0), now)
+
+
+
+class SimulatedTemperatureProbe:
+	def __init__(self, temperature = 22.0, humidity = 40.0, queryLatency = 0.02):
+		"""In-memory stand-in for the Thorlabs TSP01 TemperatureProbe
+
+		Readings drift slowly around the given values.
+
+		Args:
+			temperature (float): mean temperature (celcius)
+			humidity (float): mean relative humidity (%)
+			queryLatency (float): simulated VISA query time (s)
+
+		Returns:
+			None
+		"""
+		self.temperature = temperature
+		self.humidity = humidity
+		self.queryLatency = queryLatency
+
+
+	def _query(self, mean, scale):
+		if self.queryLatency:
+			clock.sleep(self.queryLatency)
+		return round(mean + scale * np.sin(clock.now() / 600.0), 2)
+
+
+	def load(self):
+		pass
+
+
+	def getDeviceInfo(self):
+		return {'Model': 'Simulated TSP01', 'SerialNo': '0', 'FirmwareRev': '0'}
+
+
+	def getOnboardTemp(self):
+		return self._query(self.temperature + 1.0, 0.2)
+
+
+	def getProbeTemp(self):
+		return self._query(self.temperature, 0.2)
+
+
+	def getHumidity(self):
+		return self._query(self.humidity, 1.0)
@@ -0,0 +1,269 @@
+# title             : stacks.py
+# description       : Chunked Zarr and OME-TIFF image stacks for RunPack scans
+# authors           : Daniel Mokhtari
+# credits           :
+# date              : 20201018
+# version update    : 20201018
+# version           : 0.1.1
+# python_version    : 2.7
+
+
+import os
+import json
+import threading
+
+import numpy as np
+
+from runpack import storage
+
+try:
+	import zarr
+except ImportError:
+	zarr = None
+
+try:
+	import tifffile
+except ImportError:
+	tifffile = None
+
+
+################################################################################
+
+
+axes = 'TCEPYX' # time, channel, exposure, position, y, x
+
+exifNames = {37888: 'temperature', 37889: 'humidity', 33434: 'exposure_s',
+				37510: 'summary', 270: 'frame_info', 306: 'frame_time'}
+
+
+def _jsonValue(value):
+	return value.item() if isinstance(value, np.generic) else value
+
+
+
+class FrameStack:
+	def __init__(self, path, timepoints, channelsExposures, positionNames, frameShape,
+					dtype = np.uint16, attrs = None, workers = 2, maxQueued = 16):
+		"""Single image stack of dimensions time x channel x exposure x
+		position x y x x, holding a scan or a whole kinetic acquisition
+
+		Frames are written by a background FrameWriter. The EXIF metadata
+		of each frame is kept in the stack attributes under 'frames', keyed
+		by 't,c,e,p'. Exposure index e is the index of the exposure in its
+		channel's exposure list. The stack closes itself once every
+		timepoint is finished.
+
+		Args:
+			path (str): stack path
+			timepoints (int): number of timepoints
+			channelsExposures (dict): channels mapped to exposure lists (ms)
+			positionNames (list): position names, in position list order
+			frameShape (tuple): frame shape (rows, columns)
+			dtype (np.dtype): pixel type
+			attrs (dict): additional stack attributes
+			workers (int): number of writer threads
+			maxQueued (int): maximum number of frames waiting to be written
+
+		Returns:
+			None
+		"""
+		self.path = path
+		self.channels = sorted(channelsExposures)
+		self.exposures = {c: list(channelsExposures[c]) for c in self.channels}
+		numExposures = max(len(e) for e in self.exposures.values())
+		self.shape = (timepoints, len(self.channels), numExposures, len(positionNames)) + tuple(frameShape)
+		self.dtype = np.dtype(dtype)
+		self.attrs = {'axes': axes, 'channels': self.channels, 'exposures_ms': self.exposures,
+						'positions': [str(n) for n in positionNames]}
+		self.attrs.update(attrs or {})
+		self.frames = {}
+		self.finished = set()
+		self.closed = False
+		self.lock = threading.Lock()
+		self._open()
+		self.writer = storage.FrameWriter(workers, maxQueued, 'thread', write = self._write)
+
+
+	def index(self, timepoint, channel, exposureIndex, position):
+		"""Returns the stack index of a frame
+
+		Args:
+			timepoint (int): timepoint index
+			channel (str): channel
+			exposureIndex (int): index of the exposure in the channel's list
+			position (int): position list index
+
+		Returns:
+			tuple: (t, c, e, p) stack index
+		"""
+		return (timepoint, self.channels.index(channel), exposureIndex, position)
+
+
+	def framePath(self, index):
+		"""Returns a reference to a frame of the stack, for imaging records"""
+		return '{}[{}]'.format(self.path, ','.join(str(i) for i in index))
+
+
+	def _write(self, frame, index, tags):
+		self._store(frame, index)
+		metadata = {exifNames.get(k, str(k)): _jsonValue(v) for k, v in tags.items()}
+		with self.lock:
+			self.frames[','.join(str(i) for i in index)] = metadata
+
+
+	def submit(self, frame, index, tags):
+		"""Queues a frame to be written, blocking while the queue is full
+
+		Args:
+			frame (np.ndarray): image array. Must not be modified afterwards.
+			index (tuple): (t, c, e, p) stack index
+			tags (dict): EXIF tag IDs mapped to values
+
+		Returns:
+			None
+		"""
+		self.writer.submit(frame, index, tags)
+
+
+	def flush(self):
+		"""Blocks until every queued frame is written and saves the attributes
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		self.writer.flush()
+		with self.lock:
+			attrs = dict(self.attrs, frames = dict(self.frames))
+		self._saveAttrs(attrs)
+
+
+	def finishTimepoint(self, timepoint):
+		"""Flushes the stack and closes it once every timepoint is finished
+
+		Args:
+			timepoint (int): finished timepoint index
+
+		Returns:
+			None
+		"""
+		self.flush()
+		self.finished.add(timepoint)
+		if len(self.finished) >= self.shape[0]:
+			self.close()
+
+
+	def close(self):
+		"""Flushes the stack and stops its writer
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		if self.closed:
+			return
+		try:
+			self.flush()
+			self._finalize()
+		finally:
+			self.writer.close()
+			self.closed = True
+
+
+	def _finalize(self):
+		pass
+
+
+
+class ZarrStack(FrameStack):
+	"""FrameStack stored as a Zarr array with one chunk per frame. See FrameStack."""
+
+	def _open(self):
+		if zarr is None:
+			raise ImportError('Zarr stacks require zarr (pip install zarr)')
+		chunks = (1, 1, 1, 1) + self.shape[4:]
+		self.array = zarr.open_array(self.path, mode = 'w', shape = self.shape, chunks = chunks,
+										dtype = self.dtype, fill_value = 0)
+
+
+	def _store(self, frame, index):
+		self.array[index] = frame
+
+
+	def _saveAttrs(self, attrs):
+		self.array.attrs.update(attrs)
+
+
+
+class OmeTiffStack(FrameStack):
+	"""FrameStack stored as an OME-TIFF. See FrameStack.
+
+	Frames are collected in a memory-mapped buffer next to the stack and
+	written out when the stack closes. Each position is an OME image of axes
+	TCYX, whose channels are the channel and exposure pairs. The stack
+	attributes are also written to a JSON sidecar, since OME has no place
+	for the temperature and humidity of each frame. Requires tifffile with
+	OME-TIFF writing support.
+	"""
+
+	def _open(self):
+		if tifffile is None:
+			raise ImportError('OME-TIFF stacks require tifffile (pip install tifffile)')
+		self.bufferPath = self.path + '.partial.npy'
+		self.buffer = np.lib.format.open_memmap(self.bufferPath, mode = 'w+', dtype = self.dtype,
+												shape = self.shape)
+
+
+	def _store(self, frame, index):
+		self.buffer[index] = frame
+
+
+	def _saveAttrs(self, attrs):
+		self.buffer.flush()
+		with open(os.path.splitext(os.path.splitext(self.path)[0])[0] + '.json', 'w') as f:
+			json.dump(attrs, f)
+
+
+	def _finalize(self):
+		t, c, e, p, y, x = self.shape
+		names = ['{}_{}ms'.format(channel, exposure) if k < len(self.exposures[channel]) else
+					'{}_none'.format(channel) for channel in self.channels
+					for k, exposure in enumerate(self.exposures[channel] + [None] * (e - len(self.exposures[channel])))]
+		try:
+			tif = tifffile.TiffWriter(self.path, bigtiff = True, ome = True)
+		except TypeError:
+			raise ImportError('OME-TIFF stacks require tifffile 2020.9 or later')
+		with tif:
+			for position in range(p):
+				data = np.ascontiguousarray(self.buffer[:, :, :, position]).reshape(t, c * e, y, x)
+				tif.write(data, metadata = {'axes': 'TCYX', 'Name': self.attrs['positions'][position],
+											'Channel': {'Name': names}})
+		del self.buffer
+		os.remove(self.bufferPath)
+
+
+
+backends = {'zarr': (ZarrStack, '.zarr'), 'ome-tiff': (OmeTiffStack, '.ome.tif')}
+
+
+def openStack(backend, path, timepoints, channelsExposures, positionNames, frameShape,
+				dtype = np.uint16, attrs = None, workers = 2, maxQueued = 16):
+	"""Creates an image stack
+
+	Args:
+		backend (str): stack format ('zarr' | 'ome-tiff')
+		path (str): stack path, without extension
+		See FrameStack for the remaining arguments
+
+	Returns:
+		FrameStack: the stack
+	"""
+	if backend not in backends:
+		raise ValueError('Stack backend must be \'zarr\' or \'ome-tiff\'')
+	stackClass, extension = backends[backend]
+	return stackClass(path + extension, timepoints, channelsExposures, positionNames, frameShape,
+						dtype, attrs, workers, maxQueued)
@@ -0,0 +1,583 @@
+# title             : storage.py
+# description       : Image writing stages for RunPack acquisitions
+# authors           : Daniel Mokhtari
+# credits           :
+# date              : 20201018
+# version update    : 20201018
+# version           : 0.1.1
+# python_version    : 2.7
+
+
+import os
+import json
+import tempfile
+import itertools
+import threading
+import functools
+import multiprocessing
+from Queue import Queue
+
+import numpy as np
+from PIL import Image
+
+from runpack import clock
+from runpack import profiling
+
+
+################################################################################
+
+
+codecs = {'none': None, 'deflate': 'tiff_adobe_deflate', 'lzw': 'tiff_lzw', 'zstd': 'zstd'}
+
+
+def writeTiff(frame, path, tags, compression = None):
+	"""Encodes a frame as a TIFF and writes it to disk
+
+	Args:
+		frame (np.ndarray): image array
+		path (str | file): output path or file object
+		tags (dict): TIFF tag IDs mapped to values
+		compression (str | None): lossless codec ('none' | 'deflate' | 
+			'lzw' | 'zstd'). Defaults to uncompressed.
+
+	Returns:
+		None
+	"""
+	if compression is not None and compression not in codecs:
+		raise ValueError('Compression must be one of {}'.format(sorted(codecs)))
+	Image.fromarray(frame).save(path, format = 'TIFF', tiffinfo = tags, 
+								compression = codecs.get(compression))
+
+
+def codecAvailable(compression):
+	"""Checks whether the installed PIL and libtiff can encode a codec
+
+	Args:
+		compression (str): codec ('none' | 'deflate' | 'lzw' | 'zstd')
+
+	Returns:
+		bool: True if a test frame encodes
+	"""
+	try:
+		with tempfile.TemporaryFile() as f:
+			writeTiff(np.zeros((8, 8), dtype = np.uint16), f, {}, compression)
+	except (IOError, OSError, KeyError, ValueError):
+		return False
+	return True
+
+
+def _writeTiffInProcess(frame, path, tags, compression):
+	try:
+		writeTiff(frame, path, tags, compression)
+	except Exception as e:
+		return '{} ({}: {})'.format(path, type(e).__name__, e)
+	return None
+
+
+
+class FrameWriter:
+	def __init__(self, workers = 2, maxQueued = 16, mode = 'thread', write = writeTiff, 
+					compression = None, writeTimeout = 60.0):
+		"""Asynchronous frame writing stage
+
+		Frames are queued by the acquisition thread and encoded and written
+		by a pool of writer threads or processes. Compressed TIFFs are best 
+		written by a process pool, so that encoding does not hold the GIL 
+		on the acquisition thread. When maxQueued frames are
+		waiting, submit() blocks until one is written (backpressure). Write
+		errors are raised on the next submit() or flush(). A frame not 
+		written by a process pool within writeTimeout (e.g. its worker 
+		died) is reported as a write error.
+
+		Args:
+			workers (int): number of writer threads or processes. 0 writes
+				synchronously on the calling thread.
+			maxQueued (int): maximum number of frames waiting to be written
+			mode (str): writer pool type ('thread' | 'process')
+			write (callable): function writing a (frame, path, tags) job.
+				Defaults to writeTiff. Process pools only support writeTiff.
+			compression (str | None): TIFF codec ('none' | 'deflate' | 
+				'lzw' | 'zstd'). Defaults to uncompressed.
+			writeTimeout (float): time (s) after submission at which a frame 
+				not written by a process pool is reported lost
+
+		Returns:
+			None
+		"""
+		if mode not in ('thread', 'process'):
+			raise ValueError('Writer mode must be \'thread\' or \'process\'')
+		if mode == 'process' and write is not writeTiff:
+			raise ValueError('Process writer pools only write TIFF files')
+		if compression not in (None, 'none'):
+			if write is not writeTiff:
+				raise ValueError('Compression is only supported for TIFF files')
+			if not codecAvailable(compression):
+				raise ValueError('TIFF codec {} is not supported by this PIL build'.format(compression))
+			write = functools.partial(writeTiff, compression = compression)
+		self.workers = workers
+		self.maxQueued = maxQueued
+		self.mode = mode
+		self.write = write
+		self.compression = compression
+		self.errors = []
+		self.framesWritten = 0
+		self.lock = threading.Lock()
+		self.pool = None
+		self.threads = []
+		if workers and mode == 'thread':
+			self.queue = Queue(maxQueued)
+			for i in range(workers):
+				thread = threading.Thread(target = self._drain, name = 'FrameWriter-{}'.format(i))
+				thread.daemon = True
+				thread.start()
+				self.threads.append(thread)
+		elif workers:
+			self.pool = multiprocessing.Pool(workers)
+			self.writeTimeout = writeTimeout
+			self.jobs = {} # job ID -> (path, submission time) of frames being written
+			self.jobIDs = itertools.count()
+			self.lost = 0
+			self.idle = threading.Condition(self.lock)
+
+
+	def _drain(self):
+		while True:
+			job = self.queue.get()
+			try:
+				if job is None:
+					return
+				self._write(*job)
+			finally:
+				self.queue.task_done()
+
+
+	def _write(self, frame, path, tags):
+		try:
+			started = profiling.active.start()
+			self.write(frame, path, tags)
+			profiling.active.stop('save', started)
+		except Exception as e:
+			self._recordResult('{} ({}: {})'.format(path, type(e).__name__, e))
+		else:
+			self._recordResult(None)
+
+
+	def _recordResult(self, error):
+		with self.lock:
+			if error is None:
+				self.framesWritten += 1
+			else:
+				self.errors.append(error)
+
+
+	def _processDone(self, jobID, error):
+		with self.lock:
+			if self.jobs.pop(jobID, None) is None:
+				return # already reported lost
+			if error is None:
+				self.framesWritten += 1
+			else:
+				self.errors.append(error)
+			self.idle.notify_all()
+
+
+	def _waitForJobs(self, maxPending):
+		# Must be called while holding the lock
+		while len(self.jobs) > maxPending:
+			self.idle.wait(min(1.0, self.writeTimeout))
+			now = clock.counter()
+			for jobID, (path, submitted) in list(self.jobs.items()):
+				if now - submitted > self.writeTimeout:
+					del self.jobs[jobID]
+					self.lost += 1
+					self.errors.append('{} (not written within {} s, writer process lost)'.format(
+										path, self.writeTimeout))
+
+
+	def raiseErrors(self):
+		"""Raises an IOError for frames that failed to write since the last call
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		with self.lock:
+			errors, self.errors = self.errors, []
+		if errors:
+			raise IOError('{} frame(s) failed to write: {}'.format(len(errors), '; '.join(errors)))
+
+
+	def submit(self, frame, path, tags):
+		"""Queues a frame to be written, blocking while the queue is full
+
+		Args:
+			frame (np.ndarray): image array. Must not be modified afterwards.
+			path (str): output path
+			tags (dict): TIFF tag IDs mapped to values
+
+		Returns:
+			None
+		"""
+		self.raiseErrors()
+		if not self.workers:
+			started = profiling.active.start()
+			self.write(frame, path, tags)
+			profiling.active.stop('save', started)
+			self.framesWritten += 1
+		elif self.pool is None:
+			self.queue.put((frame, path, tags))
+		else:
+			with self.lock:
+				self._waitForJobs(self.maxQueued - 1)
+				jobID = next(self.jobIDs)
+				self.jobs[jobID] = (path, clock.counter())
+			self.pool.apply_async(_writeTiffInProcess, (frame, path, tags, self.compression),
+									callback = functools.partial(self._processDone, jobID))
+
+
+	def flush(self):
+		"""Blocks until every queued frame is written, then raises any write errors
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		if self.workers and self.pool is None:
+			self.queue.join()
+		elif self.pool is not None:
+			with self.lock:
+				self._waitForJobs(0)
+		self.raiseErrors()
+
+
+	def close(self):
+		"""Flushes the writer and stops its threads or processes
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		try:
+			self.flush()
+		finally:
+			for thread in self.threads:
+				self.queue.put(None)
+			for thread in self.threads:
+				thread.join()
+			self.threads = []
+			if self.pool is not None:
+				if self.lost:
+					self.pool.terminate() # lost writes may be hung in a worker
+				else:
+					self.pool.close()
+				self.pool.join()
+				self.pool = None
+
+
+
+def _jsonDefault(value):
+	return value.item() if isinstance(value, np.generic) else str(value)
+
+
+def _readSpoolIndex(indexPath):
+	entries, converted = {}, set()
+	with open(indexPath) as f:
+		for line in f:
+			try:
+				entry = json.loads(line)
+			except ValueError: # line cut short by a crash
+				continue
+			if 'converted' in entry:
+				converted.add(entry['converted'])
+			else:
+				entries[entry['frame']] = entry
+	return entries, converted
+
+
+def _spoolFrame(data, entry):
+	start = entry['offset']
+	raw = np.array(data[start:start + entry['nbytes']])
+	return raw.view(np.dtype(str(entry['dtype']))).reshape(entry['shape'])
+
+
+def _spoolTags(entry):
+	return {int(k): v for k, v in entry['tags'].items()}
+
+
+
+class FrameSpool:
+	def __init__(self, path, workers = 1, write = writeTiff, compression = None, 
+					capacity = 256 * 2**20, sync = False):
+		"""Crash-safe frame writing stage backed by a memory-mapped spool file
+
+		Raw frames are copied into an append-only, preallocated spool file
+		(<path>.spool), and their offset, shape, output path, and tags are
+		appended to an index (<path>.index). Submitting never waits on
+		encoding or on the output disk. Converter threads then write each
+		spooled frame to its output path and mark it converted in the index.
+		Once every frame is converted, flush() empties the spool. Frames that
+		failed to convert, or were spooled before a crash, stay in the spool
+		and are recovered with replaySpool(). Conversion errors are raised by
+		flush() and close() only, so a failed conversion never stops frames
+		from being spooled. Same interface as FrameWriter.
+
+		Args:
+			path (str): spool path, without extension
+			workers (int): number of converter threads
+			write (callable): function writing a (frame, path, tags) job.
+				Defaults to writeTiff. Replay after a crash uses writeTiff.
+			compression (str | None): TIFF codec ('none' | 'deflate' |
+				'lzw' | 'zstd'). Defaults to uncompressed.
+			capacity (int): initial spool file size (bytes). The file grows
+				by doubling when full.
+			sync (bool): flag to fsync the spool and index on every frame, so
+				frames also survive a power loss. Slower.
+
+		Returns:
+			None
+		"""
+		if compression not in (None, 'none'):
+			if write is not writeTiff:
+				raise ValueError('Compression is only supported for TIFF files')
+			if not codecAvailable(compression):
+				raise ValueError('TIFF codec {} is not supported by this PIL build'.format(compression))
+			write = functools.partial(writeTiff, compression = compression)
+		self.path = path
+		self.spoolPath = path + '.spool'
+		self.indexPath = path + '.index'
+		self.write = write
+		self.compression = compression
+		self.capacity = max(int(capacity), 1)
+		self.sync = sync
+		self.errors = []
+		self.framesWritten = 0
+		self.lock = threading.Lock()
+		self.idle = threading.Condition(self.lock)
+		self.queue = Queue()
+		self.threads = []
+		self.data = None
+		self._reset()
+		for i in range(max(workers, 1)):
+			thread = threading.Thread(target = self._convert, name = 'FrameSpool-{}'.format(i))
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+
+	def _reset(self):
+		directory = os.path.dirname(self.spoolPath)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		if os.path.isfile(self.indexPath):
+			raise IOError('Spool {} already exists, replay it first'.format(self.path))
+		with open(self.spoolPath, 'wb') as f:
+			f.truncate(self.capacity)
+		self.data = np.memmap(self.spoolPath, dtype = np.uint8, mode = 'r+', shape = (self.capacity,))
+		self.index = open(self.indexPath, 'a')
+		self.size = 0
+		self.framesSpooled = 0
+		self.pending = 0
+		self.failed = 0
+
+
+	def _grow(self, nbytes):
+		while self.capacity < self.size + nbytes:
+			self.capacity *= 2
+		self.data.flush()
+		del self.data
+		with open(self.spoolPath, 'r+b') as f:
+			f.truncate(self.capacity)
+		self.data = np.memmap(self.spoolPath, dtype = np.uint8, mode = 'r+', shape = (self.capacity,))
+
+
+	def _appendIndex(self, entry):
+		self.index.write(json.dumps(entry, default = _jsonDefault) + '\n')
+		self.index.flush()
+		if self.sync:
+			os.fsync(self.index.fileno())
+
+
+	def submit(self, frame, path, tags):
+		"""Copies a frame into the spool and queues it for conversion
+
+		Args:
+			frame (np.ndarray): image array
+			path (str): output path
+			tags (dict): TIFF tag IDs mapped to values
+
+		Returns:
+			None
+		"""
+		frame = np.ascontiguousarray(frame)
+		with self.lock:
+			if self.size + frame.nbytes > self.capacity:
+				self._grow(frame.nbytes)
+			offset = self.size
+			self.data[offset:offset + frame.nbytes] = frame.reshape(-1).view(np.uint8)
+			if self.sync:
+				self.data.flush()
+			entry = {'frame': self.framesSpooled, 'offset': offset, 'nbytes': frame.nbytes, 
+						'shape': list(frame.shape), 'dtype': frame.dtype.str, 'path': path, 
+						'tags': tags}
+			self._appendIndex(entry) # written after the frame, so indexed frames are complete
+			self.size += frame.nbytes
+			self.framesSpooled += 1
+			self.pending += 1
+		self.queue.put(entry)
+
+
+	def _convert(self):
+		while True:
+			entry = self.queue.get()
+			if entry is None:
+				return
+			try:
+				with self.lock:
+					frame = _spoolFrame(self.data, entry)
+				started = profiling.active.start()
+				self.write(frame, entry['path'], _spoolTags(entry))
+				profiling.active.stop('save', started)
+			except Exception as e:
+				error = '{} ({}: {})'.format(entry['path'], type(e).__name__, e)
+			else:
+				error = None
+			with self.lock:
+				if error is None:
+					self._appendIndex({'converted': entry['frame']})
+					self.framesWritten += 1
+				else:
+					self.errors.append(error)
+					self.failed += 1
+				self.pending -= 1
+				self.idle.notify_all()
+
+
+	def raiseErrors(self):
+		"""Raises an IOError for frames that failed to convert since the last
+		call. The frames remain in the spool.
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		with self.lock:
+			errors, self.errors = self.errors, []
+		if errors:
+			raise IOError('{} frame(s) failed to write and remain in spool {}: {}'.format(
+				len(errors), self.path, '; '.join(errors)))
+
+
+	def flush(self):
+		"""Blocks until every spooled frame is converted, empties the spool if
+		all conversions succeeded, then raises any write errors
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		with self.lock:
+			while self.pending:
+				self.idle.wait()
+			if self.framesSpooled and not self.failed:
+				self._discard()
+				self._reset()
+		self.raiseErrors()
+
+
+	def _discard(self):
+		self.index.close()
+		del self.data
+		self.data = None
+		os.remove(self.indexPath)
+		os.remove(self.spoolPath)
+
+
+	def close(self):
+		"""Flushes the spool and stops its converter threads. A spool holding
+		unconverted frames is kept for replaySpool().
+
+		Args:
+			None
+
+		Returns:
+			None
+		"""
+		try:
+			self.flush()
+		finally:
+			for thread in self.threads:
+				self.queue.put(None)
+			for thread in self.threads:
+				thread.join()
+			self.threads = []
+			with self.lock:
+				if self.data is not None and not self.failed:
+					self._discard()
+				elif self.data is not None:
+					self.index.close()
+					self.data.flush()
+
+
+
+def pendingSpools(directory):
+	"""Returns the spools in a directory, e.g. left behind by a crash
+
+	Args:
+		directory (str): spool directory
+
+	Returns:
+		list: spool paths, without extension
+	"""
+	if not os.path.isdir(directory):
+		return []
+	return sorted(os.path.join(directory, f[:-len('.index')]) for f in os.listdir(directory)
+					if f.endswith('.index'))
+
+
+def replaySpool(path, write = writeTiff, compression = None):
+	"""Writes every unconverted frame of a spool to its output path, then
+	deletes the spool if all frames were written
+
+	Args:
+		path (str): spool path, without extension
+		write (callable): function writing a (frame, path, tags) job
+		compression (str | None): TIFF codec, if write is writeTiff
+
+	Returns:
+		int: number of frames recovered
+	"""
+	if compression not in (None, 'none'):
+		write = functools.partial(write, compression = compression)
+	entries, converted = _readSpoolIndex(path + '.index')
+	remaining = [entries[k] for k in sorted(entries) if k not in converted]
+	recovered, errors = 0, []
+	if remaining:
+		data = np.memmap(path + '.spool', dtype = np.uint8, mode = 'r')
+		with open(path + '.index', 'a') as index:
+			for entry in remaining:
+				try:
+					if entry['offset'] + entry['nbytes'] > len(data):
+						raise IOError('frame data missing from spool')
+					write(_spoolFrame(data, entry), entry['path'], _spoolTags(entry))
+				except Exception as e:
+					errors.append('{} ({}: {})'.format(entry['path'], type(e).__name__, e))
+				else:
+					index.write(json.dumps({'converted': entry['frame']}) + '\n')
+					recovered += 1
+		del data
+	if errors:
+		raise IOError('{} frame(s) of spool {} could not be recovered: {}'.format(
+			len(errors), path, '; '.join(errors)))
+	os.remove(path + '.index')
+	os.remove(path + '.spool')
+	return recovered
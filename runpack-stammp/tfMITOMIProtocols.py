@@ -7,6 +7,7 @@
 # version           : v0.1
 # python_version    : 2.7
 
+from runpack import clock
 from runpack import valvecontrol as vc
 from runpack import imagingcontrol as ic
 from runpack.io import ExperimentalHarness as eh
@@ -16,8 +17,6 @@ import numpy as np
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.schedulers.blocking import BlockingScheduler
 
-import time
-
 
 
 def flowOligoStartAssay(deviceName, substrateInput, bufferInput, KineticAcquisition, equilibrationTime = 600, treeFlushTime = 20, bindingTime = 1800, washoutTime = 600, postEquilibImageChanExp = {'5cy5':[30]}, postWashImageChanExp = {'5cy5':[30], '4egfp':[500]}, performImaging = True):
@@ -35,21 +34,22 @@ def flowOligoStartAssay(deviceName, substrateInput, bufferInput, KineticAcquisit
 	eh.scriptlogger.info('The inlet tree wash started for oligo in ' + str(substrateInput))
 	vc.returnToSafeState([deviceName])
 	vc.openValves([deviceName], [substrateInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	eh.scriptlogger.info('The inlet tree wash done for oligo in ' + str(substrateInput))
 
 
 	#Expose chip to oligo, equilibrate for equilibrationTime
 	eh.scriptlogger.info('Chip equilibration started for substrate in ' + str(substrateInput))
-	vc.closeValves([deviceName], ['w'])
-	vc.openValves([deviceName], ['in', 'out', 's1', 's2'])
-	time.sleep(equilibrationTime)
+	with vc.transaction([deviceName]):
+		vc.closeValves([deviceName], ['w'])
+		vc.openValves([deviceName], ['in', 'out', 's1', 's2'])
+	clock.sleep(equilibrationTime)
 	eh.scriptlogger.info('Chip equilibration done for substrate in ' + str(substrateInput))
 
 
 	#Close things to prep for assay, and open buttons
 	vc.closeValves([deviceName], [substrateInput[:-1], 'in', 'out', 's1', 's2'])
-	time.sleep(0.5)
+	clock.sleep(0.5)
 	vc.openValves([deviceName], ['b1', 'b2'])
 	#Start the assay
 	if performImaging:
@@ -57,7 +57,7 @@ def flowOligoStartAssay(deviceName, substrateInput, bufferInput, KineticAcquisit
 		KineticAcquisition.startAssay(eh.rootPath, eh.posLists[deviceName], scanQueueFlag = sendToQueue)
 	else:
 		eh.scriptlogger.info('Binding oligo to buttons, no kinetics' + str(substrateInput))
-		time.sleep(bindingTime)
+		clock.sleep(bindingTime)
 
 	# Obtain pre-wash Cy5 no matter what
 	ic.scan(eh.rootPath, postEquilibImageChanExp, deviceName, KineticAcquisition.note.replace(" ", "_")+'_PreWash_Quant', eh.posLists[deviceName], wrappingFolder = True)
@@ -66,15 +66,15 @@ def flowOligoStartAssay(deviceName, substrateInput, bufferInput, KineticAcquisit
 	eh.scriptlogger.info('The inlet tree wash started for buffer in ' + str(bufferInput))
 	vc.returnToSafeState([deviceName])
 	vc.openValves([deviceName], [bufferInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	eh.scriptlogger.info('The inlet tree wash done for buffer in ' + str(bufferInput))
 
 	# Flow buffer through chip
 	vc.closeValves([deviceName], ['w'])
 	vc.closeValves([deviceName], ['b1', 'b2'])
-	time.sleep(0.5)
+	clock.sleep(0.5)
 	vc.openValves([deviceName], ['in', 'out', 's1', 's2'])
-	time.sleep(washoutTime)
+	clock.sleep(washoutTime)
 	
 
 	vc.closeValves([deviceName], [bufferInput[:-1], 'in', 's1', 's2', 'out'])
@@ -122,27 +122,28 @@ def flowOligoStartAssaysConcurrent(deviceNames, substrateInputs, bufferInputs, n
 
 	for device, substrateInput in list(zip(deviceNames, substrateInputs)):
 		vc.openValves([device], [substrateInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	eh.scriptlogger.info('The inlet tree wash done for oligo in ' + str(substrateInput))
 
 
 	#Flow oligo onto device, equilibrate for equilibrationTime
 	eh.scriptlogger.info('Chip equilibration started for substrate in ' + str(substrateInputs))
-	vc.closeValves(deviceNames, ['w'])
-	vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
-	time.sleep(equilibrationTime)
+	with vc.transaction(deviceNames):
+		vc.closeValves(deviceNames, ['w'])
+		vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
+	clock.sleep(equilibrationTime)
 	eh.scriptlogger.info('Chip equilibration done for substrate in ' + str(substrateInputs))
 
 
 	#Close things to prep for assay, and open buttons
 	for device, substrateInput in list(zip(deviceNames, substrateInputs)):
 		vc.closeValves([device], [substrateInput[:-1], 'in', 'out', 's1', 's2'])
-	time.sleep(1)
+	clock.sleep(1)
 	vc.openValves(deviceNames, ['b1', 'b2'])
   
 
 	eh.scriptlogger.info('Binding oligo to buttons, no kinetics' + str(substrateInputs))
-	time.sleep(bindingTime)
+	clock.sleep(bindingTime)
 
 	# Obtain pre-wash Cy5 no matter what
 	for device, note in list(zip(deviceNames, notes)):
@@ -156,7 +157,7 @@ def flowOligoStartAssaysConcurrent(deviceNames, substrateInputs, bufferInputs, n
 
 	for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 		vc.openValves([device], [bufferInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	eh.scriptlogger.info('The inlet tree wash done for buffer in ' + str(bufferInputs))
 
 
@@ -164,9 +165,9 @@ def flowOligoStartAssaysConcurrent(deviceNames, substrateInputs, bufferInputs, n
 	eh.scriptlogger.info('Started flowing buffer through devices for washout ' + str(bufferInputs))
 	vc.closeValves(deviceNames, ['w'])
 	vc.closeValves(deviceNames, ['b1', 'b2'])
-	time.sleep(0.5)
+	clock.sleep(0.5)
 	vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
-	time.sleep(washoutTime)
+	clock.sleep(washoutTime)
 	eh.scriptlogger.info('Done flowing buffer through devices for washout ' + str(bufferInputs))
    
 
@@ -215,12 +216,12 @@ def trypsinDigest(deviceNames, bufferInputs, trypInputs, bBSAInputs, assayBuffer
 	# open buffer lines to waste
 	for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 		vc.openValves([device], [bufferInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	vc.closeValves(deviceNames, ['w'])
 
 	eh.scriptlogger.info('Started flowing buffer through devices for washout ' + str(bufferInputs))
 	vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
-	time.sleep(washoutTime)
+	clock.sleep(washoutTime)
 	eh.scriptlogger.info('Done flowing buffer through devices for washout ' + str(bufferInputs))
 	vc.closeValves(deviceNames, ['in'])
 	for device, bufferInput in list(zip(deviceNames, bufferInputs)):
@@ -231,12 +232,12 @@ def trypsinDigest(deviceNames, bufferInputs, trypInputs, bBSAInputs, assayBuffer
 	eh.scriptlogger.info('Started flowing trypsin to waste')
 	for device, bufferInput in list(zip(deviceNames, trypInputs)):
 		vc.openValves([device], [bufferInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	vc.closeValves(deviceNames, ['w'])
 
 	eh.scriptlogger.info('Started flowing trypsin through devices for protein cleaning ' + str(trypInputs))
 	vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
-	time.sleep(trypsinWashTime)
+	clock.sleep(trypsinWashTime)
 	eh.scriptlogger.info('Done flowing trypsin through devices ' + str(trypInputs))
 	vc.closeValves(deviceNames, ['in'])
 
@@ -246,12 +247,12 @@ def trypsinDigest(deviceNames, bufferInputs, trypInputs, bBSAInputs, assayBuffer
 	#wash trypsin away
 	for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 		vc.openValves([device], [bufferInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	vc.closeValves(deviceNames, ['w'])
 
 	eh.scriptlogger.info('Started flowing buffer through devices for washout ' + str(bufferInputs))
 	vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
-	time.sleep(washoutTime)
+	clock.sleep(washoutTime)
 	eh.scriptlogger.info('Done flowing buffer through devices for washout ' + str(bufferInputs))
 	vc.closeValves(deviceNames, ['in'])
 
@@ -262,12 +263,12 @@ def trypsinDigest(deviceNames, bufferInputs, trypInputs, bBSAInputs, assayBuffer
 	eh.scriptlogger.info('Started bBSA to waste')
 	for device, bBSAInput in list(zip(deviceNames, bBSAInputs)):
 		vc.openValves([device], [bBSAInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	vc.closeValves(deviceNames, ['w'])
 
 	eh.scriptlogger.info('Started flowing bBSA through devices for surface regeneration ' + str(bBSAInputs))
 	vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
-	time.sleep(trypsinWashTime)
+	clock.sleep(trypsinWashTime)
 	eh.scriptlogger.info('Done flowing bBSA through devices ' + str(bBSAInputs))
 	vc.closeValves(deviceNames, ['in'])
 
@@ -277,12 +278,12 @@ def trypsinDigest(deviceNames, bufferInputs, trypInputs, bBSAInputs, assayBuffer
 	#flow buffer through to wash away bBSA
 	# for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 	# 	vc.openValves([device], [bufferInput[:-1], 'w'])
-	# time.sleep(treeFlushTime)
+	# clock.sleep(treeFlushTime)
 	# vc.closeValves(deviceNames, ['w'])
 
 	# eh.scriptlogger.info('Started flowing buffer through devices for washout ' + str(bufferInputs))
 	# vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
-	# time.sleep(washoutTime)
+	# clock.sleep(washoutTime)
 	# eh.scriptlogger.info('Done flowing buffer through devices for washout ' + str(bufferInputs))
 	# vc.closeValves(deviceNames, ['in'])
 
@@ -293,12 +294,12 @@ def trypsinDigest(deviceNames, bufferInputs, trypInputs, bBSAInputs, assayBuffer
 	eh.scriptlogger.info('Started assay buffer')
 	for device, bufferInput in list(zip(deviceNames, assayBufferInputs)):
 		vc.openValves([device], [bufferInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	vc.closeValves(deviceNames, ['w'])
 
 	eh.scriptlogger.info('Started flowing assay buffer through devices for equilibration ' + str(assayBufferInputs))
 	vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
-	time.sleep(trypsinWashTime)
+	clock.sleep(trypsinWashTime)
 	eh.scriptlogger.info('Done flowing assay buffer through devices ' + str(assayBufferInputs))
 	vc.closeValves(deviceNames, ['in'])
 
@@ -344,29 +345,29 @@ def removeOligo(deviceNames, bufferInputs, openTime = 120, washoutTime = 300, tr
 	# open buffer lines to waste
 	for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 		vc.openValves([device], [bufferInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	vc.closeValves(deviceNames, ['w'])
 
 	eh.scriptlogger.info('Started flowing buffer through devices for washout ' + str(bufferInputs))
 	vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
-	time.sleep(300)
+	clock.sleep(300)
 	eh.scriptlogger.info('Done flowing buffer through devices for washout ' + str(bufferInputs))
 
 	for i in range(washoutSteps):
 		eh.scriptlogger.info('Started washout step {} of {}'.format(i+1, washoutSteps))
 		vc.closeValves(deviceNames, ['s1','s2']) #close sandwiches
-		time.sleep(5)
+		clock.sleep(5)
 		vc.openValves(deviceNames, ['b1','b2']) #open buttons
 		eh.scriptlogger.info('Closed sandwiches and opened buttons' + str(deviceNames))
-		time.sleep(openTime)
+		clock.sleep(openTime)
 
 		vc.closeValves(deviceNames, ['b1', 'b2'])
-		time.sleep(5)
+		clock.sleep(5)
 		vc.openValves(deviceNames, ['s1','s2'])
 		eh.scriptlogger.info('Closed buttons and opened sandwiches {} for {}s'.format(str(deviceNames), washoutTime))
-		time.sleep(washoutTime)
+		clock.sleep(washoutTime)
 	
-	time.sleep(washoutTime)
+	clock.sleep(washoutTime)
 	eh.scriptlogger.info('Finished additional washout ' + str(bufferInputs))
 	eh.scriptlogger.info('Finished Oligo Removal/Protein refresh')
 	vc.returnToSafeState(deviceNames)
@@ -405,26 +406,26 @@ def dissociationConcurrent(deviceNames, bufferInputs, notes, points=20, dutyCycl
 
 		eh.scriptlogger.info('Shutting sandwich valves')
 		vc.closeValves(deviceNames,['s1','s2'])
-		time.sleep(5)
+		clock.sleep(5)
 
 		eh.scriptlogger.info('Opening button valves')
 		vc.openValves(deviceNames,['b1','b2'])
-		time.sleep(dutyCycle)
+		clock.sleep(dutyCycle)
 		vc.closeValves(deviceNames,['b1','b2'])
 		eh.scriptlogger.info('Shut button valves')
-		time.sleep(5)
+		clock.sleep(5)
 
 		eh.scriptlogger.info('Opening sandiwch valves for wash')
 		vc.openValves(deviceNames, ['s1','s2'])
 
-		time.sleep(5)
+		clock.sleep(5)
 
 		eh.scriptlogger.info('Started flowing buffer through devices for washout ' + str(bufferInputs))
 
 		for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 			vc.openValves([device], [bufferInput[:-1]])
 
-		time.sleep(washoutTime)
+		clock.sleep(washoutTime)
 
 		for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 			vc.closeValves([device], [bufferInput[:-1]])
@@ -446,7 +447,7 @@ def continuousImagingbyRaster(deviceNames, notes, exposures = {'5cy5': [100], '4
 
 	eh.scriptlogger.info('Imaging continuously by rastering across device(s) during DNA incubation')
 
-	startTime = time.time()
+	startTime = clock.monotonic()
 
 	count = 0
 	scan_records = {}
@@ -455,7 +456,7 @@ def continuousImagingbyRaster(deviceNames, notes, exposures = {'5cy5': [100], '4
 		for device, note in list(zip(deviceNames, notes)):
 			scan_records[(count, device)] = ic.scan(eh.rootPath, exposures, device, note.replace(" ", "_")+'_BindingRate_Point_'+str(count), eh.posLists[device], wrappingFolder = True)
 		count += 1
-		timeElapsed = time.time() - startTime
+		timeElapsed = clock.monotonic() - startTime
 
 	return scan_records
 
@@ -475,11 +476,11 @@ def flowProteinandDNA(deviceNames, bufferInputs, DNAInputs, proteinInputs, prote
 	for device, proteinInput in list(zip(deviceNames, proteinInputs)):
 		vc.openValves([device], [proteinInput[:-1], 'w'])
 	eh.scriptlogger.info('Started flowing protein through devices ' + str(proteinInputs))
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	vc.closeValves(deviceNames, ['w'])
 
 	vc.openValves(deviceNames, ['in', 'out', 's1', 's2', 'b1', 'b2'])
-	time.sleep(proteinFlowTime)
+	clock.sleep(proteinFlowTime)
 
 	for device, proteinInput in list(zip(deviceNames, proteinInputs)):
 		vc.closeValves([device], [proteinInput[:-1]])
@@ -490,11 +491,11 @@ def flowProteinandDNA(deviceNames, bufferInputs, DNAInputs, proteinInputs, prote
 	for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 		vc.openValves([device], [bufferInput[:-1], 'w'])
 	eh.scriptlogger.info('Started flowing buffer through devices for washout ' + str(bufferInputs))
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	vc.closeValves(deviceNames, ['w'])
 
 	vc.openValves(deviceNames, ['in', 'out'])
-	time.sleep(washoutTime)
+	clock.sleep(washoutTime)
 
 	for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 		vc.closeValves([device], [bufferInput[:-1]])
@@ -505,11 +506,11 @@ def flowProteinandDNA(deviceNames, bufferInputs, DNAInputs, proteinInputs, prote
 	for device, DNAInput in list(zip(deviceNames, DNAInputs)):
 		vc.openValves([device], [DNAInput[:-1], 'w'])
 	eh.scriptlogger.info('Started flowing DNA through devices for binding ' + str(DNAInputs))
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	vc.closeValves(deviceNames, ['w'])
 
 	vc.openValves(deviceNames, ['in', 'out'])
-	time.sleep(washoutTime)
+	clock.sleep(washoutTime)
 
 	for device, DNAInput in list(zip(deviceNames, DNAInputs)):
 		vc.closeValves([device], [DNAInput[:-1]])
@@ -517,7 +518,7 @@ def flowProteinandDNA(deviceNames, bufferInputs, DNAInputs, proteinInputs, prote
 	eh.scriptlogger.info('Finished flowing DNA through devices for binding ' + str(DNAInputs))
 
 	eh.scriptlogger.info('Allowing DNA to bind for %.1f minutes' % (incubationTime/60.0))
-	time.sleep(incubationTime)
+	clock.sleep(incubationTime)
 
 	vc.returnToSafeState(deviceNames)
 
@@ -534,7 +535,7 @@ def BETseqElute(deviceNames, bufferInputs, treeFlushTime=20):
 	# open buffer lines to waste
 	for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 		vc.openValves([device], [bufferInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	vc.closeValves(deviceNames, ['w'])
 
 	eh.scriptlogger.info('Started flowing buffer through devices for washout ' + str(bufferInputs))
@@ -546,9 +547,9 @@ def BETseqElute(deviceNames, bufferInputs, treeFlushTime=20):
 	for cycle in range(numCycles):
 		eh.scriptlogger.info('Cycle number ' + str(cycle+1))
 		vc.openValves(deviceNames,['b1','b2'])
-		time.sleep(dutyCycle)
+		clock.sleep(dutyCycle)
 		vc.closeValves(deviceNames,['b1','b2'])
-		time.sleep(5)
+		clock.sleep(5)
             
 	vc.returnToSafeState(deviceNames)
 
@@ -578,7 +579,7 @@ def runAssaywithKinetics(deviceNames, notes, bufferInputs, competitorInputs, poi
 	### still working on this
 	# scan_records = continuousImagingbyRaster(deviceNames, notes, exposures=bindingExposures, incubationTime=incubationTime)
 	eh.scriptlogger.info('Letting oligo bind for %.1f minutes' % (incubationTime/60.0))
-	time.sleep(incubationTime)
+	clock.sleep(incubationTime)
 
 	# close neck valves and take prewash image
 	vc.closeValves(deviceNames,['neck'])
@@ -594,11 +595,11 @@ def runAssaywithKinetics(deviceNames, notes, bufferInputs, competitorInputs, poi
 	for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 		vc.openValves([device], [bufferInput[:-1], 'w'])
 	eh.scriptlogger.info('Started flowing buffer through devices for washout ' + str(bufferInputs))
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	vc.closeValves(deviceNames, ['w'])
 
 	vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
-	time.sleep(washoutTime)
+	clock.sleep(washoutTime)
 
 	for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 		vc.closeValves([device], [bufferInput[:-1]])
@@ -612,11 +613,12 @@ def runAssaywithKinetics(deviceNames, notes, bufferInputs, competitorInputs, poi
 
 	for device, competitorInput in list(zip(deviceNames, competitorInputs)):
 		vc.openValves([device], [competitorInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
-	vc.closeValves(deviceNames, ['w'])
-	vc.openValves(deviceNames, ['in', 'out'])
+	clock.sleep(treeFlushTime)
+	with vc.transaction(deviceNames):
+		vc.closeValves(deviceNames, ['w'])
+		vc.openValves(deviceNames, ['in', 'out'])
 	eh.scriptlogger.info('Started flowing dark competitor through devices for washout ' + str(competitorInputs))
-	time.sleep(washoutTime)
+	clock.sleep(washoutTime)
 
 	for device, competitorInput in list(zip(deviceNames, competitorInputs)):
 		vc.closeValves([device], [competitorInput[:-1]])
@@ -646,7 +648,7 @@ def runAssaywithOnOffRates(deviceNames, notes, bufferInputs, competitorInputs, p
 	# open and close buttons repeatedly to record on rate
 	vc.openValves(deviceNames,['b1','b2','neck'])
 	for i in range(associationPoints):
-		time.sleep(associationCycle)
+		clock.sleep(associationCycle)
 		vc.closeValves(deviceNames,['b1','b2'])
 		eh.scriptlogger.info('Taking image of TF-DNA association rate @ %d sec' % (associationCycle*(i+1)))
 		for device, note in list(zip(deviceNames, notes)):
@@ -656,7 +658,7 @@ def runAssaywithOnOffRates(deviceNames, notes, bufferInputs, competitorInputs, p
 
 	remainingTime = incubationTime - associationCycle*associationPoints
 	eh.scriptlogger.info('Letting oligo bind for %.1f minutes' % (remainingTime/60.0))
-	time.sleep(remainingTime)
+	clock.sleep(remainingTime)
 
 	# close neck valves and take prewash image
 	vc.closeValves(deviceNames,['neck'])
@@ -672,11 +674,11 @@ def runAssaywithOnOffRates(deviceNames, notes, bufferInputs, competitorInputs, p
 	for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 		vc.openValves([device], [bufferInput[:-1], 'w'])
 	eh.scriptlogger.info('Started flowing buffer through devices for washout ' + str(bufferInputs))
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	vc.closeValves(deviceNames, ['w'])
 
 	vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
-	time.sleep(washoutTime)
+	clock.sleep(washoutTime)
 
 	for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 		vc.closeValves([device], [bufferInput[:-1]])
@@ -690,11 +692,12 @@ def runAssaywithOnOffRates(deviceNames, notes, bufferInputs, competitorInputs, p
 
 	for device, competitorInput in list(zip(deviceNames, competitorInputs)):
 		vc.openValves([device], [competitorInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
-	vc.closeValves(deviceNames, ['w'])
-	vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
+	clock.sleep(treeFlushTime)
+	with vc.transaction(deviceNames):
+		vc.closeValves(deviceNames, ['w'])
+		vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
 	eh.scriptlogger.info('Started flowing dark competitor through devices for washout ' + str(competitorInputs))
-	time.sleep(washoutTime)
+	clock.sleep(washoutTime)
 
 	for device, competitorInput in list(zip(deviceNames, competitorInputs)):
 		vc.closeValves([device], [competitorInput[:-1]])
@@ -744,27 +747,28 @@ def flowProteinStartAssaysConcurrent(deviceNames, substrateInputs, bufferInputs,
 
 	for device, substrateInput in list(zip(deviceNames, substrateInputs)):
 		vc.openValves([device], [substrateInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	eh.scriptlogger.info('The inlet tree wash done for protein in ' + str(substrateInput))
 
 
 	#Flow protein onto device, equilibrate for equilibrationTime
 	eh.scriptlogger.info('Chip equilibration started for substrate in ' + str(substrateInputs))
-	vc.closeValves(deviceNames, ['w'])
-	vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
-	time.sleep(equilibrationTime)
+	with vc.transaction(deviceNames):
+		vc.closeValves(deviceNames, ['w'])
+		vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
+	clock.sleep(equilibrationTime)
 	eh.scriptlogger.info('Chip equilibration done for substrate in ' + str(substrateInputs))
 
 
 	#Close things to prep for assay, and open buttons
 	for device, substrateInput in list(zip(deviceNames, substrateInputs)):
 		vc.closeValves([device], [substrateInput[:-1], 'in', 'out', 's1', 's2'])
-	time.sleep(1)
+	clock.sleep(1)
 	vc.openValves(deviceNames, ['b1', 'b2'])
   
 
 	eh.scriptlogger.info('Binding protein to buttons, no kinetics' + str(substrateInputs))
-	time.sleep(bindingTime)
+	clock.sleep(bindingTime)
 
 	# Obtain pre-wash mCherry no matter what
 	for device, note in list(zip(deviceNames, notes)):
@@ -778,7 +782,7 @@ def flowProteinStartAssaysConcurrent(deviceNames, substrateInputs, bufferInputs,
 
 	for device, bufferInput in list(zip(deviceNames, bufferInputs)):
 		vc.openValves([device], [bufferInput[:-1], 'w'])
-	time.sleep(treeFlushTime)
+	clock.sleep(treeFlushTime)
 	eh.scriptlogger.info('The inlet tree wash done for buffer in ' + str(bufferInputs))
 
 
@@ -786,9 +790,9 @@ def flowProteinStartAssaysConcurrent(deviceNames, substrateInputs, bufferInputs,
 	eh.scriptlogger.info('Started flowing buffer through devices for washout ' + str(bufferInputs))
 	vc.closeValves(deviceNames, ['w'])
 	vc.closeValves(deviceNames, ['b1', 'b2'])
-	time.sleep(0.5)
+	clock.sleep(0.5)
 	vc.openValves(deviceNames, ['in', 'out', 's1', 's2'])
-	time.sleep(washoutTime)
+	clock.sleep(washoutTime)
 	eh.scriptlogger.info('Done flowing buffer through devices for washout ' + str(bufferInputs))
    
 
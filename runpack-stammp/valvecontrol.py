@@ -8,9 +8,15 @@
 # python_version    : 2.7
 
 
-import time
+import threading
+import contextlib
 
-from acqpack import gui
+try:
+    from acqpack import gui
+except ImportError:
+    gui = None
+
+from runpack import clock
 from runpack.io import HardwareInterface as hi
 from runpack.io import ExperimentalHarness as eh
 
@@ -18,21 +24,35 @@ from runpack.io import ExperimentalHarness as eh
 ################################################################################
 
 
+CLOSED = True # coil state of a pressurized (closed) valve
+OPENED = False
+
+_valveLock = threading.Lock()
+_activeTransactions = threading.local()
+
+
 def launchGui():
     """Wrapper for AcqPack manifold-controlling widget.
 
+    Valve changes made with the widget are recorded in the shadow valve 
+    state register.
+
     Args:
         None
 
     Returns:
         None
     """
+    if gui is None:
+        raise ImportError('The manifold GUI requires acqpack')
     gui.manifold_control(hi.m, hi.valveReferenceIndex)
 
 
 def open(reference, valveName, logging = True):
     """Opens a valve.
 
+    The write is skipped if the valve is already open.
+
     Args:
         reference (str): valvemap reference name
         valveName (str): Valve name as per valvemap
@@ -42,7 +62,8 @@ def open(reference, valveName, logging = True):
         None
         
     """
-    hi.m.open(reference, valveName)
+    with _valveLock:
+        _commit({_coilOffset(reference, valveName): OPENED}, reference)
     if logging: 
         eh.valvelogger.info('Opened {}'.format(valveName))
 
@@ -50,6 +71,8 @@ def open(reference, valveName, logging = True):
 def close(reference, valveName, logging = True):
     """Closes a valve.
 
+    The write is skipped if the valve is already closed.
+
     Args:
         reference (str): valvemap reference name
         valveName (str): Valve name as per valvemap
@@ -59,11 +82,227 @@ def close(reference, valveName, logging = True):
         None
         
     """
-    hi.m.close(reference, valveName)
+    with _valveLock:
+        _commit({_coilOffset(reference, valveName): CLOSED}, reference)
     if logging: 
         eh.valvelogger.info('Closed {}'.format(valveName))
 
 
+def getValveState(device, valve, reference = hi.valveReferenceIndex):
+    """Returns the last commanded state of a valve without querying the manifold.
+
+    Args:
+        device (str): device name (e.g. 'd1')
+        valve (str): shorthand valve name (e.g. 'bb')
+        reference (str): valvemap reference name
+
+    Returns:
+        str | None: 'open' or 'closed', or None if the state is unknown
+
+    """
+    if hi.valveState is None:
+        return None
+    state = hi.valveState.get(_coilOffsets([device], [valve], reference)[0])
+    if state is None:
+        return None
+    return 'closed' if state == CLOSED else 'open'
+
+
+def supportsBulkWrite():
+    """Checks whether the manifold backend can write multiple coils at once.
+
+    Args:
+        None
+
+    Returns:
+        bool: True if the manifold client exposes Modbus multi-coil reads and writes
+
+    """
+    client = getattr(hi.m, 'client', None)
+    client = getattr(client, '_client', client) # unwrap the shadow register proxy
+    return hasattr(client, 'read_coils') and hasattr(client, 'write_coils')
+
+
+def _valveNames(devices, valves):
+    """Expands shorthand valve names to full valvemap names for each device.
+
+    Args:
+        devices (list | tuple): list of devices (e.g. ['d1', 'd2'])
+        valves (list | tuple): list of shorthand valves (e.g. ['bb', 'na'])
+
+    Returns:
+        list: full valve names (e.g. ['bb1', 'na1', 'bb2', 'na2'])
+
+    """
+    dnums = [dname[-1] for dname in devices]
+    return [valve+str(dnum) for dnum in dnums for valve in valves]
+
+
+def _coilOffset(reference, valveName):
+    """Resolves a valve name to its coil offset in the valvemap.
+
+    Uses the precompiled valve index for its reference column, and the 
+    manifold valvemap otherwise.
+
+    Args:
+        reference (str): valvemap reference name
+        valveName (str): Valve name as per valvemap
+
+    Returns:
+        int: coil offset relative to the manifold offset
+
+    """
+    index = hi.valveIndex
+    if index is not None and reference == index.reference:
+        try:
+            return index.nameLookup[valveName]
+        except KeyError:
+            raise ValueError('Valve {} not found in valvemap column {}'.format(valveName, reference))
+    valvemap = hi.m.valvemap
+    matches = valvemap.index[valvemap[reference] == valveName]
+    if len(matches) == 0:
+        raise ValueError('Valve {} not found in valvemap column {}'.format(valveName, reference))
+    return int(matches[0])
+
+
+def _coilOffsets(devices, valves, reference):
+    """Resolves shorthand valves of each device to coil offsets.
+
+    Args:
+        devices (list | tuple): list of devices (e.g. ['d1', 'd2'])
+        valves (list | tuple): list of shorthand valves (e.g. ['bb', 'na'])
+        reference (str): valvemap reference name
+
+    Returns:
+        list: coil offsets relative to the manifold offset
+
+    """
+    index = hi.valveIndex
+    if index is not None and reference == index.reference:
+        return index.coils(devices, valves)
+    return [_coilOffset(reference, v) for v in _valveNames(devices, valves)]
+
+
+def _valveName(reference, offset):
+    index = hi.valveIndex
+    if index is not None and reference == index.reference:
+        return index.names[offset]
+    return hi.m.valvemap.loc[offset, reference]
+
+
+def _inTransaction():
+    return getattr(_activeTransactions, 'transaction', None) is not None
+
+
+def _checkResponse(response, action):
+    if hasattr(response, 'isError') and response.isError():
+        raise IOError('Manifold {} failed: {}'.format(action, response))
+    return response
+
+
+def _writeCoils(coilStates):
+    """Writes the given coil states with a single multi-coil Modbus write.
+
+    The coils spanning the lowest to highest requested offset are written in 
+    one request. Coils in the span that were not requested keep their state 
+    from the shadow register, or are read back from the manifold first if 
+    their state is unknown.
+
+    Args:
+        coilStates (dict): coil offsets mapped to coil states (bool)
+
+    Returns:
+        None
+
+    """
+    first = min(coilStates)
+    count = max(coilStates) - first + 1
+    address = hi.manifoldOffset + first
+    if hi.valveState is not None and hi.valveState.isKnown(first, count):
+        coils = hi.valveState.coils(first, count)
+    else:
+        response = _checkResponse(hi.m.client.read_coils(address, count), 'coil read')
+        coils = list(response.bits[:count])
+    for offset, state in coilStates.items():
+        coils[offset - first] = state
+    _checkResponse(hi.m.client.write_coils(address, coils), 'coil write')
+
+
+def _commit(coilStates, reference, force = False):
+    """Writes coil states to the manifold, skipping coils already in state.
+
+    Must be called while holding the valve lock. Raises if an emergency stop
+    is in effect, so that queued valve writes cannot follow it.
+
+    Args:
+        coilStates (dict): coil offsets mapped to coil states (bool)
+        reference (str): valvemap reference name
+        force (bool): flag to write coils even if the shadow register 
+            reports them as already in state
+
+    Returns:
+        float: duration of the valve write (s)
+
+    """
+    if hi.haltEvent.is_set() and not force:
+        raise RuntimeError('Valve write refused: emergency stop in effect')
+    startTime = clock.monotonic()
+    pending = coilStates
+    if hi.valveState is not None and not force:
+        pending = hi.valveState.changes(coilStates)
+    if pending and supportsBulkWrite():
+        _writeCoils(pending)
+    else:
+        for offset, state in pending.items():
+            if not force:
+                clock.sleep(0.005)
+            valveName = _valveName(reference, offset)
+            if state == OPENED:
+                hi.m.open(reference, valveName)
+            else:
+                hi.m.close(reference, valveName)
+            if hi.valveState is not None:
+                hi.valveState.update({offset: state})
+    return clock.monotonic() - startTime
+
+
+def actuateValves(devices, opened = (), closed = (), reference = hi.valveReferenceIndex, logging = True):
+    """Opens and closes the specified valves of the specified devices together.
+
+    All valves are resolved to WAGO coil addresses and committed with one
+    multi-coil write. If the manifold backend cannot write multiple coils,
+    valves are written one at a time instead. A valve listed as both opened
+    and closed is closed. Valves already in the requested state, as per the 
+    shadow valve state register, are not written.
+
+    Args:
+        devices (list | tuple): list of devices (e.g. ['d1', 'd2', and 'd3'])
+        opened (list | tuple): list of valves to open (e.g. ['in', 'out'])
+        closed (list | tuple): list of valves to close (e.g. ['w'])
+        reference (str): valvemap reference name
+        logging (bool): flag to log valve state change
+
+    Returns:
+        float: duration of the valve write (s), or 0 if deferred to an open 
+            transaction
+
+    """
+    coilStates = {}
+    for offset in _coilOffsets(devices, opened, reference):
+        coilStates[offset] = OPENED
+    for offset in _coilOffsets(devices, closed, reference):
+        coilStates[offset] = CLOSED
+    if _inTransaction():
+        _activeTransactions.transaction.stage(coilStates)
+        return 0.0
+    with _valveLock:
+        writeTime = _commit(coilStates, reference)
+    if logging:
+        eh.valvelogger.info('Opened Valve(s) {}, Closed Valve(s) {} for Device(s) {} in {:.1f}ms'.format(
+            list(opened), list(closed), devices, writeTime*1000))
+    return writeTime
+
+
 def openValves(devices, valves, reference = hi.valveReferenceIndex, logging = True):  
     """Opens specified valves of specified devices. 
 
@@ -74,16 +313,13 @@ def openValves(devices, valves, reference = hi.valveReferenceIndex, logging = Tr
         valves (list): list of valves. (e.g. ['bb'] or ['bb, na, out'])
 
     Returns:
-        None
+        float: duration of the valve write (s)
 
     """
-    dnums = [dname[-1] for dname in devices]
-    for dnum in dnums:
-        for valve in valves:
-            time.sleep(0.005)
-            open(reference, valve+str(dnum), logging = False)
-    if logging:
-        eh.valvelogger.info('Opened Valve(s) {} for Device(s) {}'.format(valves, devices))
+    writeTime = actuateValves(devices, opened = valves, reference = reference, logging = False)
+    if logging and not _inTransaction():
+        eh.valvelogger.info('Opened Valve(s) {} for Device(s) {} in {:.1f}ms'.format(valves, devices, writeTime*1000))
+    return writeTime
 
 
 def closeValves(devices, valves, reference= hi.valveReferenceIndex, logging = True):
@@ -96,23 +332,45 @@ def closeValves(devices, valves, reference= hi.valveReferenceIndex, logging = Tr
         valves (list | tuple): list of valves. (e.g. ['bb'] or ['bb, na, out'])
 
     Returns:
-        None
+        float: duration of the valve write (s)
 
     """
-    dnums = [dname[-1] for dname in devices]
-    for dnum in dnums:
-        for valve in valves:
-            time.sleep(0.005)
-            close(reference, valve+str(dnum), logging = False)
-    if logging:
-        eh.valvelogger.info('Closed Valve(s) {} for Device(s) {}'.format(valves, devices))
+    writeTime = actuateValves(devices, closed = valves, reference = reference, logging = False)
+    if logging and not _inTransaction():
+        eh.valvelogger.info('Closed Valve(s) {} for Device(s) {} in {:.1f}ms'.format(valves, devices, writeTime*1000))
+    return writeTime
+
+
+def _safeState(devices, valves, reference):
+    """Returns the closed coil states of all valves of a type on the devices.
+
+    Args:
+        devices (list | tuple): list of devices (e.g. ['d1', 'd2'])
+        valves (str): which valving to shut ('all', 'flow', or 'control')
+        reference (str): valvemap reference name
+
+    Returns:
+        dict: coil offsets mapped to the closed coil state
+
+    """
+    if valves not in ('all', 'flow', 'control'):
+        raise ValueError('Valve type must be one of \'all\', \'flow\', or \'control\'')
+    index = hi.valveIndex
+    if index is not None and reference == index.reference:
+        offsets = index.layerCoils(devices, valves)
+    else:
+        shorthand = {'all': hi.flowValves + hi.controlValves, 
+                    'flow': hi.flowValves, 
+                    'control': hi.controlValves}[valves]
+        offsets = _coilOffsets(devices, shorthand, reference)
+    return dict.fromkeys(offsets, CLOSED)
 
 
 def returnToSafeState(devices, valves = 'all', reference = 'chip', logging = True):
     """Closes all valving of specified type
 
     If valves = 'all', shuts all inlets/outlets, depresses buttons, sandwiches,
-    and necks
+    and necks. The valves of all devices are closed with a single write.
     
     Note: flowValves ['w','bb','na','ph','ext1','ext2','prot', 'hep','out','in']
           controlValves ['neck','b1','b2','s1','s2']
@@ -122,24 +380,177 @@ def returnToSafeState(devices, valves = 'all', reference = 'chip', logging = Tru
             only, e.g. 'd1')
         valves (str): which valving to shut ('all', 'flow', or 'control')
 
+    Returns:
+        float: duration of the valve write (s), or 0 if deferred to an open 
+            transaction
+
+    """
+
+    coilStates = _safeState(devices, valves, reference)
+    if _inTransaction():
+        _activeTransactions.transaction.stage(coilStates)
+        return 0.0
+    with _valveLock:
+        writeTime = _commit(coilStates, reference)
+    if logging:
+        eh.valvelogger.info('Closed {} valves for devices {}'.format(valves, devices))
+    return writeTime
+
+
+def _emergencyState(reference):
+    """Returns the closed coil states of every mapped valve, for emergencyStop.
+
+    Uses the valve index if it is loaded for the reference, and every named 
+    valve of the loaded valvemap otherwise. Must not raise, so that the 
+    emergency write always happens.
+
+    Args:
+        reference (str): valvemap reference name
+
+    Returns:
+        dict: coil offsets mapped to the closed coil state, empty if no 
+            valvemap is loaded
+
+    """
+    index = hi.valveIndex
+    if index is not None and reference == index.reference:
+        devices = ['d'+dnum for dnum in sorted(index.layerMasks)]
+        return dict.fromkeys(index.layerCoils(devices, 'all'), CLOSED)
+    valvemap = getattr(hi.m, 'valvemap', None)
+    if valvemap is None or reference not in valvemap:
+        return {}
+    named = valvemap[reference].fillna('') != ''
+    return dict.fromkeys([int(offset) for offset in valvemap.index[named]], CLOSED)
+
+
+def emergencyStop(reference = 'chip'):
+    """Immediately closes every valve of every device and halts hardware work.
+
+    The halt flag is raised before the valve lock is taken, so valve writes 
+    queued behind an in-flight write are refused and the emergency write 
+    goes next. Scans stop before their next frame. Every valve is written 
+    closed regardless of the shadow valve state register. Without a valve 
+    index, the valves are found in the loaded valvemap. Call 
+    clearEmergencyStop() to resume.
+
+    Args:
+        reference (str): valvemap reference name
+
+    Returns:
+        float: latency from call to acknowledged valve write (s)
+
+    """
+    startTime = clock.monotonic()
+    hi.haltEvent.set()
+    coilStates = _emergencyState(reference)
+    if not coilStates:
+        eh.valvelogger.critical('EMERGENCY STOP: no valvemap loaded, no valves closed')
+        return clock.monotonic() - startTime
+    with _valveLock:
+        writeTime = _commit(coilStates, reference, force = True)
+    latency = clock.monotonic() - startTime
+    eh.valvelogger.critical('EMERGENCY STOP: closed all valves in {:.1f}ms (write {:.1f}ms)'.format(
+        latency*1000, writeTime*1000))
+    return latency
+
+
+def clearEmergencyStop():
+    """Clears the emergency stop halt flag so valve writes and scans may resume.
+
+    Args:
+        None
+
     Returns:
         None
 
     """
+    hi.haltEvent.clear()
+    eh.valvelogger.warning('Emergency stop cleared')
 
-    if valves == 'all':
-        for device in devices:
-            closeValves(devices, hi.flowValves, logging = False)
-            closeValves(devices, hi.controlValves, logging = False)
-        if logging:
-            eh.valvelogger.info('Closed all valves for devices {}'.format(devices))
-    elif valves == 'flow':
-        for device in devices:
-            closeValves(devices, hi.flowValves, logging = False)
-        if logging:
-            eh.valvelogger.info('Closed flow valves for devices {}'.format(devices))
-    elif valves == 'control':
-        for device in devices:
-            closeValves(devices, hi.controlValves, logging = False)
+
+class ValveTransaction:
+    def __init__(self, devices, reference = hi.valveReferenceIndex):
+        """Collects valve state changes to commit together in one write.
+
+        Later changes to a valve replace earlier ones, so contradictory opens
+        and closes cancel out and only the final state is written.
+
+        Args:
+            devices (list | tuple): list of devices in the transaction (e.g. 
+                ['d1', 'd2'])
+            reference (str): valvemap reference name
+
+        Returns:
+            None
+        """
+        self.devices = devices
+        self.reference = reference
+        self.coilStates = {}
+        self.commitTime = None
+
+
+    def stage(self, coilStates):
+        """Adds coil states to the transaction, replacing earlier states.
+
+        Args:
+            coilStates (dict): coil offsets mapped to coil states (bool)
+
+        Returns:
+            None
+        """
+        self.coilStates.update(coilStates)
+
+
+    def commit(self, logging = True):
+        """Writes the final valve states of the transaction in one write.
+
+        Args:
+            logging (bool): flag to log the combined valve state change
+
+        Returns:
+            float: duration of the valve write (s)
+        """
+        with _valveLock:
+            self.commitTime = _commit(self.coilStates, self.reference)
         if logging:
-            eh.valvelogger.info('Closed control valves for devices {}'.format(devices))
\ No newline at end of file
+            names = lambda state: [_valveName(self.reference, c) 
+                                    for c, s in sorted(self.coilStates.items()) if s == state]
+            eh.valvelogger.info('Transaction for Device(s) {}: Opened {}, Closed {} in {:.1f}ms'.format(
+                self.devices, names(OPENED), names(CLOSED), self.commitTime*1000))
+        return self.commitTime
+
+
+@contextlib.contextmanager
+def transaction(devices, reference = hi.valveReferenceIndex, logging = True):
+    """Defers valve changes made in the block and commits them in one write.
+
+    openValves, closeValves, actuateValves, and returnToSafeState called in 
+    the block on this thread are staged instead of written. On leaving the 
+    block, the final state of every touched valve is written with one 
+    batched write and logged as one entry. Nothing is written if the block
+    raises. A transaction opened inside another joins the outer one.
+
+        with vc.transaction(['d1']):
+            vc.closeValves(['d1'], ['w'])
+            vc.openValves(['d1'], ['in', 'out'])
+
+    Args:
+        devices (list | tuple): list of devices in the transaction (e.g. 
+            ['d1', 'd2'])
+        reference (str): valvemap reference name
+        logging (bool): flag to log the combined valve state change
+
+    Returns:
+        ValveTransaction: the transaction, whose commitTime holds the commit 
+            latency (s) after the block
+    """
+    if _inTransaction():
+        yield _activeTransactions.transaction
+        return
+    active = ValveTransaction(devices, reference)
+    _activeTransactions.transaction = active
+    try:
+        yield active
+    finally:
+        _activeTransactions.transaction = None
+    active.commit(logging = logging)